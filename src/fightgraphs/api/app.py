@@ -0,0 +1,252 @@
+"""Read API over the scraped collections.
+
+    uvicorn fightgraphs.api.app:app --workers 4
+
+Lists are paged with cursors: each page carries a next cursor to pass back as after, which resumes right behind the
+last document through an index instead of skipping over every earlier page. fields picks which of an endpoint's
+fields are returned. Fighter lookups, event cards and head-to-head records are cached in each process. Entries expire
+after API_CACHE_TTL seconds, and are dropped within API_VERSION_POLL_SECONDS once a pipeline writes to a collection
+they were read from. The indexes the queries rely on are created at startup."""
+import asyncio, base64, json, os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import FastAPI, HTTPException, Query
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from fightgraphs.db import MONGO_URI, MONGO_DATABASE, TAPOLOGY_FIGHTERS, TAPOLOGY_EVENTS, UFCSTATS_FIGHTERS, UFCSTATS_FIGHTS, FIGHTER_ID_MAP
+from fightgraphs.api.cache import TTLCache, VersionWatcher
+
+MAX_POOL_SIZE = int(os.getenv('API_MAX_POOL_SIZE', 100))
+CACHE_SIZE = int(os.getenv('API_CACHE_SIZE', 10000))
+CACHE_TTL = float(os.getenv('API_CACHE_TTL', 300))
+VERSION_POLL_SECONDS = float(os.getenv('API_VERSION_POLL_SECONDS', 1.0))
+MAX_PAGE_SIZE = 500
+
+# Compound indexes go equality fields first, then the fields pages are sorted and resumed on, then range fields
+INDEXES = {
+    UFCSTATS_FIGHTERS: [
+        [('fighter_link', ASCENDING)],
+        [('stance', ASCENDING), ('_id', ASCENDING), ('weight_kg', ASCENDING)],
+        # Searches without a stance walk the range of one attribute and sort each page of matches by _id in memory
+        [('weight_kg', ASCENDING), ('_id', ASCENDING)],
+        [('height_cm', ASCENDING), ('_id', ASCENDING)],
+        [('reach_cm', ASCENDING), ('_id', ASCENDING)]
+    ],
+    UFCSTATS_FIGHTS: [
+        [('fight_link', ASCENDING)],
+        [('fighters', ASCENDING), ('_id', ASCENDING)],
+        [('event_link', ASCENDING), ('_id', ASCENDING)]
+    ],
+    TAPOLOGY_FIGHTERS: [
+        [('tapology_link', ASCENDING)]
+    ],
+    TAPOLOGY_EVENTS: [
+        [('event_link', ASCENDING)],
+        [('promotion_link', ASCENDING), ('event_datetime', DESCENDING), ('_id', DESCENDING)],
+        [('event_datetime', DESCENDING), ('_id', DESCENDING)]
+    ]
+}
+
+FIGHTER_FIELDS = ('fighter_link', 'first_name', 'last_name', 'nickname', 'height', 'weight', 'reach', 'stance', 'wins', 'losses',
+                  'draws', 'champ', 'height_cm', 'weight_kg', 'reach_cm', 'record_wld', 'fights')
+EVENT_FIELDS = ('event_link', 'event_name', 'promotion_link', 'event_date', 'event_datetime', 'event_location', 'event_details', 'fights', 'fighters', 'bouts')
+BOUT_FIELDS = ('fight_link', 'event_link', 'event_name', 'fighters', 'fighter_names', 'outcomes', 'bout', 'title_fight', 'bonuses', 'method',
+               'round', 'time', 'time_format', 'referee', 'details', 'finish_round', 'finish_seconds', 'round_stats')
+# Fields left out of list pages unless asked for, they are the bulk of a document
+HEAVY_FIELDS = ('fights', 'fighters', 'bouts', 'event_details', 'round_stats')
+
+
+async def ensure_indexes(db):
+    for collection, indexes in INDEXES.items():
+        for keys in indexes:
+            try:
+                await db[collection].create_index(keys)
+            except OperationFailure:
+                # The pipeline's unique index on the same key already serves the lookup
+                pass
+
+
+def encode_cursor(values):
+    encoded = [{'$oid': str(value)} if isinstance(value, ObjectId) else {'$date': value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return [ObjectId(value['$oid']) if isinstance(value, dict) and '$oid' in value else datetime.fromisoformat(value['$date']) if isinstance(value, dict) else value for value in values]
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(400, 'Invalid cursor')
+
+
+def projection(fields, allowed, default_exclude=()):
+    """Mongo projection for a comma separated field list, or every allowed field but the heavy ones"""
+    if fields:
+        chosen = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = [field for field in chosen if field not in allowed]
+        if unknown:
+            raise HTTPException(400, f"Unknown fields {unknown}, choose from {list(allowed)}")
+    else:
+        chosen = [field for field in allowed if field not in default_exclude]
+    return {field: 1 for field in chosen}
+
+
+async def page(collection, query, fields, sort, limit):
+    """One page of a query sorted on sort, a list of (field, direction) ending in _id, with the cursor to the next one"""
+    docs = await collection.find(query, {**fields, **{field: 1 for field, _ in sort}}).sort(sort).limit(limit + 1).to_list(limit + 1)
+    cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        cursor = encode_cursor([docs[-1].get(field) for field, _ in sort])
+    for doc in docs:
+        doc.pop('_id', None)
+        for field, _ in sort:
+            if field not in fields:
+                doc.pop(field, None)
+    return {'items': docs, 'next': cursor}
+
+
+def after(sort, cursor):
+    """Query for the documents sorted behind a cursor: later on the first field, or equal on it and later on the next"""
+    values = decode_cursor(cursor)
+    if len(values) != len(sort):
+        raise HTTPException(400, 'Invalid cursor')
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {previous: values[j] for j, (previous, _) in enumerate(sort[:i])}
+        if values[i] is None:
+            # Missing values sort lowest, so only a descending sort has anything behind them
+            if direction == ASCENDING:
+                clause[field] = {'$ne': None}
+            else:
+                continue
+        else:
+            clause[field] = {'$gt' if direction == ASCENDING else '$lt': values[i]}
+        clauses.append(clause)
+    return {'$or': clauses} if clauses else {'_id': {'$exists': False}}
+
+
+def source_of(link):
+    return 'ufcstats' if 'ufcstats.com' in link else 'tapology'
+
+
+def create_app(client=None):
+    """The API, on a given Motor client or one made from MONGO_URI"""
+
+    @asynccontextmanager
+    async def lifespan(app):
+        mongo = client or AsyncIOMotorClient(MONGO_URI, maxPoolSize=MAX_POOL_SIZE)
+        app.state.db = mongo[MONGO_DATABASE]
+        app.state.cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+        await ensure_indexes(app.state.db)
+        watcher = VersionWatcher(app.state.db, app.state.cache, VERSION_POLL_SECONDS)
+        await watcher.poll()
+        task = asyncio.create_task(watcher.run())
+        yield
+        task.cancel()
+        if client is None:
+            mongo.close()
+
+    app = FastAPI(title='FightGraphs', lifespan=lifespan)
+
+    @app.get('/fighters')
+    async def search_fighters(stance: str = None, min_height_cm: float = None, max_height_cm: float = None,
+                              min_weight_kg: float = None, max_weight_kg: float = None, min_reach_cm: float = None,
+                              max_reach_cm: float = None, fields: str = None, after_cursor: str = Query(None, alias='after'),
+                              limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+        """ufcstats fighters by stance and physical attributes"""
+        query = {'stance': stance} if stance else {}
+        for field, low, high in (('height_cm', min_height_cm, max_height_cm), ('weight_kg', min_weight_kg, max_weight_kg), ('reach_cm', min_reach_cm, max_reach_cm)):
+            bounds = {operator: value for operator, value in (('$gte', low), ('$lte', high)) if value is not None}
+            if bounds:
+                query[field] = bounds
+        sort = [('_id', ASCENDING)]
+        if after_cursor:
+            query = {'$and': [query, after(sort, after_cursor)]}
+        return await page(app.state.db[UFCSTATS_FIGHTERS], query, projection(fields, FIGHTER_FIELDS, HEAVY_FIELDS), sort, limit)
+
+    @app.get('/fighters/lookup')
+    async def lookup_fighter(link: str):
+        """A fighter from either source by link, with the link of the same fighter on the other source"""
+        collection, key_field = (UFCSTATS_FIGHTERS, 'fighter_link') if source_of(link) == 'ufcstats' else (TAPOLOGY_FIGHTERS, 'tapology_link')
+
+        async def load():
+            db = app.state.db
+            fighter, match = await asyncio.gather(
+                db[collection].find_one({key_field: link}, {'_id': 0, 'hash': 0}),
+                db[FIGHTER_ID_MAP].find_one({'$or': [{'tapology_link': link}, {'ufcstats_link': link}]}, {'_id': 0, 'tapology_link': 1, 'ufcstats_link': 1})
+            )
+            if fighter is not None and match is not None:
+                fighter['matched_link'] = match['tapology_link'] if match['ufcstats_link'] == link else match['ufcstats_link']
+            return fighter
+
+        fighter = await app.state.cache.get_or_load(('fighter', link), (collection, FIGHTER_ID_MAP), load)
+        if fighter is None:
+            raise HTTPException(404, 'Fighter not found')
+        return fighter
+
+    @app.get('/fighters/bouts')
+    async def fighter_bouts(link: str, fields: str = None, after_cursor: str = Query(None, alias='after'), limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+        """A ufcstats fighter's bouts with their details"""
+        query = {'fighters': link}
+        sort = [('_id', ASCENDING)]
+        if after_cursor:
+            query = {'$and': [query, after(sort, after_cursor)]}
+        return await page(app.state.db[UFCSTATS_FIGHTS], query, projection(fields, BOUT_FIELDS, ('round_stats',)), sort, limit)
+
+    @app.get('/head-to-head')
+    async def head_to_head(first: str, second: str):
+        """Every ufcstats bout between two fighters, with round stats where the bout was scraped"""
+        async def load():
+            db = app.state.db
+            fighter = await db[UFCSTATS_FIGHTERS].find_one({'fighter_link': first}, {'_id': 0, 'fights': 1})
+            fights = [fight for fight in (fighter or {}).get('fights') or [] if second in (fight.get('fighters_involved') or [])]
+            links = [fight['fight_link'] for fight in fights if fight.get('fight_link')]
+            details = {bout['fight_link']: bout async for bout in db[UFCSTATS_FIGHTS].find({'fight_link': {'$in': links}}, {'_id': 0, 'hash': 0})}
+            return {'first': first, 'second': second, 'bouts': [{**fight, 'details': details.get(fight.get('fight_link'))} for fight in fights]}
+
+        # Keyed on the order too, the bouts are read from the first fighter's record
+        return await app.state.cache.get_or_load(('head_to_head', first, second), (UFCSTATS_FIGHTERS, UFCSTATS_FIGHTS), load)
+
+    @app.get('/events')
+    async def search_events(promotion: str = None, start: datetime = None, end: datetime = None, fields: str = None,
+                            after_cursor: str = Query(None, alias='after'), limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+        """Tapology events, newest first, by promotion and date range"""
+        query = {'promotion_link': promotion} if promotion else {}
+        bounds = {operator: value for operator, value in (('$gte', start), ('$lte', end)) if value is not None}
+        if bounds:
+            query['event_datetime'] = bounds
+        sort = [('event_datetime', DESCENDING), ('_id', DESCENDING)]
+        if after_cursor:
+            query = {'$and': [query, after(sort, after_cursor)]}
+        return await page(app.state.db[TAPOLOGY_EVENTS], query, projection(fields, EVENT_FIELDS, HEAVY_FIELDS), sort, limit)
+
+    @app.get('/events/card')
+    async def event_card(link: str):
+        """A Tapology event with its bout and fighter links, or the scraped bouts of a ufcstats event"""
+        if source_of(link) == 'tapology':
+            async def load():
+                return await app.state.db[TAPOLOGY_EVENTS].find_one({'event_link': link}, {'_id': 0, 'hash': 0})
+            tags = (TAPOLOGY_EVENTS,)
+        else:
+            async def load():
+                fields = {field: 1 for field in BOUT_FIELDS if field != 'round_stats'}
+                bouts = await app.state.db[UFCSTATS_FIGHTS].find({'event_link': link}, {'_id': 0, **fields}).sort('_id', ASCENDING).to_list(None)
+                return {'event_link': link, 'event_name': bouts[0].get('event_name'), 'bouts': bouts} if bouts else None
+            tags = (UFCSTATS_FIGHTS,)
+        card = await app.state.cache.get_or_load(('card', link), tags, load)
+        if card is None:
+            raise HTTPException(404, 'Event not found')
+        return card
+
+    @app.get('/stats')
+    async def stats():
+        return {'cache': app.state.cache.stats()}
+
+    return app
+
+
+app = create_app()
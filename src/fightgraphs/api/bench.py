@@ -0,0 +1,90 @@
+"""Load test of the read API against the configured database.
+
+    python -m fightgraphs.api.bench [--url http://localhost:8000] [--requests 5000] [--concurrency 50] [--sample 200]
+
+Without --url the app is served in process, which measures the handlers, the driver and the cache without a network
+hop. Requests are drawn from real fighter and event links sampled from the database, mixing cached lookups with
+paged searches, and the run reports throughput, latency percentiles and the cache hit rate the server saw."""
+import argparse, asyncio, random, time
+import httpx
+import numpy as np
+from fightgraphs.db import get_db, TAPOLOGY_EVENTS, UFCSTATS_FIGHTERS, FIGHTER_ID_MAP
+
+
+def sample_paths(db, sample, seed=0):
+    """Request paths over sample links of each kind, weighted towards the cached lookups"""
+    fighters = [doc for doc in db[UFCSTATS_FIGHTERS].aggregate([{'$sample': {'size': sample}}, {'$project': {'fighter_link': 1, 'fights.fighters_involved': 1, 'stance': 1}}])]
+    events = [doc['event_link'] for doc in db[TAPOLOGY_EVENTS].aggregate([{'$sample': {'size': sample}}, {'$project': {'event_link': 1}}])]
+    matched = [doc['tapology_link'] for doc in db[FIGHTER_ID_MAP].aggregate([{'$sample': {'size': sample}}, {'$project': {'tapology_link': 1}}])]
+    rng = random.Random(seed)
+    paths = []
+    for fighter in fighters:
+        link = fighter['fighter_link']
+        paths += [f'/fighters/lookup?link={link}'] * 3 + [f'/fighters/bouts?link={link}&limit=20']
+        opponents = {other for fight in fighter.get('fights') or [] for other in fight.get('fighters_involved') or [] if other != link}
+        if opponents:
+            paths.append(f'/head-to-head?first={link}&second={rng.choice(sorted(opponents))}')
+        if fighter.get('stance'):
+            paths.append(f"/fighters?stance={fighter['stance']}&min_weight_kg=60&limit=50")
+    paths += [f'/events/card?link={link}' for link in events for _ in range(3)]
+    paths += [f'/fighters/lookup?link={link}' for link in matched]
+    paths += ['/events?limit=50'] * max(len(events) // 10, 1)
+    return paths
+
+
+async def run(client, paths, requests, concurrency, seed=0):
+    rng = random.Random(seed)
+    queue = [rng.choice(paths) for _ in range(requests)]
+    latencies, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            path = queue.pop()
+            started = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 500:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, np.array(latencies), errors
+
+
+async def main(args):
+    paths = sample_paths(get_db(), args.sample)
+    if not paths:
+        print('Nothing to request, the collections are empty')
+        return
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, limits=httpx.Limits(max_connections=args.concurrency))
+        server = None
+    else:
+        from fightgraphs.api.app import create_app
+        app = create_app()
+        server = app.router.lifespan_context(app)
+        await server.__aenter__()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench')
+    try:
+        # A short warm up so connection setup is not counted
+        await run(client, paths, min(args.concurrency * 2, args.requests), args.concurrency)
+        elapsed, latencies, errors = await run(client, paths, args.requests, args.concurrency, seed=1)
+        cache = (await client.get('/stats')).json()['cache']
+    finally:
+        await client.aclose()
+        if server is not None:
+            await server.__aexit__(None, None, None)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    print(f"{args.requests} requests over {len(paths)} paths in {elapsed:.2f}s with {args.concurrency} concurrent: {args.requests / elapsed:.0f} req/s")
+    print(f"Latency p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms, {errors} server errors")
+    print(f"Cache hit rate {cache['hit_rate']:.1%} over {cache['hits'] + cache['misses']} lookups, {cache['entries']} entries")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the read API')
+    parser.add_argument('--url', help='Base URL of a running server, the app is served in process by default')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--sample', type=int, default=200, help='Links sampled from each collection')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,108 @@
+"""In-process cache for the API's hot lookups, emptied of a collection's entries when the pipelines write to it."""
+import asyncio, logging, time
+from collections import OrderedDict
+from pymongo.errors import PyMongoError
+from fightgraphs.db import CACHE_VERSIONS
+
+cache_logger = logging.getLogger('api.cache')
+
+MISSING = object()
+
+
+class TTLCache:
+    """LRU cache whose entries also expire ttl seconds after they were stored.
+
+    Each entry is tagged with the collections it was read from, so a write to one collection only drops what it
+    could have changed. A load that was running while its collections were invalidated is not stored."""
+
+    def __init__(self, maxsize=10000, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tagged = {}
+        self.generations = {}
+        self.hits = self.misses = self.invalidated = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def set(self, key, value, tags, generations=None):
+        if generations is not None and generations != self.generation_of(tags):
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, tags, value)
+        for tag in tags:
+            self.tagged.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.maxsize:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, tags, _ = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+
+    def generation_of(self, tags):
+        return tuple(self.generations.get(tag, 0) for tag in tags)
+
+    def invalidate(self, tag):
+        self.generations[tag] = self.generations.get(tag, 0) + 1
+        keys = self.tagged.pop(tag, set())
+        for key in keys:
+            if key in self.entries:
+                self._remove(key)
+        self.invalidated += len(keys)
+
+    async def get_or_load(self, key, tags, load):
+        """The cached value of key, or the result of awaiting load(), stored unless tags were invalidated meanwhile"""
+        value = self.get(key)
+        if value is MISSING:
+            generations = self.generation_of(tags)
+            value = await load()
+            self.set(key, value, tags, generations)
+        return value
+
+    def stats(self):
+        lookups = max(self.hits + self.misses, 1)
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4), 'invalidated': self.invalidated}
+
+
+class VersionWatcher:
+    """Polls the write counters the pipelines keep in cache_versions and invalidates the collections whose count moved"""
+
+    def __init__(self, db, cache, interval=1.0):
+        self.db = db
+        self.cache = cache
+        self.interval = interval
+        self.versions = None
+
+    async def poll(self):
+        versions = {doc['_id']: doc.get('version') async for doc in self.db[CACHE_VERSIONS].find({})}
+        if self.versions is not None:
+            for collection, version in versions.items():
+                if self.versions.get(collection) != version:
+                    self.cache.invalidate(collection)
+        self.versions = versions
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except PyMongoError as e:
+                # Without fresh versions the TTL still bounds how stale an entry can get
+                cache_logger.warning(f"Could not read cache versions: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,22 @@
+from pymongo import MongoClient
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DATABASE = os.getenv("MONGO_DATABASE")
+
+TAPOLOGY_FIGHTERS = 'scrapy_tapology_fighters_initial'
+TAPOLOGY_EVENTS = 'scrapy_tapology_events'
+TAPOLOGY_PROMOTIONS = 'scrapy_tapology_promotions'
+UFCSTATS_FIGHTERS = 'scrapy_ufcstats_fighter'
+UFCSTATS_FIGHTS = 'scrapy_ufcstats_fights'
+FIGHTER_ID_MAP = 'fighter_id_map'
+# Write counters the pipelines bump, read by the API to drop stale cache entries
+CACHE_VERSIONS = 'cache_versions'
+
+
+def get_db(mongo_uri=MONGO_URI, mongo_db=MONGO_DATABASE):
+    """Connects to the database the scrapers write to"""
+    return MongoClient(mongo_uri)[mongo_db]
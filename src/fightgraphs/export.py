@@ -0,0 +1,354 @@
+"""Exports the scraped collections to Parquet, so analysis memory maps typed columns instead of pulling BSON.
+
+    python -m fightgraphs.export run <dir> [--collection scrapy_tapology_events ...] [--full] [--batch-size 20000]
+    python -m fightgraphs.export info <dir>
+
+Each collection gets a directory with a table of its documents and a child table for each nested array, keyed on
+the document's natural link: a row per ufcstats fight of a fighter, per bout and fighter link of a Tapology event,
+per event detail and per fighter per round of a ufcstats bout. Every export run writes its own run=<id> partition of
+each table, in files of at most --batch-size documents. Runs only export documents whose hash was not exported
+before, so a document changed in place by an upsert shows up again in a later run; load() keeps the newest copy.
+A run counts once it is listed in the collection's _manifest.json, files left behind by a run that never got there
+are removed by the next one. --full exports everything again and drops the older runs.
+
+Every table has one schema, kept in the manifest. A column whose type changes between batches, like a count that
+is 'N/A' in one batch, is widened (integers to floats, anything else to strings), and parts written before are
+cast to the widened schema when they are read."""
+import argparse, base64, json, os, shutil, time
+from datetime import datetime, timezone
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from fightgraphs.db import get_db, TAPOLOGY_FIGHTERS, TAPOLOGY_EVENTS, TAPOLOGY_PROMOTIONS, UFCSTATS_FIGHTERS, UFCSTATS_FIGHTS
+
+DOCUMENTS = 'documents'
+HASH_SIZE = 16
+
+# Collection -> (natural key, {nested field: how it is flattened into its child table})
+#   records: a list of dicts, a row per dict with its keys as columns
+#   values:  a list of scalars, a row per value
+#   pairs:   a dict of scalars, a row per name and value
+#   columns: a dict of equal length lists, a row per position
+COLLECTIONS = {
+    TAPOLOGY_PROMOTIONS: ('promotion_link', {'social_media_links': 'values'}),
+    TAPOLOGY_FIGHTERS: ('tapology_link', {}),
+    TAPOLOGY_EVENTS: ('event_link', {'fights': 'values', 'fighters': 'values', 'bouts': 'records', 'event_details': 'pairs'}),
+    UFCSTATS_FIGHTERS: ('fighter_link', {'fights': 'records'}),
+    UFCSTATS_FIGHTS: ('fight_link', {'round_stats': 'columns'})
+}
+
+
+def child_rows(kind, key_field, key, value):
+    if kind == 'records':
+        for position, record in enumerate(value if isinstance(value, list) else []):
+            if isinstance(record, dict):
+                yield {key_field: key, 'position': position, **record}
+    elif kind == 'values':
+        for position, item in enumerate(value if isinstance(value, list) else []):
+            yield {key_field: key, 'position': position, 'value': item}
+    elif kind == 'pairs':
+        for name, item in (value if isinstance(value, dict) else {}).items():
+            yield {key_field: key, 'name': name, 'value': item}
+    elif kind == 'columns' and isinstance(value, dict):
+        columns = {name: values for name, values in value.items() if isinstance(values, list)}
+        for position in range(max(map(len, columns.values()), default=0)):
+            yield {key_field: key, **{name: values[position] if position < len(values) else None for name, values in columns.items()}}
+
+
+def stringify(value):
+    return None if value is None else value if isinstance(value, str) else json.dumps(value, default=str) if isinstance(value, (list, dict)) else str(value)
+
+
+def to_arrow(rows):
+    """Arrow table of dict rows. Columns holding values of several types, like 'N/A' next to numbers, become strings"""
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    columns = {}
+    for name in names:
+        values = [row.get(name) for row in rows]
+        kinds = {type(value) for value in values if value is not None}
+        if len(kinds) > 1 and not kinds <= {int, float}:
+            values = [stringify(value) for value in values]
+        try:
+            columns[name] = pa.array(values)
+        except (pa.ArrowException, TypeError, ValueError):
+            # Lists or dicts whose items differ in type
+            columns[name] = pa.array([stringify(value) for value in values], pa.string())
+    return pa.table(columns)
+
+
+def widen_type(first, second):
+    """The narrowest type holding values of both types"""
+    if first == second or pa.types.is_null(second):
+        return first
+    if pa.types.is_null(first):
+        return second
+    if (pa.types.is_integer(first) or pa.types.is_floating(first)) and (pa.types.is_integer(second) or pa.types.is_floating(second)):
+        return pa.float64()
+    if pa.types.is_list(first) and pa.types.is_list(second) and (pa.types.is_null(first.value_type) or pa.types.is_null(second.value_type)):
+        return first if pa.types.is_null(second.value_type) else second
+    return pa.string()
+
+
+def widen_schema(schema, other):
+    """Schema holding the columns of both, in the order they were first seen"""
+    if schema is None:
+        return other
+    types = {field.name: field.type for field in schema}
+    for field in other:
+        types[field.name] = widen_type(types[field.name], field.type) if field.name in types else field.type
+    return pa.schema([(name, kind) for name, kind in types.items()])
+
+
+def conform(table, schema):
+    """Casts a table to the schema, adding the columns it lacks as nulls"""
+    columns = []
+    for field in schema:
+        if field.name not in table.column_names:
+            columns.append(pa.chunked_array([pa.nulls(table.num_rows, field.type)]))
+            continue
+        column = table.column(field.name)
+        if column.type == field.type:
+            columns.append(column)
+        elif pa.types.is_string(field.type):
+            # Written the way to_arrow writes mixed columns, so old and new parts read the same
+            columns.append(pa.chunked_array([pa.array([stringify(value) for value in column.to_pylist()], pa.string())]))
+        else:
+            columns.append(column.cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def encode_schema(schema):
+    return base64.b64encode(schema.serialize().to_pybytes()).decode()
+
+
+def decode_schema(data):
+    return pa.ipc.read_schema(pa.py_buffer(base64.b64decode(data)))
+
+
+def compact_hash(item_hash):
+    # The same 128 bit prefix the pipelines keep in memory
+    try:
+        return bytes.fromhex(item_hash.rpartition(':')[2])[:HASH_SIZE]
+    except ValueError:
+        return item_hash.encode()[:HASH_SIZE].ljust(HASH_SIZE, b'\0')
+
+
+class CollectionExport:
+    """The exported runs of one collection and the hashes of every document they hold"""
+
+    def __init__(self, directory, collection):
+        self.collection = collection
+        self.key_field, self.children = COLLECTIONS[collection]
+        self.directory = os.path.join(directory, collection)
+        self.manifest_path = os.path.join(self.directory, '_manifest.json')
+        self.runs = []
+        self.schemas = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.runs = manifest['runs']
+            self.schemas = {table: decode_schema(data) for table, data in manifest['schemas'].items()}
+
+    @property
+    def tables(self):
+        return [DOCUMENTS] + list(self.children)
+
+    def hashes_path(self, run):
+        return os.path.join(self.directory, '_hashes', f'{run}.bin')
+
+    def exported_hashes(self):
+        hashes = set()
+        for run in self.runs:
+            with open(self.hashes_path(run), 'rb') as f:
+                data = f.read()
+            hashes.update(data[i:i + HASH_SIZE] for i in range(0, len(data), HASH_SIZE))
+        return hashes
+
+    def run_files(self, table, runs=None):
+        files = []
+        for run in self.runs if runs is None else runs:
+            path = os.path.join(self.directory, table, f'run={run}')
+            if os.path.isdir(path):
+                files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.parquet'))
+        return files
+
+    def schema(self, table):
+        """The table's schema as kept in the manifest, None before anything was written to it"""
+        return self.schemas.get(table)
+
+    def widen(self, table, schema):
+        self.schemas[table] = widen_schema(self.schema(table), schema)
+        return self.schemas[table]
+
+    def remove_unlisted(self, keep=()):
+        """Deletes partitions and hash files of runs missing from the manifest"""
+        listed = set(self.runs) | set(keep)
+        for table in self.tables:
+            path = os.path.join(self.directory, table)
+            for name in os.listdir(path) if os.path.isdir(path) else []:
+                if name.startswith('run=') and name[4:] not in listed:
+                    shutil.rmtree(os.path.join(path, name))
+        path = os.path.join(self.directory, '_hashes')
+        for name in os.listdir(path) if os.path.isdir(path) else []:
+            if name[:-4] not in listed:
+                os.remove(os.path.join(path, name))
+
+    def commit(self, run, replace=False):
+        self.runs = [run] if replace else self.runs + [run]
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump({'collection': self.collection, 'key': self.key_field, 'tables': self.tables, 'runs': self.runs,
+                       'schemas': {table: encode_schema(schema) for table, schema in self.schemas.items()}}, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+        if replace:
+            self.remove_unlisted()
+
+
+class RunWriter:
+    """Buffers the rows of one run and writes each table's rows out as a Parquet file every batch of documents"""
+
+    def __init__(self, export, run, batch_size):
+        self.export = export
+        self.run = run
+        self.batch_size = batch_size
+        self.rows = {table: [] for table in export.tables}
+        self.hashes = []
+        self.parts = 0
+        self.documents = 0
+        os.makedirs(os.path.join(export.directory, '_hashes'), exist_ok=True)
+        self.hashes_file = open(export.hashes_path(run), 'wb')
+
+    def add(self, doc):
+        doc.pop('_id', None)
+        key = doc.get(self.export.key_field)
+        for field, kind in self.export.children.items():
+            self.rows[field].extend(child_rows(kind, self.export.key_field, key, doc.pop(field, None)))
+        self.rows[DOCUMENTS].append(doc)
+        self.hashes.append(compact_hash(doc['hash']) if isinstance(doc.get('hash'), str) else None)
+        self.documents += 1
+        if len(self.rows[DOCUMENTS]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows[DOCUMENTS]:
+            return
+        for table, rows in self.rows.items():
+            if not rows:
+                continue
+            path = os.path.join(self.export.directory, table, f'run={self.run}')
+            os.makedirs(path, exist_ok=True)
+            part = to_arrow(rows)
+            part = conform(part, self.export.widen(table, part.schema))
+            pq.write_table(part, os.path.join(path, f'part-{self.parts:05d}.parquet'), compression='zstd')
+        self.hashes_file.write(b''.join(item_hash for item_hash in self.hashes if item_hash))
+        self.hashes_file.flush()
+        self.rows = {table: [] for table in self.export.tables}
+        self.hashes = []
+        self.parts += 1
+
+    def close(self):
+        self.flush()
+        self.hashes_file.close()
+
+
+def export_collection(db, directory, collection, full=False, batch_size=20000):
+    """Writes the documents of a collection not exported yet as a new run, returns (run, documents written)"""
+    export = CollectionExport(directory, collection)
+    run = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    export.remove_unlisted()
+    if full:
+        # The older runs are dropped, so their schemas no longer constrain the columns
+        export.schemas = {}
+    writer = RunWriter(export, run, batch_size)
+    if full or not export.runs:
+        for doc in db[collection].find({}, batch_size=batch_size):
+            writer.add(doc)
+    else:
+        # Only hashes cross the wire to find the new documents, which are then fetched a batch at a time
+        exported = export.exported_hashes()
+        new_ids = [doc['_id'] for doc in db[collection].find({}, {'hash': 1}, batch_size=batch_size)
+                   if not isinstance(doc.get('hash'), str) or compact_hash(doc['hash']) not in exported]
+        for i in range(0, len(new_ids), batch_size):
+            for doc in db[collection].find({'_id': {'$in': new_ids[i:i + batch_size]}}):
+                writer.add(doc)
+    writer.close()
+    if not writer.documents:
+        export.remove_unlisted()
+        return None, 0
+    export.commit(run, replace=full)
+    return run, writer.documents
+
+
+def load(directory, collection, table=DOCUMENTS, columns=None, latest=True):
+    """Reads an exported table memory mapped, with the run each row came from, every part cast to the table's schema.
+    With latest only the rows of the newest export of each document are kept, and rows without a key are left out"""
+    export = CollectionExport(directory, collection)
+    schema = export.schema(table)
+    if schema is None:
+        return pa.table({})
+    if columns is not None:
+        columns = set(columns) | {export.key_field}
+        schema = pa.schema([field for field in schema if field.name in columns])
+    parts = []
+    for run in export.runs:
+        for path in export.run_files(table, [run]):
+            stored = pq.read_schema(path).names
+            part = pq.read_table(path, columns=[name for name in schema.names if name in stored], memory_map=True)
+            part = conform(part, schema)
+            parts.append(part.append_column('run', pa.array([run] * part.num_rows, pa.string())))
+    if not parts:
+        return pa.table({})
+    result = pa.concat_tables(parts)
+    if not latest:
+        return result
+    if export.key_field not in result.column_names:
+        return result.slice(0, 0)
+    result = result.filter(pc.is_valid(result.column(export.key_field)))
+    if len(export.runs) < 2:
+        return result
+    # The newest run of each key, read from the documents table, then the rows of other runs are dropped
+    documents = result if table == DOCUMENTS else load(directory, collection, DOCUMENTS, [export.key_field], latest=False)
+    documents = documents.filter(pc.is_valid(documents.column(export.key_field)))
+    keys = documents.column(export.key_field).to_numpy(zero_copy_only=False)
+    runs = documents.column('run').to_numpy(zero_copy_only=False)
+    order = np.argsort(runs, kind='stable')[::-1]
+    _, first = np.unique(keys[order], return_index=True)
+    newest = {}
+    for key, run in zip(keys[order][first], runs[order][first]):
+        newest.setdefault(run, []).append(key)
+    mask = None
+    for run, run_keys in newest.items():
+        selected = pc.and_(pc.equal(result.column('run'), run), pc.is_in(result.column(export.key_field), value_set=pa.array(run_keys)))
+        mask = selected if mask is None else pc.or_(mask, selected)
+    return result.filter(mask)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export scraped collections to Parquet')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='Export documents not exported yet')
+    run.add_argument('directory')
+    run.add_argument('--collection', action='append', choices=sorted(COLLECTIONS), help='Collections to export, every one by default')
+    run.add_argument('--full', action='store_true', help='Export everything again and drop the older runs')
+    run.add_argument('--batch-size', type=int, default=20000)
+    info = commands.add_parser('info', help='Runs, rows and size on disk of each exported table')
+    info.add_argument('directory')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        db = get_db()
+        for collection in args.collection or COLLECTIONS:
+            started = time.time()
+            run_id, documents = export_collection(db, args.directory, collection, args.full, args.batch_size)
+            elapsed = max(time.time() - started, 1e-9)
+            print(f"{collection}: exported {documents} documents in {elapsed:.1f}s ({documents / elapsed:.0f} docs/s)" + (f" as run {run_id}" if run_id else ''))
+    else:
+        for collection in COLLECTIONS:
+            export = CollectionExport(args.directory, collection)
+            if not export.runs:
+                continue
+            for table in export.tables:
+                files = export.run_files(table)
+                rows = sum(pq.ParquetFile(path).metadata.num_rows for path in files)
+                size = sum(os.path.getsize(path) for path in files)
+                print(f"{collection}/{table}: {len(export.runs)} runs, {rows} rows, {size / 2 ** 20:.1f} MiB")
@@ -0,0 +1,317 @@
+"""Fight graph over every scraped bout, stored in CSR form over integer fighter ids.
+
+    python -m fightgraphs.graph build <dir> [--full]
+    python -m fightgraphs.graph query <dir> <fighter link> [--versus <fighter link>]
+    python -m fightgraphs.graph bench <dir> [--samples 1000]
+    python -m fightgraphs.graph check
+
+Bouts come from the fights arrays of scrapy_ufcstats_fighter and the per bout card of scrapy_tapology_events.
+A Tapology fighter matched to a ufcstats fighter in fighter_id_map is the same node as the ufcstats fighter, and
+a bout is counted once however many pages list it: it is keyed on its bout link and on who fought on which day,
+so a UFC bout listed by both sources is only taken once. Events scraped before the card was stored per bout
+have no bouts to give. The arrays are saved as .npy files and opened memory mapped, so loading the graph costs
+next to nothing and it can be shared between processes. build only streams documents added since the last
+build and compacts the new bouts into the arrays. Pass --full, which rebuilds the graph from scratch, after
+upsert-mode crawls, which update documents in place, and after fighter matching runs. check builds a graph
+from one UFC bout as ufcstats and a Tapology card list it, and fails unless it becomes a single edge."""
+import argparse, hashlib, json, os, random, time
+from datetime import datetime
+import numpy as np
+from bson import ObjectId
+from fightgraphs.db import get_db, TAPOLOGY_EVENTS, UFCSTATS_FIGHTERS, FIGHTER_ID_MAP
+from scraping.dates import parse_event_date
+
+EMPTY = np.zeros(0, dtype=np.int32)
+EPOCH = datetime(1970, 1, 1)
+
+
+def bout_key(link):
+    """64 bit key of a bout link, enough to tell 850k bouts apart at a fraction of the memory of the strings"""
+    return int.from_bytes(hashlib.blake2b(link.encode(), digest_size=8).digest(), 'little')
+
+
+def pair_key(first, second, day):
+    """Key of a bout from who fought on which day, the same whichever source lists the bout"""
+    first, second = sorted((first, second))
+    return bout_key(f'{first}|{second}|{day}')
+
+
+def fight_day(fight):
+    """Days since 1970 of a fight, from the typed event_datetime when the normalization pipeline added it, else
+    from event_date as either source shows it, 'Oct. 19, 2024' on ufcstats or 'Saturday 10.19.2024' on Tapology"""
+    value = fight.get('event_datetime')
+    if not isinstance(value, datetime):
+        value = parse_event_date(fight.get('event_date'))
+        if value is None:
+            return None
+    return (value.replace(tzinfo=None) - EPOCH).days
+
+
+class FighterIndex:
+    """Dense integer ids for fighter links, in the order they were first seen"""
+
+    def __init__(self, links=()):
+        self.links = list(links)
+        self.ids = {link: i for i, link in enumerate(self.links)}
+
+    def __len__(self):
+        return len(self.links)
+
+    def get(self, link):
+        return self.ids.get(link)
+
+    def add(self, link):
+        fighter = self.ids.get(link)
+        if fighter is None:
+            fighter = self.ids[link] = len(self.links)
+            self.links.append(link)
+        return fighter
+
+
+class FightGraph:
+    """Undirected fighter graph.
+
+    Row i of the CSR arrays lists fighter i's opponents in indices[indptr[i]:indptr[i + 1]], sorted, with the
+    number of bouts against each in the same slice of bouts. Bouts added since the last compaction sit in a small
+    dict and are merged into query results until compact() folds them into the arrays."""
+
+    def __init__(self, nodes=None, indptr=None, indices=None, bouts=None, seen=None, cursors=None):
+        self.nodes = nodes or FighterIndex()
+        self.indptr = indptr if indptr is not None else np.zeros(1, dtype=np.int64)
+        self.indices = indices if indices is not None else EMPTY
+        self.bouts = bouts if bouts is not None else EMPTY
+        self.seen = seen if seen is not None else set()
+        self.cursors = cursors or {}
+        self.delta = {}
+
+    @property
+    def rows(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def build(cls, nodes, rows, cols, weights):
+        """Builds the CSR arrays from directed edge arrays, summing the weights of repeated edges"""
+        count = max(len(nodes), 1)
+        keep = rows != cols
+        keys = rows[keep].astype(np.int64) * count + cols[keep]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        summed = np.bincount(inverse, weights=weights[keep], minlength=len(keys)).astype(np.int32)
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // count, minlength=len(nodes)), out=indptr[1:])
+        return cls(nodes, indptr, (keys % count).astype(np.int32), summed)
+
+    def add_bout(self, key, first, second, day=None):
+        """Adds a bout between two fighter links, unless the bout was seen before under its link or, when the day
+        is known, under who fought on that day. Returns whether it was added"""
+        keys = (key,) if day is None else (key, pair_key(first, second, day))
+        if first == second or any(k in self.seen for k in keys):
+            return False
+        self.seen.update(keys)
+        a, b = self.nodes.add(first), self.nodes.add(second)
+        for x, y in ((a, b), (b, a)):
+            opponents = self.delta.setdefault(x, {})
+            opponents[y] = opponents.get(y, 0) + 1
+        return True
+
+    def compact(self):
+        """Folds the bouts added since the last compaction into the CSR arrays"""
+        if not self.delta:
+            return
+        rows = np.repeat(np.arange(self.rows, dtype=np.int64), np.diff(self.indptr))
+        delta_rows = np.fromiter((x for x, opponents in self.delta.items() for _ in opponents), dtype=np.int64)
+        delta_cols = np.fromiter((y for opponents in self.delta.values() for y in opponents), dtype=np.int64)
+        delta_bouts = np.fromiter((n for opponents in self.delta.values() for n in opponents.values()), dtype=np.int64)
+        graph = FightGraph.build(
+            self.nodes,
+            np.concatenate([rows, delta_rows]),
+            np.concatenate([self.indices.astype(np.int64), delta_cols]),
+            np.concatenate([self.bouts.astype(np.int64), delta_bouts])
+        )
+        self.indptr, self.indices, self.bouts = graph.indptr, graph.indices, graph.bouts
+        self.delta = {}
+
+    def fighter_id(self, fighter):
+        return fighter if isinstance(fighter, (int, np.integer)) else self.nodes.get(fighter)
+
+    def opponents(self, fighter):
+        """Sorted ids of everyone the fighter has fought"""
+        fighter = self.fighter_id(fighter)
+        if fighter is None:
+            return EMPTY
+        base = self.indices[self.indptr[fighter]:self.indptr[fighter + 1]] if fighter < self.rows else EMPTY
+        extra = self.delta.get(fighter)
+        if extra:
+            return np.union1d(base, np.fromiter(extra, dtype=np.int32))
+        return base
+
+    def _gather(self, fighters):
+        """Concatenated opponent lists of many fighters, sliced straight out of the CSR arrays"""
+        fighters = np.asarray(fighters, dtype=np.int64)
+        in_arrays = fighters[fighters < self.rows]
+        starts = self.indptr[in_arrays]
+        lengths = self.indptr[in_arrays + 1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        parts = [self.indices[positions]]
+        for fighter in fighters:
+            if fighter in self.delta:
+                parts.append(np.fromiter(self.delta[fighter], dtype=np.int32))
+        return np.concatenate(parts)
+
+    def opponents_of_opponents(self, fighter):
+        """Fighters two bouts away, leaving out the fighter and their direct opponents"""
+        fighter = self.fighter_id(fighter)
+        if fighter is None:
+            return EMPTY
+        direct = self.opponents(fighter)
+        second = np.unique(self._gather(direct))
+        return np.setdiff1d(second, np.append(direct, fighter), assume_unique=True)
+
+    def common_opponents(self, first, second):
+        return np.intersect1d(self.opponents(first), self.opponents(second), assume_unique=True)
+
+    def links(self, fighters):
+        return [self.nodes.links[i] for i in fighters]
+
+    def save(self, directory):
+        """Writes the arrays next to the fighter links, each file swapped in only once fully written"""
+        self.compact()
+        os.makedirs(directory, exist_ok=True)
+        arrays = {'indptr': self.indptr, 'indices': self.indices, 'bouts': self.bouts,
+                  'seen': np.array(sorted(self.seen), dtype=np.uint64)}
+        for name, values in arrays.items():
+            with open(os.path.join(directory, f'{name}.npy.tmp'), 'wb') as f:
+                np.save(f, values)
+        with open(os.path.join(directory, 'nodes.json.tmp'), 'w') as f:
+            json.dump({'links': self.nodes.links, 'cursors': self.cursors}, f)
+        for name in list(arrays) + ['nodes']:
+            filename = f'{name}.json' if name == 'nodes' else f'{name}.npy'
+            os.replace(os.path.join(directory, filename + '.tmp'), os.path.join(directory, filename))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        if not os.path.exists(os.path.join(directory, 'nodes.json')):
+            return cls()
+        with open(os.path.join(directory, 'nodes.json')) as f:
+            meta = json.load(f)
+        mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mode) for name in ('indptr', 'indices', 'bouts')}
+        seen = set(np.load(os.path.join(directory, 'seen.npy')).tolist())
+        return cls(FighterIndex(meta['links']), arrays['indptr'], arrays['indices'], arrays['bouts'], seen, meta.get('cursors'))
+
+    def add_document(self, collection, doc, aliases):
+        """Adds the bouts a document of either source lists, returns how many were new"""
+        extract = ufcstats_bouts if collection == UFCSTATS_FIGHTERS else tapology_bouts
+        added = 0
+        for key, first, second, day in extract(doc):
+            added += self.add_bout(key, aliases.get(first, first), aliases.get(second, second), day)
+        return added
+
+    def update_from_mongo(self, db, full=False, batch_size=5000):
+        """Streams bouts out of both sources, only documents newer than the last update unless full.
+        Matched Tapology fighters are filed under their ufcstats link"""
+        added = 0
+        aliases = {doc['tapology_link']: doc['ufcstats_link'] for doc in db[FIGHTER_ID_MAP].find({}, {'tapology_link': 1, 'ufcstats_link': 1})}
+        for collection in (UFCSTATS_FIGHTERS, TAPOLOGY_EVENTS):
+            query = {}
+            if not full and self.cursors.get(collection):
+                query = {'_id': {'$gt': ObjectId(self.cursors[collection])}}
+            if collection == UFCSTATS_FIGHTERS:
+                projection = {'fights.fight_link': 1, 'fights.fighters_involved': 1, 'fights.event_date': 1, 'fights.event_datetime': 1}
+            else:
+                projection = {'bouts': 1, 'event_date': 1, 'event_datetime': 1}
+            for doc in db[collection].find(query, projection, batch_size=batch_size).sort('_id', 1):
+                added += self.add_document(collection, doc, aliases)
+                self.cursors[collection] = str(doc['_id'])
+        self.compact()
+        return added
+
+
+def ufcstats_bouts(doc):
+    for fight in doc.get('fights') or []:
+        fighters = fight.get('fighters_involved') or []
+        if len(fighters) == 2 and fight.get('fight_link'):
+            yield bout_key(fight['fight_link']), fighters[0], fighters[1], fight_day(fight)
+
+
+def tapology_bouts(doc):
+    day = fight_day(doc)
+    for bout in doc.get('bouts') or []:
+        fighters = bout.get('fighters') or []
+        if len(fighters) == 2 and bout.get('bout_link'):
+            yield bout_key(bout['bout_link']), fighters[0], fighters[1], day
+
+
+def bench(graph, samples=1000, seed=7):
+    rng = random.Random(seed)
+    fighters = [rng.randrange(graph.rows) for _ in range(samples)]
+    timings = {}
+    started = time.perf_counter()
+    for fighter in fighters:
+        graph.opponents_of_opponents(fighter)
+    timings['opponents_of_opponents'] = (time.perf_counter() - started) / samples * 1e3
+    # Pair each fighter with an opponent's opponent, so the pairs have at least one opponent in common
+    pairs = []
+    for fighter in fighters:
+        opponents = graph.opponents(fighter)
+        second = graph.opponents(int(opponents[0])) if len(opponents) else EMPTY
+        pairs.append((fighter, int(second[-1]) if len(second) else fighter))
+    started = time.perf_counter()
+    for first, second in pairs:
+        graph.common_opponents(first, second)
+    timings['common_opponents'] = (time.perf_counter() - started) / samples * 1e3
+    return timings
+
+
+def check():
+    """Builds a graph from one UFC bout as both fighters' ufcstats pages and a Tapology card list it, with the dates
+    as scraped, and returns the bouts counted between the two fighters"""
+    graph = FightGraph()
+    fight = {'fight_link': 'http://ufcstats.com/fight-details/check', 'event_date': 'Oct. 19, 2024',
+             'fighters_involved': ['http://ufcstats.com/fighter-details/a', 'http://ufcstats.com/fighter-details/b']}
+    for link in fight['fighters_involved']:
+        graph.add_document(UFCSTATS_FIGHTERS, {'fighter_link': link, 'fights': [fight]}, {})
+    card = {'event_date': 'Saturday 10.19.2024',
+            'bouts': [{'bout_link': 'https://www.tapology.com/fightcenter/bouts/check', 'fighters': ['/fighters/a', '/fighters/b']}]}
+    aliases = {'/fighters/a': 'http://ufcstats.com/fighter-details/a', '/fighters/b': 'http://ufcstats.com/fighter-details/b'}
+    graph.add_document(TAPOLOGY_EVENTS, card, aliases)
+    graph.compact()
+    return graph.bouts.tolist()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and query the fight graph')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Build or update the graph from MongoDB')
+    build.add_argument('directory')
+    build.add_argument('--full', action='store_true', help='Rebuild from every document instead of adding new ones')
+    query = commands.add_parser('query', help='Opponents of opponents, or common opponents with --versus')
+    query.add_argument('directory')
+    query.add_argument('fighter')
+    query.add_argument('--versus', default=None)
+    benchmark = commands.add_parser('bench', help='Time queries for random fighters')
+    benchmark.add_argument('directory')
+    benchmark.add_argument('--samples', type=int, default=1000)
+    commands.add_parser('check', help='Check that a bout listed by both sources becomes one edge')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        graph = FightGraph() if args.full else FightGraph.load(args.directory, mmap=False)
+        started = time.time()
+        added = graph.update_from_mongo(get_db(), args.full)
+        graph.save(args.directory)
+        print(f"Added {added} bouts in {time.time() - started:.1f}s, graph has {len(graph.nodes)} fighters and {len(graph.indices) // 2} pairings")
+    elif args.command == 'query':
+        graph = FightGraph.load(args.directory)
+        if args.versus:
+            print('\n'.join(graph.links(graph.common_opponents(args.fighter, args.versus))))
+        else:
+            print('\n'.join(graph.links(graph.opponents_of_opponents(args.fighter))))
+    elif args.command == 'check':
+        bouts = check()
+        print(f"Bouts between the two fighters: {bouts}")
+        if bouts != [1, 1]:
+            raise SystemExit("A bout listed by both sources was counted more than once")
+    else:
+        graph = FightGraph.load(args.directory)
+        for name, milliseconds in bench(graph, args.samples).items():
+            print(f"{name}: {milliseconds:.3f} ms per query")
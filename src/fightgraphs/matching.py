@@ -0,0 +1,369 @@
+"""Links Tapology fighters to ufcstats fighters, which share no key, and stores the resolved pairs in MongoDB.
+
+    python -m fightgraphs.matching resolve [--full] [--threshold 0.8]
+    python -m fightgraphs.matching lookup <fighter link>
+    python -m fightgraphs.matching bench [--tapology 300000] [--ufcstats 20000]
+
+Names are folded to lowercase ASCII tokens. Tapology has no name field, so its names come from the slug of the
+fighter link, which sometimes ends in the nickname. Every ufcstats fighter goes into an inverted index under a few
+blocking keys: the Soundex codes of each pair of name tokens, and the code of each token with the weight class or
+with the height bucket. A Tapology fighter is only scored against the fighters sharing at least two of its keys, on
+name similarity, height, weight class and record. Pairs above the threshold are assigned best first, one to one, and
+upserted into fighter_id_map. resolve only reads documents added since the last run: new Tapology fighters are
+matched against every ufcstats fighter, and Tapology fighters still unmatched against the new ufcstats fighters.
+--full rescores everything and replaces the map."""
+import argparse, difflib, random, re, time, unicodedata
+from collections import Counter
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import combinations
+from bson import ObjectId
+from pymongo import ASCENDING, UpdateOne
+from fightgraphs.db import get_db, TAPOLOGY_FIGHTERS, UFCSTATS_FIGHTERS, FIGHTER_ID_MAP
+
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+LEADING_ID = re.compile(r'^\d+-')
+FEET_INCHES = re.compile(r"(\d+)'\s*(\d+(?:\.\d+)?)?")
+CENTIMETRES = re.compile(r'(\d+(?:\.\d+)?)\s*cm')
+POUNDS = re.compile(r'(\d+(?:\.\d+)?)\s*lbs?\b')
+RECORD = re.compile(r'(\d+)\s*-\s*(\d+)\s*-\s*(\d+)')
+
+SOUNDEX_CODES = {letter: code for code, letters in enumerate(('aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r')) for letter in letters}
+# Upper limit in pounds of each weight class, the last one is open ended
+WEIGHT_LIMITS = (105, 115, 125, 135, 145, 155, 170, 185, 205, 265)
+WEIGHT_CLASSES = ('atomweight', 'strawweight', 'flyweight', 'bantamweight', 'featherweight', 'lightweight',
+                  'welterweight', 'middleweight', 'lightheavyweight', 'heavyweight', 'superheavyweight')
+HEIGHT_BUCKET_CM = 5
+FUZZY_FLOOR = 0.7
+CM_PER_INCH = 2.54
+
+STATE = f'{FIGHTER_ID_MAP}_state'
+TAPOLOGY_PROJECTION = {'tapology_link': 1, 'height': 1, 'height_cm': 1, 'weightclass': 1, 'record': 1, 'record_wld': 1}
+UFCSTATS_PROJECTION = {'fighter_link': 1, 'first_name': 1, 'last_name': 1, 'nickname': 1, 'height': 1, 'height_cm': 1,
+                       'weight': 1, 'wins': 1, 'losses': 1, 'draws': 1, 'record_wld': 1}
+
+
+def name_tokens(name):
+    """Jiří Procházka -> ['jiri', 'prochazka']"""
+    if not isinstance(name, str):
+        return []
+    folded = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode().lower()
+    return [token for token in NON_ALPHANUMERIC.split(folded) if token and token != 'n']
+
+
+def slug_tokens(link):
+    """/fightcenter/fighters/10332-jon-jones-bones -> ['jon', 'jones', 'bones']"""
+    slug = link.rstrip('/').rsplit('/', 1)[-1] if isinstance(link, str) else ''
+    return name_tokens(LEADING_ID.sub('', slug))
+
+
+@lru_cache(maxsize=1 << 16)
+def soundex(token):
+    letters = [letter for letter in token if letter in SOUNDEX_CODES]
+    if not letters:
+        return token
+    code, previous = letters[0], SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES[letter]
+        # h and w do not separate two consonants with the same code, vowels do
+        if letter in 'hw':
+            continue
+        if digit and digit != previous:
+            code += str(digit)
+        previous = digit
+    return (code + '000')[:4]
+
+
+def weight_class(value):
+    """Index into WEIGHT_CLASSES of a weight like 155 lbs. or a class name like Light_Heavyweight"""
+    if not isinstance(value, str):
+        return None
+    match = POUNDS.search(value)
+    if match:
+        pounds = float(match.group(1))
+        return next((i for i, limit in enumerate(WEIGHT_LIMITS) if pounds <= limit), len(WEIGHT_LIMITS))
+    folded = NON_ALPHANUMERIC.sub('', value.lower())
+    # Longest names first, so lightheavyweight is not taken for heavyweight
+    for name in sorted(WEIGHT_CLASSES, key=len, reverse=True):
+        if name in folded:
+            return WEIGHT_CLASSES.index(name)
+    return None
+
+
+def height_cm(doc):
+    """The typed height_cm when the normalization pipeline added it, parsed from the raw height otherwise"""
+    if isinstance(doc.get('height_cm'), (int, float)):
+        return float(doc['height_cm'])
+    value = doc.get('height')
+    if not isinstance(value, str):
+        return None
+    match = CENTIMETRES.search(value)
+    if match:
+        return float(match.group(1))
+    match = FEET_INCHES.search(value)
+    return round((int(match.group(1)) * 12 + float(match.group(2) or 0)) * CM_PER_INCH, 1) if match else None
+
+
+def record(doc):
+    if isinstance(doc.get('record_wld'), list) and len(doc['record_wld']) == 3:
+        return tuple(doc['record_wld'])
+    if 'wins' in doc:
+        parts = [doc.get(key) for key in ('wins', 'losses', 'draws')]
+        return tuple(int(part) for part in parts) if all(str(part).strip().isdigit() for part in parts) else None
+    match = RECORD.search(doc.get('record') or '')
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+class Fighter:
+    """What matching needs to know about a fighter from either source"""
+
+    __slots__ = ('link', 'tokens', 'nickname', 'height', 'weightclass', 'record')
+
+    def __init__(self, link, tokens, nickname=(), height=None, weightclass=None, record=None):
+        self.link = link
+        self.tokens = tokens
+        self.nickname = nickname
+        self.height = height
+        self.weightclass = weightclass
+        self.record = record
+
+    @classmethod
+    def from_tapology(cls, doc):
+        return cls(doc.get('tapology_link'), slug_tokens(doc.get('tapology_link')), (), height_cm(doc), weight_class(doc.get('weightclass')), record(doc))
+
+    @classmethod
+    def from_ufcstats(cls, doc):
+        tokens = name_tokens(doc.get('first_name')) + name_tokens(doc.get('last_name'))
+        return cls(doc.get('fighter_link'), tokens, tuple(name_tokens(doc.get('nickname'))), height_cm(doc), weight_class(doc.get('weight')), record(doc))
+
+    def blocking_keys(self):
+        codes = [soundex(token) for token in self.tokens]
+        # Pairs in sorted order, so swapped given and family names still meet
+        keys = {('name',) + tuple(sorted(pair)) for pair in combinations(codes, 2)}
+        for code in codes:
+            if self.weightclass is not None:
+                keys.add(('weight', code, self.weightclass))
+            if self.height is not None:
+                keys.add(('height', code, int(self.height // HEIGHT_BUCKET_CM)))
+        return keys
+
+
+@lru_cache(maxsize=1 << 16)
+def letter_counts(token):
+    return Counter(token)
+
+
+@lru_cache(maxsize=1 << 20)
+def token_similarity(first, second):
+    """SequenceMatcher ratio of two name tokens, tokens less alike than FUZZY_FLOOR count as different"""
+    if 2 * min(len(first), len(second)) < FUZZY_FLOOR * (len(first) + len(second)):
+        return 0.0
+    # Letters in common bound the ratio from above, and are much cheaper to count than the matching blocks
+    first_letters, second_letters = letter_counts(first), letter_counts(second)
+    common = sum(min(count, second_letters.get(letter, 0)) for letter, count in first_letters.items())
+    if 2 * common < FUZZY_FLOOR * (len(first) + len(second)):
+        return 0.0
+    ratio = difflib.SequenceMatcher(None, first, second).ratio()
+    return ratio if ratio >= FUZZY_FLOOR else 0.0
+
+
+def name_similarity(tokens, other):
+    """Share of the shorter name's tokens found in the other, fuzzily, less a little for each token left over"""
+    short, long = sorted((tokens, other), key=len)
+    if not short:
+        return 0.0
+    found = 0.0
+    for token in short:
+        # Most tokens are found as they are, which spares the fuzzy comparisons
+        found += 1.0 if token in long else max(token_similarity(*sorted((token, candidate))) for candidate in long)
+    return found / len(short) - 0.05 * (len(long) - len(short))
+
+
+def score(tapology, ufcstats):
+    """(overall, name) similarity of two fighters, attributes missing on either side count as a coin toss"""
+    name = name_similarity(tapology.tokens, ufcstats.tokens)
+    if ufcstats.nickname:
+        name = max(name, name_similarity(tapology.tokens, ufcstats.tokens + list(ufcstats.nickname)))
+    height = weight = history = 0.5
+    if tapology.height is not None and ufcstats.height is not None:
+        difference = abs(tapology.height - ufcstats.height)
+        height = 1.0 if difference <= 3 else 0.5 if difference <= 6 else 0.0
+    if tapology.weightclass is not None and ufcstats.weightclass is not None:
+        weight = {0: 1.0, 1: 0.5}.get(abs(tapology.weightclass - ufcstats.weightclass), 0.0)
+    if tapology.record and ufcstats.record:
+        # The two sites update records at different times, so a couple of fights apart is still a match
+        difference = sum(abs(a - b) for a, b in zip(tapology.record, ufcstats.record))
+        history = 1.0 if difference == 0 else 0.75 if difference <= 2 else 0.25 if difference <= 6 else 0.0
+    return 0.6 * name + 0.15 * height + 0.1 * weight + 0.15 * history, name
+
+
+class Resolver:
+    """Inverted index of ufcstats fighters by blocking key"""
+
+    def __init__(self, threshold=0.8, name_threshold=0.85, min_shared_keys=2, max_block=1000):
+        self.threshold = threshold
+        self.name_threshold = name_threshold
+        self.min_shared_keys = min_shared_keys
+        self.max_block = max_block
+        self.fighters = []
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.fighters)
+
+    def add(self, fighter):
+        if not fighter.link or not fighter.tokens:
+            return
+        position = len(self.fighters)
+        self.fighters.append(fighter)
+        for key in fighter.blocking_keys():
+            self.postings.setdefault(key, []).append(position)
+
+    def candidates(self, fighter):
+        """Indexed fighters sharing enough blocking keys, leaving out blocks too common to tell anyone apart"""
+        shared = Counter()
+        for key in fighter.blocking_keys():
+            posting = self.postings.get(key)
+            if posting and len(posting) <= self.max_block:
+                shared.update(posting)
+        return [self.fighters[position] for position, count in shared.items() if count >= self.min_shared_keys]
+
+    def match(self, fighter):
+        """(score, tapology link, ufcstats link) for every candidate good enough to be a match"""
+        if not fighter.link or not fighter.tokens:
+            return []
+        pairs = []
+        for candidate in self.candidates(fighter):
+            overall, name = score(fighter, candidate)
+            if overall >= self.threshold and name >= self.name_threshold:
+                pairs.append((overall, fighter.link, candidate.link))
+        return pairs
+
+
+def assign(pairs, taken_tapology=(), taken_ufcstats=()):
+    """Best scoring pairs first, each fighter used at most once"""
+    taken_tapology, taken_ufcstats = set(taken_tapology), set(taken_ufcstats)
+    matches = []
+    for overall, tapology, ufcstats in sorted(pairs, reverse=True):
+        if tapology in taken_tapology or ufcstats in taken_ufcstats:
+            continue
+        taken_tapology.add(tapology)
+        taken_ufcstats.add(ufcstats)
+        matches.append((overall, tapology, ufcstats))
+    return matches
+
+
+def ensure_indexes(db):
+    db[FIGHTER_ID_MAP].create_index([('tapology_link', ASCENDING)], unique=True)
+    db[FIGHTER_ID_MAP].create_index([('ufcstats_link', ASCENDING)])
+
+
+def resolve(db, threshold=0.8, full=False, batch_size=5000):
+    """Matches fighters added since the last run, or everyone with full, and writes the pairs to fighter_id_map"""
+    started = datetime.now(timezone.utc)
+    ensure_indexes(db)
+    cursors = {} if full else db[STATE].find_one({'_id': 'cursors'}) or {}
+    mapped = {} if full else {doc['tapology_link']: doc['ufcstats_link'] for doc in db[FIGHTER_ID_MAP].find({}, {'tapology_link': 1, 'ufcstats_link': 1})}
+
+    everyone, newcomers = Resolver(threshold), Resolver(threshold)
+    ufcstats_cursor = ObjectId(cursors[UFCSTATS_FIGHTERS]) if cursors.get(UFCSTATS_FIGHTERS) else None
+    for doc in db[UFCSTATS_FIGHTERS].find({}, UFCSTATS_PROJECTION, batch_size=batch_size).sort('_id', 1):
+        fighter = Fighter.from_ufcstats(doc)
+        everyone.add(fighter)
+        if ufcstats_cursor and doc['_id'] > ufcstats_cursor:
+            newcomers.add(fighter)
+        cursors[UFCSTATS_FIGHTERS] = str(doc['_id'])
+
+    # Fighters read by the last run only need another look when there are new ufcstats fighters to match them with
+    tapology_cursor = ObjectId(cursors[TAPOLOGY_FIGHTERS]) if cursors.get(TAPOLOGY_FIGHTERS) else None
+    query = {'_id': {'$gt': tapology_cursor}} if tapology_cursor and not len(newcomers) else {}
+    pairs, scored = [], 0
+    for doc in db[TAPOLOGY_FIGHTERS].find(query, TAPOLOGY_PROJECTION, batch_size=batch_size).sort('_id', 1):
+        cursors[TAPOLOGY_FIGHTERS] = str(doc['_id'])
+        if doc.get('tapology_link') in mapped:
+            continue
+        resolver = everyone if tapology_cursor is None or doc['_id'] > tapology_cursor else newcomers
+        pairs.extend(resolver.match(Fighter.from_tapology(doc)))
+        scored += 1
+
+    matches = assign(pairs, mapped, mapped.values())
+    operations = [UpdateOne({'tapology_link': tapology}, {'$set': {'ufcstats_link': ufcstats, 'score': round(overall, 4), 'matched_at': started}}, upsert=True)
+                  for overall, tapology, ufcstats in matches]
+    for i in range(0, len(operations), batch_size):
+        db[FIGHTER_ID_MAP].bulk_write(operations[i:i + batch_size], ordered=False)
+    if full:
+        db[FIGHTER_ID_MAP].delete_many({'matched_at': {'$lt': started}})
+    cursors.pop('_id', None)
+    db[STATE].replace_one({'_id': 'cursors'}, cursors, upsert=True)
+    return scored, len(matches)
+
+
+def lookup(db, link):
+    """The other source's link for a fighter link from either source"""
+    doc = db[FIGHTER_ID_MAP].find_one({'$or': [{'tapology_link': link}, {'ufcstats_link': link}]})
+    if doc is None:
+        return None
+    return doc['ufcstats_link'] if doc['tapology_link'] == link else doc['tapology_link']
+
+
+def synthetic_sources(tapology, ufcstats, seed=7):
+    """Random Tapology fighters and noisy ufcstats copies of some of them, with the true pairs, for benchmarking"""
+    rng = random.Random(seed)
+    syllables = ['ka', 'ro', 'mi', 'an', 'de', 'lu', 'so', 'ta', 'vi', 'ne', 'gor', 'sil', 'man', 'ber', 'ski', 'ov', 'ez', 'son']
+    firsts = sorted({''.join(rng.choices(syllables, k=rng.randint(2, 3))) for _ in range(3000)})
+    lasts = sorted({''.join(rng.choices(syllables, k=rng.randint(2, 4))) for _ in range(40000)})
+    tapology_fighters, ufcstats_fighters, truth = [], [], {}
+    for i in range(tapology):
+        tokens = [rng.choice(firsts), rng.choice(lasts)]
+        height = round(rng.gauss(178, 8), 1)
+        weightclass = rng.randrange(len(WEIGHT_CLASSES))
+        wins, losses = rng.randint(0, 30), rng.randint(0, 12)
+        nickname = [rng.choice(lasts)] if rng.random() < 0.1 else []
+        tapology_fighters.append(Fighter(f'/fightcenter/fighters/{i}-{"-".join(tokens + nickname)}', tokens + nickname, (), height, weightclass, (wins, losses, 0)))
+    for fighter in rng.sample(tapology_fighters, ufcstats):
+        tokens = list(fighter.tokens[:2])
+        if rng.random() < 0.2:
+            # A typo or transliteration difference in one letter
+            word = rng.randrange(2)
+            position = rng.randrange(len(tokens[word]))
+            tokens[word] = tokens[word][:position] + rng.choice('aeiouy') + tokens[word][position + 1:]
+        weightclass = fighter.weightclass if rng.random() < 0.8 else min(fighter.weightclass + 1, len(WEIGHT_CLASSES) - 1)
+        wins, losses, draws = fighter.record
+        link = f'http://ufcstats.com/fighter-details/{len(ufcstats_fighters):016x}'
+        ufcstats_fighters.append(Fighter(link, tokens, tuple(fighter.tokens[2:]), round(fighter.height + rng.uniform(-1.5, 1.5), 1), weightclass, (max(wins - rng.randint(0, 2), 0), losses, draws)))
+        truth[fighter.link] = link
+    return tapology_fighters, ufcstats_fighters, truth
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Match Tapology fighters to ufcstats fighters')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('resolve', help='Match new fighters and store the pairs in MongoDB')
+    run.add_argument('--full', action='store_true', help='Rescore every fighter and replace the map')
+    run.add_argument('--threshold', type=float, default=0.8)
+    find = commands.add_parser('lookup', help='The matching link from the other source')
+    find.add_argument('link')
+    benchmark = commands.add_parser('bench', help='Time a full join over synthetic fighters')
+    benchmark.add_argument('--tapology', type=int, default=300000)
+    benchmark.add_argument('--ufcstats', type=int, default=20000)
+    benchmark.add_argument('--threshold', type=float, default=0.8)
+    args = parser.parse_args()
+
+    if args.command == 'resolve':
+        started = time.time()
+        scored, matched = resolve(get_db(), args.threshold, args.full)
+        print(f"Scored {scored} Tapology fighters and matched {matched} in {time.time() - started:.1f}s")
+    elif args.command == 'lookup':
+        print(lookup(get_db(), args.link))
+    else:
+        tapology_fighters, ufcstats_fighters, truth = synthetic_sources(args.tapology, args.ufcstats)
+        started = time.time()
+        resolver = Resolver(args.threshold)
+        for fighter in ufcstats_fighters:
+            resolver.add(fighter)
+        pairs = [pair for fighter in tapology_fighters for pair in resolver.match(fighter)]
+        matches = assign(pairs)
+        elapsed = time.time() - started
+        correct = sum(1 for _, tapology, ufcstats in matches if truth.get(tapology) == ufcstats)
+        print(f"Matched {len(matches)} of {len(truth)} pairs in {elapsed:.1f}s, "
+              f"precision {correct / max(len(matches), 1):.3f}, recall {correct / max(len(truth), 1):.3f}")
@@ -0,0 +1,427 @@
+"""Elo and Glicko-2 ratings over the fight history, computed one rating period at a time with NumPy.
+
+    python -m fightgraphs.ratings build <dir> [--period-days 30] [--full]
+    python -m fightgraphs.ratings top <dir> [--system glicko2] [--limit 25]
+    python -m fightgraphs.ratings history <dir> <fighter link> [--date 2020-01-31]
+    python -m fightgraphs.ratings bench [--fights 850000] [--fighters 300000]
+
+Results come from the fights arrays of scrapy_ufcstats_fighter. Each bout is taken once, from whichever
+fighter's page is seen first, and no contests are skipped. Tapology events list who fought but not who won, so
+they cannot feed the ratings. Fights are laid out as date-sorted arrays. Every fight in a period is rated
+against the ratings from the start of that period, which is what lets a period be computed as one batch.
+Every fighter's Elo rating and Glicko-2 rating, deviation and volatility are kept after each period they fought
+in, so their ratings on any date can be read back. build only streams documents whose hash it has not read
+before, new ones and ones an upsert changed in place. It rates their fights on top of the saved state when
+they all come after the last rated period, and reruns everything otherwise."""
+import argparse, json, math, os, time
+from datetime import datetime, timedelta
+import numpy as np
+from fightgraphs.db import get_db, UFCSTATS_FIGHTERS
+from fightgraphs.graph import FighterIndex, bout_key, fight_day, EPOCH
+
+SCORES = {'win': 1.0, 'loss': 0.0, 'draw': 0.5}
+GLICKO_SCALE = 173.7178
+
+
+class FightTable:
+    """Fights as parallel arrays sorted by day: fighter a, fighter b and a's score (1 win, 0.5 draw, 0 loss)"""
+
+    def __init__(self, nodes=None, days=(), a=(), b=(), scores=()):
+        self.nodes = nodes or FighterIndex()
+        self.days = np.asarray(days, dtype=np.int32)
+        self.a = np.asarray(a, dtype=np.int32)
+        self.b = np.asarray(b, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.sort()
+
+    def __len__(self):
+        return len(self.days)
+
+    def sort(self):
+        order = np.argsort(self.days, kind='stable')
+        self.days, self.a, self.b, self.scores = self.days[order], self.a[order], self.b[order], self.scores[order]
+
+    def extend(self, days, a, b, scores):
+        self.days = np.concatenate([self.days, np.asarray(days, dtype=np.int32)])
+        self.a = np.concatenate([self.a, np.asarray(a, dtype=np.int32)])
+        self.b = np.concatenate([self.b, np.asarray(b, dtype=np.int32)])
+        self.scores = np.concatenate([self.scores, np.asarray(scores, dtype=np.float64)])
+        self.sort()
+
+
+def document_key(doc):
+    # Documents from before item hashes were stored are read once, under their _id
+    return bout_key(str(doc.get('hash') or doc['_id']))
+
+
+def stream_fights(db, nodes, seen, hashes, batch_size=5000):
+    """Reads new bouts with a result out of the ufcstats fighter documents whose hash is not in hashes, adding the
+    hashes read. Returns the bouts as lists"""
+    days, a, b, scores = [], [], [], []
+    projection = {'hash': 1, 'fights.fight_link': 1, 'fights.fight_outcome': 1, 'fights.fighters_involved': 1, 'fights.event_date': 1, 'fights.event_datetime': 1}
+    changed = [doc['_id'] for doc in db[UFCSTATS_FIGHTERS].find({}, {'hash': 1}, batch_size=batch_size) if document_key(doc) not in hashes]
+    changed.sort()
+    docs = (doc for i in range(0, len(changed), batch_size)
+            for doc in db[UFCSTATS_FIGHTERS].find({'_id': {'$in': changed[i:i + batch_size]}}, projection).sort('_id', 1))
+    for doc in docs:
+        hashes.add(document_key(doc))
+        for fight in doc.get('fights') or []:
+            outcome = (fight.get('fight_outcome') or '').lower()
+            fighters = fight.get('fighters_involved') or []
+            if outcome not in SCORES or len(fighters) != 2 or not fight.get('fight_link'):
+                continue
+            key = bout_key(fight['fight_link'])
+            day = fight_day(fight)
+            if key in seen or day is None:
+                continue
+            seen.add(key)
+            days.append(day)
+            a.append(nodes.add(fighters[0]))
+            b.append(nodes.add(fighters[1]))
+            scores.append(SCORES[outcome])
+    return days, a, b, scores
+
+
+class Elo:
+    name = 'elo'
+
+    def __init__(self, size=0, k=32.0, initial=1500.0):
+        self.k = k
+        self.initial = initial
+        self.rating = np.full(size, initial)
+
+    def grow(self, size):
+        if size > len(self.rating):
+            self.rating = np.concatenate([self.rating, np.full(size - len(self.rating), self.initial)])
+
+    def rate_period(self, a, b, scores, period):
+        expected = 1.0 / (1.0 + 10.0 ** ((self.rating[b] - self.rating[a]) / 400.0))
+        change = self.k * (scores - expected)
+        # add.at so a fighter with two fights in one period gets both changes
+        np.add.at(self.rating, a, change)
+        np.add.at(self.rating, b, -change)
+
+    def snapshot(self, fighters):
+        return {'elo': self.rating[fighters]}
+
+    def state(self):
+        return {'rating': self.rating}
+
+    def restore(self, state):
+        self.rating = state['rating'].copy()
+
+
+class Glicko2:
+    """Glicko-2 over the internal scale, with rating deviation growth for idle periods applied when a fighter next fights"""
+
+    name = 'glicko2'
+
+    def __init__(self, size=0, tau=0.5, initial_rd=350.0, initial_volatility=0.06):
+        self.tau = tau
+        self.max_phi = initial_rd / GLICKO_SCALE
+        self.initial_volatility = initial_volatility
+        self.mu = np.zeros(size)
+        self.phi = np.full(size, self.max_phi)
+        self.sigma = np.full(size, initial_volatility)
+        self.last_period = np.full(size, -1, dtype=np.int64)
+
+    def grow(self, size):
+        extra = size - len(self.mu)
+        if extra > 0:
+            self.mu = np.concatenate([self.mu, np.zeros(extra)])
+            self.phi = np.concatenate([self.phi, np.full(extra, self.max_phi)])
+            self.sigma = np.concatenate([self.sigma, np.full(extra, self.initial_volatility)])
+            self.last_period = np.concatenate([self.last_period, np.full(extra, -1, dtype=np.int64)])
+
+    @property
+    def rating(self):
+        return 1500.0 + GLICKO_SCALE * self.mu
+
+    @property
+    def deviation(self):
+        return GLICKO_SCALE * self.phi
+
+    def rate_period(self, a, b, scores, period):
+        players = np.concatenate([a, b])
+        opponents = np.concatenate([b, a])
+        results = np.concatenate([scores, 1.0 - scores])
+        fighters, local = np.unique(players, return_inverse=True)
+
+        # Deviation grows by one volatility step per idle period, capped at the starting deviation
+        idle = np.maximum(np.where(self.last_period[fighters] >= 0, period - self.last_period[fighters] - 1, 0), 0)
+        phi = np.minimum(np.sqrt(self.phi[fighters] ** 2 + idle * self.sigma[fighters] ** 2), self.max_phi)
+        self.phi[fighters] = phi
+
+        g = 1.0 / np.sqrt(1.0 + 3.0 * self.phi[opponents] ** 2 / math.pi ** 2)
+        expected = 1.0 / (1.0 + np.exp(-g * (self.mu[players] - self.mu[opponents])))
+        v = 1.0 / np.bincount(local, weights=g ** 2 * expected * (1.0 - expected), minlength=len(fighters))
+        total = np.bincount(local, weights=g * (results - expected), minlength=len(fighters))
+        delta = v * total
+
+        sigma = self.new_volatility(phi, self.sigma[fighters], v, delta)
+        phi_star = np.sqrt(phi ** 2 + sigma ** 2)
+        new_phi = 1.0 / np.sqrt(1.0 / phi_star ** 2 + 1.0 / v)
+        self.mu[fighters] += new_phi ** 2 * total
+        self.phi[fighters] = new_phi
+        self.sigma[fighters] = sigma
+        self.last_period[fighters] = period
+
+    def new_volatility(self, phi, sigma, v, delta, tolerance=1e-6, max_iterations=60):
+        """Step 5 of Glicko-2, the Illinois root finding run for every fighter of the period at once"""
+        alpha = np.log(sigma ** 2)
+        tau2 = self.tau ** 2
+
+        def f(x):
+            ex = np.exp(x)
+            return ex * (delta ** 2 - phi ** 2 - v - ex) / (2.0 * (phi ** 2 + v + ex) ** 2) - (x - alpha) / tau2
+
+        lower = alpha.copy()
+        big = delta ** 2 > phi ** 2 + v
+        upper = np.where(big, np.log(np.maximum(delta ** 2 - phi ** 2 - v, 1e-300)), alpha - self.tau)
+        # Where the bracket is not given directly, step down by tau until f turns positive
+        pending = ~big
+        for k in range(1, max_iterations):
+            if not pending.any():
+                break
+            candidate = alpha - k * self.tau
+            found = pending & (f(candidate) >= 0)
+            upper = np.where(found, candidate, upper)
+            pending &= ~found
+            upper = np.where(pending, candidate - self.tau, upper)
+        a, b = lower, upper
+        fa, fb = f(a), f(b)
+        # Converged fighters still go through the arithmetic, their results are just not used
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for _ in range(max_iterations):
+                active = np.abs(b - a) > tolerance
+                if not active.any():
+                    break
+                c = a + (a - b) * fa / (fb - fa)
+                fc = f(c)
+                move = fc * fb <= 0
+                a = np.where(active, np.where(move, b, a), a)
+                fa = np.where(active, np.where(move, fb, fa / 2.0), fa)
+                b = np.where(active, c, b)
+                fb = np.where(active, fc, fb)
+        return np.exp(a / 2.0)
+
+    def snapshot(self, fighters):
+        return {'glicko2': 1500.0 + GLICKO_SCALE * self.mu[fighters], 'glicko2_rd': GLICKO_SCALE * self.phi[fighters], 'glicko2_volatility': self.sigma[fighters]}
+
+    def state(self):
+        return {'mu': self.mu, 'phi': self.phi, 'sigma': self.sigma, 'last_period': self.last_period}
+
+    def restore(self, state):
+        self.mu, self.phi, self.sigma, self.last_period = (state[name].copy() for name in ('mu', 'phi', 'sigma', 'last_period'))
+
+
+class History:
+    """The ratings of every fighter after each period they fought in, as parallel arrays in the order periods were rated.
+    Rows are appended in chunks and only concatenated when read"""
+
+    def __init__(self, columns=None):
+        self.chunks = {name: [np.asarray(values)] for name, values in (columns or {}).items()}
+        self.index = None
+
+    def __len__(self):
+        return sum(map(len, self.chunks.get('period', ())))
+
+    def record(self, period, fighters, engines):
+        rows = {'period': np.full(len(fighters), period, dtype=np.int32), 'fighter': fighters.astype(np.int32)}
+        for engine in engines:
+            rows.update(engine.snapshot(fighters))
+        for name, values in rows.items():
+            self.chunks.setdefault(name, []).append(values)
+        self.index = None
+
+    def columns(self):
+        for name, chunks in self.chunks.items():
+            if len(chunks) > 1:
+                self.chunks[name] = [np.concatenate(chunks)]
+        return {name: chunks[0] for name, chunks in self.chunks.items()}
+
+    def of(self, fighter):
+        """A fighter's rows, oldest period first. The stable sort by fighter keeps each fighter's rows in period order"""
+        columns = self.columns()
+        if not columns:
+            return {'period': np.zeros(0, dtype=np.int32)}
+        if self.index is None:
+            order = np.argsort(columns['fighter'], kind='stable')
+            indptr = np.zeros(int(columns['fighter'].max(initial=-1)) + 2, dtype=np.int64)
+            np.cumsum(np.bincount(columns['fighter'], minlength=len(indptr) - 1), out=indptr[1:])
+            self.index = order, indptr
+        order, indptr = self.index
+        rows = order[indptr[fighter]:indptr[fighter + 1]] if fighter < len(indptr) - 1 else order[:0]
+        return {name: values[rows] for name, values in columns.items() if name != 'fighter'}
+
+
+def rate(table, engines, period_days=30, start=0, history=None):
+    """Rates fights from index start on, period by period, and returns the number of periods rated. The ratings of
+    the fighters of each period are recorded into history when given"""
+    if start >= len(table):
+        return 0
+    for engine in engines:
+        engine.grow(len(table.nodes))
+    periods = table.days // period_days
+    bounds = np.flatnonzero(np.diff(periods[start:])) + start + 1
+    edges = np.concatenate([[start], bounds, [len(table)]])
+    for begin, end in zip(edges[:-1], edges[1:]):
+        period = int(periods[begin])
+        for engine in engines:
+            engine.rate_period(table.a[begin:end], table.b[begin:end], table.scores[begin:end], period)
+        if history is not None:
+            history.record(period, np.unique(np.concatenate([table.a[begin:end], table.b[begin:end]])), engines)
+    return len(edges) - 1
+
+
+class RatingStore:
+    """Saved ratings with the fight table they were computed from, so later builds only rate what is new"""
+
+    def __init__(self, directory, period_days=30):
+        self.directory = directory
+        self.period_days = period_days
+        self.table = FightTable()
+        self.engines = [Elo(), Glicko2()]
+        self.history = History()
+        self.seen = set()
+        self.hashes = set()
+        self.rated = 0
+
+    def load(self):
+        path = os.path.join(self.directory, 'ratings.npz')
+        if not os.path.exists(path):
+            return self
+        with open(os.path.join(self.directory, 'ratings.json')) as f:
+            meta = json.load(f)
+        data = np.load(path)
+        self.period_days, self.rated = meta['period_days'], meta['rated']
+        self.table = FightTable(FighterIndex(meta['links']), data['days'], data['a'], data['b'], data['scores'])
+        self.seen = set(data['seen'].tolist())
+        self.hashes = set(data['hashes'].tolist())
+        self.history = History({key.split('/', 1)[1]: value for key, value in data.items() if key.startswith('history/')})
+        for engine in self.engines:
+            engine.restore({key.split('/', 1)[1]: value for key, value in data.items() if key.startswith(engine.name + '/')})
+        return self
+
+    def update(self, db, full=False):
+        """Streams new fights and rates them, returns (new fights, periods rated)"""
+        if full:
+            self.__init__(self.directory, self.period_days)
+        days, a, b, scores = stream_fights(db, self.table.nodes, self.seen, self.hashes)
+        last_period = self.table.days[self.rated - 1] // self.period_days if self.rated else None
+        if days:
+            self.table.extend(days, a, b, scores)
+            if last_period is not None and min(days) // self.period_days <= last_period:
+                # A fight landed in a period that was already rated, so everything after it has to be redone
+                self.rated = 0
+        if self.rated == len(self.table):
+            return len(days), 0
+        if not self.rated:
+            self.engines, self.history = [Elo(), Glicko2()], History()
+        periods = rate(self.table, self.engines, self.period_days, self.rated, self.history)
+        self.rated = len(self.table)
+        return len(days), periods
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {'days': self.table.days, 'a': self.table.a, 'b': self.table.b, 'scores': self.table.scores,
+                  'seen': np.array(sorted(self.seen), dtype=np.uint64), 'hashes': np.array(sorted(self.hashes), dtype=np.uint64)}
+        arrays.update({f'history/{name}': values for name, values in self.history.columns().items()})
+        for engine in self.engines:
+            arrays.update({f'{engine.name}/{key}': value for key, value in engine.state().items()})
+        with open(os.path.join(self.directory, 'ratings.npz.tmp'), 'wb') as f:
+            np.savez(f, **arrays)
+        with open(os.path.join(self.directory, 'ratings.json.tmp'), 'w') as f:
+            json.dump({'links': self.table.nodes.links, 'period_days': self.period_days, 'rated': self.rated}, f)
+        for name in ('ratings.npz', 'ratings.json'):
+            os.replace(os.path.join(self.directory, name + '.tmp'), os.path.join(self.directory, name))
+
+    def top(self, system='glicko2', limit=25):
+        engine = next(engine for engine in self.engines if engine.name == system)
+        order = np.argsort(-engine.rating)[:limit]
+        return [(self.table.nodes.links[i], float(engine.rating[i])) for i in order]
+
+    def history_of(self, link):
+        """A fighter's ratings after each period they fought in, as a list of dicts starting with the period's first day"""
+        fighter = self.table.nodes.get(link)
+        if fighter is None:
+            return []
+        rows = self.history.of(fighter)
+        names = [name for name in rows if name != 'period']
+        return [{'date': EPOCH + timedelta(days=int(period) * self.period_days), **{name: float(rows[name][i]) for name in names}}
+                for i, period in enumerate(rows['period'])]
+
+    def ratings_at(self, link, day):
+        """A fighter's ratings after the last period they fought in up to the one holding day (days since 1970), None
+        before their first. The Glicko-2 deviation grows for the periods sat out since, as their next rating would"""
+        history = self.history_of(link)
+        period = day // self.period_days
+        history = [row for row in history if (row['date'] - EPOCH).days // self.period_days <= period]
+        if not history:
+            return None
+        ratings = dict(history[-1])
+        idle = period - (ratings['date'] - EPOCH).days // self.period_days - 1
+        if idle > 0:
+            glicko = next(engine for engine in self.engines if engine.name == 'glicko2')
+            phi = math.sqrt((ratings['glicko2_rd'] / GLICKO_SCALE) ** 2 + idle * ratings['glicko2_volatility'] ** 2)
+            ratings['glicko2_rd'] = min(phi, glicko.max_phi) * GLICKO_SCALE
+        return ratings
+
+
+def synthetic_table(fights, fighters, days=11000, seed=7):
+    """Random fight history with hidden skill, for benchmarking"""
+    rng = np.random.default_rng(seed)
+    skill = rng.normal(0, 1, fighters)
+    a = rng.integers(0, fighters, fights)
+    b = (a + rng.integers(1, fighters, fights)) % fighters
+    scores = (rng.random(fights) < 1 / (1 + np.exp(skill[b] - skill[a]))).astype(np.float64)
+    nodes = FighterIndex(str(i) for i in range(fighters))
+    return FightTable(nodes, rng.integers(0, days, fights), a, b, scores)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute fighter ratings over the fight history')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Rate new fights from MongoDB')
+    build.add_argument('directory')
+    build.add_argument('--period-days', type=int, default=30)
+    build.add_argument('--full', action='store_true', help='Rerun every fight from scratch')
+    top = commands.add_parser('top', help='Highest rated fighters')
+    top.add_argument('directory')
+    top.add_argument('--system', choices=['elo', 'glicko2'], default='glicko2')
+    top.add_argument('--limit', type=int, default=25)
+    history = commands.add_parser('history', help="A fighter's ratings after each period they fought in")
+    history.add_argument('directory')
+    history.add_argument('fighter')
+    history.add_argument('--date', default=None, help='Only the ratings in force on this day, as YYYY-MM-DD')
+    benchmark = commands.add_parser('bench', help='Time a full recompute over a synthetic history')
+    benchmark.add_argument('--fights', type=int, default=850000)
+    benchmark.add_argument('--fighters', type=int, default=300000)
+    benchmark.add_argument('--period-days', type=int, default=30)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        store = RatingStore(args.directory, args.period_days).load()
+        started = time.time()
+        fights, periods = store.update(get_db(), args.full)
+        store.save()
+        print(f"Rated {fights} new fights over {periods} periods in {time.time() - started:.1f}s, {len(store.table)} fights in total")
+    elif args.command == 'top':
+        store = RatingStore(args.directory).load()
+        for link, rating in store.top(args.system, args.limit):
+            print(f"{rating:8.1f}  {link}")
+    elif args.command == 'history':
+        store = RatingStore(args.directory).load()
+        if args.date:
+            ratings = store.ratings_at(args.fighter, (datetime.strptime(args.date, '%Y-%m-%d') - EPOCH).days)
+            rows = [ratings] if ratings else []
+        else:
+            rows = store.history_of(args.fighter)
+        for row in rows:
+            print(f"{row['date']:%Y-%m-%d}  elo {row['elo']:7.1f}  glicko2 {row['glicko2']:7.1f}  rd {row['glicko2_rd']:6.1f}  volatility {row['glicko2_volatility']:.4f}")
+    else:
+        table = synthetic_table(args.fights, args.fighters)
+        engines = [Elo(), Glicko2()]
+        started = time.time()
+        periods = rate(table, engines, args.period_days, history=History())
+        print(f"Rated {len(table)} fights between {args.fighters} fighters over {periods} periods in {time.time() - started:.2f}s")
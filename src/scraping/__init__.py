@@ -0,0 +1,3 @@
+"""Modules shared by the Tapology and ufcstats Scrapy projects, so the two cannot drift apart.
+
+Each project's package puts src on sys.path when it is imported, since Scrapy only adds the project directory."""
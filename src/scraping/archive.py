@@ -0,0 +1,126 @@
+import glob, gzip, json, os, time, zlib
+import scrapy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+
+
+def serialize_meta(meta):
+    """Keeps the parts of request.meta that can be written to the archive, items included"""
+    serialized = {}
+    for key, value in meta.items():
+        if isinstance(value, scrapy.Item):
+            serialized[key] = {'__item__': type(value).__name__, 'fields': dict(value)}
+            continue
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        serialized[key] = value
+    return serialized
+
+
+def deserialize_meta(meta, items_module):
+    restored = {}
+    for key, value in meta.items():
+        if isinstance(value, dict) and '__item__' in value:
+            value = getattr(items_module, value['__item__'])(**value['fields'])
+        restored[key] = value
+    return restored
+
+
+class ArchiveWriter:
+    """Appends raw pages to gzip segment files, one gzip member per record like a WARC file"""
+
+    def __init__(self, directory, prefix, segment_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.segment = 0
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self):
+        if self.file:
+            self.file.close()
+        self.segment += 1
+        path = os.path.join(self.directory, f"{self.prefix}-{time.strftime('%Y%m%d%H%M%S')}-{self.segment:05d}.warc.gz")
+        self.file = open(path, 'ab')
+
+    def write(self, request, response, callback):
+        if self.file is None or self.file.tell() >= self.segment_size:
+            self._open_segment()
+        header = {
+            'url': response.url,
+            'request_url': request.url,
+            'status': response.status,
+            'headers': {k.decode('latin1'): [v.decode('latin1') for v in values] for k, values in response.headers.items()},
+            'callback': callback,
+            'meta': serialize_meta(request.meta),
+            'fetched_at': time.time(),
+            'length': len(response.body)
+        }
+        record = json.dumps(header).encode() + b'\n' + response.body
+        self.file.write(gzip.compress(record, 6))
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def segment_paths(directory, prefix=None):
+    return sorted(glob.glob(os.path.join(directory, f"{prefix or '*'}-*.warc.gz")))
+
+
+def _parse_record(data):
+    header_end = data.index(b'\n')
+    header = json.loads(data[:header_end])
+    return header, data[header_end + 1:header_end + 1 + header['length']]
+
+
+def iter_records(path, chunk_size=1024 * 1024):
+    """Yields (offset, header, body) for every record in a segment"""
+    with open(path, 'rb') as f:
+        pending = b''
+        offset = 0
+        while True:
+            if not pending:
+                pending = f.read(chunk_size)
+                if not pending:
+                    return
+            decompressor = zlib.decompressobj(wbits=31)
+            parts = []
+            consumed = 0
+            while not decompressor.eof:
+                parts.append(decompressor.decompress(pending))
+                if decompressor.eof:
+                    break
+                consumed += len(pending)
+                pending = f.read(chunk_size)
+                if not pending:
+                    return
+            consumed += len(pending) - len(decompressor.unused_data)
+            header, body = _parse_record(b''.join(parts))
+            yield offset, header, body
+            offset += consumed
+            pending = decompressor.unused_data
+
+
+def read_record(path, offset):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        decompressor = zlib.decompressobj(wbits=31)
+        parts = []
+        while not decompressor.eof:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            parts.append(decompressor.decompress(chunk))
+        return _parse_record(b''.join(parts))
+
+
+def build_response(header, body, request):
+    headers = Headers(header['headers'])
+    respcls = responsetypes.from_args(headers=headers, url=header['url'], body=body)
+    return respcls(url=header['url'], status=header['status'], headers=headers, body=body, request=request, flags=['archived'])
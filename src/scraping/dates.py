@@ -0,0 +1,26 @@
+import re
+from datetime import datetime
+
+DOTTED_DATE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})')
+WORDED_DATE = re.compile(r'([A-Za-z]{3,9})\.? (\d{1,2}),? (\d{4})')
+
+
+def parse_event_date(value):
+    """Parses an event date as either site shows it, e.g. 'Saturday 10.19.2024', 'October 19, 2024' or 'Oct. 19, 2024'"""
+    if not value or not isinstance(value, str):
+        return None
+    match = DOTTED_DATE.search(value)
+    if match:
+        month, day, year = (int(part) for part in match.groups())
+        try:
+            return datetime(year, month, day)
+        except ValueError:
+            return None
+    match = WORDED_DATE.search(value)
+    if match:
+        for fmt in ('%B %d %Y', '%b %d %Y'):
+            try:
+                return datetime.strptime(' '.join(match.groups()), fmt)
+            except ValueError:
+                continue
+    return None
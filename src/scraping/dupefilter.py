@@ -0,0 +1,177 @@
+import hashlib, heapq, logging, mmap, os, shutil, tempfile
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.utils.job import job_dir
+
+FINGERPRINT_SIZE = 20
+
+
+class SortedRun:
+    """A file of sorted fixed width fingerprints, memory mapped and binary searched"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else None
+
+    @classmethod
+    def write(cls, path, fingerprints):
+        with open(path, 'wb') as f:
+            f.writelines(fingerprints)
+        return cls(path)
+
+    def __len__(self):
+        return len(self.map) // FINGERPRINT_SIZE if self.map is not None else 0
+
+    def __contains__(self, fingerprint):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self.map[mid * FINGERPRINT_SIZE:(mid + 1) * FINGERPRINT_SIZE]
+            if value < fingerprint:
+                lo = mid + 1
+            elif value > fingerprint:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __iter__(self):
+        for i in range(0, len(self) * FINGERPRINT_SIZE, FINGERPRINT_SIZE):
+            yield self.map[i:i + FINGERPRINT_SIZE]
+
+    def close(self, remove=False):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+
+class CompactDupeFilter(BaseDupeFilter):
+    """Request dupefilter that keeps seen fingerprints as fixed width binary instead of a text file loaded into a set.
+
+    Fingerprints from earlier runs live in a sorted file that is memory mapped and binary searched, so resuming
+    costs neither a full read nor a Python object per entry. New fingerprints go to an append log and an in-memory
+    set. Once the set holds DUPEFILTER_SPILL_SIZE fingerprints it is written out as another sorted run, and runs are
+    merged once there are DUPEFILTER_MAX_RUNS of them, so memory stays bounded however long the crawl. Everything
+    is merged into the sorted file when the spider closes. An existing requests.seen text file in the JOBDIR is
+    converted on first use. Without a JOBDIR the runs go to a temporary directory removed on close.
+
+    Enabled with DUPEFILTER_CLASS = 'scraping.dupefilter.CompactDupeFilter'."""
+
+    def __init__(self, path=None, debug=False, fingerprinter=None, spill_size=100000, max_runs=8):
+        self.path = path
+        self.debug = debug
+        self.fingerprinter = fingerprinter
+        self.spill_size = spill_size
+        self.max_runs = max_runs
+        self.logdupes = True
+        self.logger = logging.getLogger(__name__)
+        self.new = set()
+        self.runs = []
+        self.spilled = 0
+        self.sorted_run = self.log_file = None
+        if path:
+            self.run_dir = path
+            self.sorted_path = os.path.join(path, 'requests.seen.bin')
+            self.log_path = os.path.join(path, 'requests.seen.log')
+            self._open()
+        else:
+            self.run_dir = tempfile.mkdtemp(prefix='dupefilter-')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(job_dir(settings), settings.getbool('DUPEFILTER_DEBUG'), crawler.request_fingerprinter,
+                   settings.getint('DUPEFILTER_SPILL_SIZE', 100000), settings.getint('DUPEFILTER_MAX_RUNS', 8))
+
+    def _open(self):
+        text_path = os.path.join(self.path, 'requests.seen')
+        if not os.path.exists(self.sorted_path):
+            fingerprints = set()
+            if os.path.exists(text_path):
+                with open(text_path) as f:
+                    fingerprints = {self._compact(bytes.fromhex(line.strip())) for line in f if line.strip()}
+                self.logger.info(f"Converted {len(fingerprints)} fingerprints from {text_path}")
+            with open(self.sorted_path, 'wb') as f:
+                f.writelines(sorted(fingerprints))
+        self.sorted_run = SortedRun(self.sorted_path)
+
+        # Runs left by a crash are rebuilt from the log, which holds every fingerprint they did
+        for name in os.listdir(self.path):
+            if name.startswith('requests.seen.run-'):
+                os.remove(os.path.join(self.path, name))
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                while True:
+                    data = f.read(FINGERPRINT_SIZE * 65536)
+                    # A torn write from a crash leaves a partial record at the end
+                    usable = len(data) - len(data) % FINGERPRINT_SIZE
+                    self.new.update(data[i:i + FINGERPRINT_SIZE] for i in range(0, usable, FINGERPRINT_SIZE))
+                    if len(self.new) >= self.spill_size:
+                        self._spill()
+                    if len(data) < FINGERPRINT_SIZE * 65536:
+                        break
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(os.path.getsize(self.log_path) // FINGERPRINT_SIZE * FINGERPRINT_SIZE)
+        self.log_file = open(self.log_path, 'ab')
+
+    @staticmethod
+    def _compact(fingerprint):
+        if len(fingerprint) != FINGERPRINT_SIZE:
+            return hashlib.sha1(fingerprint).digest()
+        return fingerprint
+
+    def _spill(self):
+        """Writes the in-memory fingerprints out as a sorted run, merging the runs once there are too many"""
+        self.spilled += 1
+        path = os.path.join(self.run_dir, f'requests.seen.run-{self.spilled:05d}.bin')
+        self.runs.append(SortedRun.write(path, sorted(self.new)))
+        self.new = set()
+        if len(self.runs) >= self.max_runs:
+            self.spilled += 1
+            path = os.path.join(self.run_dir, f'requests.seen.run-{self.spilled:05d}.bin')
+            merged = SortedRun.write(path, heapq.merge(*self.runs))
+            for run in self.runs:
+                run.close(remove=True)
+            self.runs = [merged]
+
+    def request_seen(self, request):
+        fingerprint = self._compact(self.fingerprinter.fingerprint(request))
+        if fingerprint in self.new or any(fingerprint in run for run in self.runs) or (self.sorted_run is not None and fingerprint in self.sorted_run):
+            return True
+        self.new.add(fingerprint)
+        if self.log_file:
+            self.log_file.write(fingerprint)
+        if len(self.new) >= self.spill_size:
+            self._spill()
+        return False
+
+    def close(self, reason):
+        if not self.path:
+            for run in self.runs:
+                run.close(remove=True)
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            return
+        self.log_file.close()
+        if self.new or self.runs:
+            merged_path = self.sorted_path + '.tmp'
+            with open(merged_path, 'wb') as f:
+                f.writelines(heapq.merge(self.sorted_run, *self.runs, sorted(self.new)))
+            self.sorted_run.close()
+            for run in self.runs:
+                run.close(remove=True)
+            os.replace(merged_path, self.sorted_path)
+            # The log is only emptied once its entries are safely in the sorted file
+            open(self.log_path, 'wb').close()
+        else:
+            self.sorted_run.close()
+
+    def log(self, request, spider):
+        if self.debug:
+            self.logger.debug("Filtered duplicate request: %(request)s", {'request': request}, extra={'spider': spider})
+        elif self.logdupes:
+            self.logger.debug("Filtered duplicate request: %(request)s - no more duplicates will be shown"
+                              " (see DUPEFILTER_DEBUG to show all duplicates)", {'request': request}, extra={'spider': spider})
+            self.logdupes = False
+        spider.crawler.stats.inc_value('dupefilter/filtered')
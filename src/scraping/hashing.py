@@ -0,0 +1,61 @@
+"""Canonical content hashing for scraped items.
+
+Items are encoded as compact JSON with dict keys sorted at every level and list order kept, so the same content
+always gives the same hash whatever order its fields or nested keys were filled in. The whole item goes through
+one call to the C JSON encoder rather than a string built up in Python. Hashes look like 'h2-blake2b:<hex>';
+the prefix carries the schema version and digest so stored hashes from another scheme are recognised instead
+of silently never matching."""
+import hashlib, json
+from datetime import date, datetime
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_VERSION = 'h2'
+DIGEST_SIZE = 16
+EXCLUDED_FIELDS = ('_id', 'hash')
+
+
+def new_digest(algorithm='blake2b'):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=DIGEST_SIZE)
+    if algorithm == 'xxh3':
+        if xxhash is None:
+            raise ImportError("The xxh3 content hash needs the xxhash package")
+        return xxhash.xxh3_128()
+    raise ValueError(f"Unknown content hash algorithm: {algorithm}")
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return {'$date': value.isoformat()}
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, bytes):
+        return {'$bytes': value.hex()}
+    if hasattr(value, 'items'):
+        return dict(value.items())
+    return str(value)
+
+
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=_default)
+
+
+def content_hash(fields, algorithm='blake2b', skip_lists=False, exclude=()):
+    """Versioned hash of an item's fields, leaving out _id, hash, the exclude fields and with skip_lists any list field"""
+    digest = new_digest(algorithm)
+    canonical = {key: value for key, value in fields.items()
+                 if key not in EXCLUDED_FIELDS and key not in exclude and not (skip_lists and isinstance(value, list))}
+    digest.update(_encoder.encode(canonical).encode())
+    return f"{HASH_VERSION}-{algorithm}:{digest.hexdigest()}"
+
+
+def is_current(item_hash, algorithm='blake2b'):
+    return isinstance(item_hash, str) and item_hash.startswith(f"{HASH_VERSION}-{algorithm}:")
+
+
+def digest_bytes(item_hash):
+    """The raw digest of a hash, for versioned hashes and older bare hex ones alike"""
+    return bytes.fromhex(item_hash.rpartition(':')[2])
@@ -0,0 +1,71 @@
+import gzip, json, os, re, time
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+
+
+class LocalCacheStorage:
+    """Stores response bodies gzip compressed on local disk, keyed by request fingerprint"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _paths(self, spider, fingerprint):
+        directory = os.path.join(self.cache_dir, spider.name, fingerprint[:2])
+        return os.path.join(directory, f'{fingerprint}.json'), os.path.join(directory, f'{fingerprint}.gz')
+
+    def load(self, spider, fingerprint):
+        meta_path, body_path = self._paths(spider, fingerprint)
+        if not os.path.exists(meta_path) or not os.path.exists(body_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def body(self, spider, fingerprint):
+        with open(self._paths(spider, fingerprint)[1], 'rb') as f:
+            return gzip.decompress(f.read())
+
+    def store(self, spider, fingerprint, response):
+        meta_path, body_path = self._paths(spider, fingerprint)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        meta = {
+            'url': response.url,
+            'status': response.status,
+            'headers': {k.decode('latin1'): [v.decode('latin1') for v in values] for k, values in response.headers.items()},
+            'stored_at': time.time()
+        }
+        # Body first so a half written entry never has metadata pointing at a missing body
+        with open(body_path, 'wb') as f:
+            f.write(gzip.compress(response.body, 6))
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def touch(self, spider, fingerprint, meta):
+        meta['stored_at'] = time.time()
+        with open(self._paths(spider, fingerprint)[0], 'w') as f:
+            json.dump(meta, f)
+
+    def response(self, spider, fingerprint, meta, request):
+        body = self.body(spider, fingerprint)
+        headers = Headers(meta['headers'])
+        respcls = responsetypes.from_args(headers=headers, url=meta['url'], body=body)
+        return respcls(url=meta['url'], headers=headers, status=meta['status'], body=body, request=request, flags=['cached'])
+
+
+class TTLPolicy:
+    """Works out how long a cached page stays fresh: URL patterns first, then the spider, then the default.
+    A negative TTL never expires and zero always revalidates."""
+
+    def __init__(self, default_ttl, spider_ttls=None, url_ttls=None):
+        self.default_ttl = default_ttl
+        self.spider_ttls = spider_ttls or {}
+        self.url_ttls = [(re.compile(pattern), ttl) for pattern, ttl in (url_ttls or [])]
+
+    def ttl(self, spider, url):
+        for pattern, ttl in self.url_ttls:
+            if pattern.search(url):
+                return ttl
+        return self.spider_ttls.get(spider.name, self.default_ttl)
+
+    def is_fresh(self, spider, url, meta):
+        ttl = self.ttl(spider, url)
+        return ttl < 0 or time.time() - meta['stored_at'] < ttl
@@ -0,0 +1,235 @@
+"""Bulk loads scraped items from JSON Lines into MongoDB without running a crawl.
+
+    python -m tapology_scraper.loader <file or dir> [...] [--item TapologyEventItem] [--mode upsert] [--writers 8]
+    python -m tapology_scraper.loader --archive <dir> --spider events
+    python -m ufcstats_scraper.loader <file or dir> [...] [--item UfcStatsFighterItem] [--mode upsert] [--writers 8]
+
+Files are matched to a collection by name: replay output (TapologyEventItem.jsonl), the pipeline's
+failed batch dumps (scrapy_tapology_events.failed.jsonl), or --item for a plain feed export. With --archive
+the archived pages are replayed first and their items loaded. Items get the pipeline's typed fields, are
+hashed like the pipeline does and skipped when the hash is already stored, then written in large unordered
+batches by parallel writers. A batch that still fails after --max-retries attempts, and documents the server
+rejects, are saved to <collection>.failed.jsonl in --failed-dir so they can be loaded again. Each project's
+loader module runs this one with its Mongo pipeline class, whose package supplies the collections,
+normalizers and item hash."""
+import argparse, json, logging, os, tempfile, threading, time
+from importlib import import_module
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from scrapy.utils.project import data_path
+from scraping.mongo import DedupIndex, bump_cache_version
+
+loader_logger = logging.getLogger('loader')
+
+
+class Loader:
+    """Streams documents into MongoDB through a pool of writer threads sharing one client"""
+
+    def __init__(self, db, pipeline_class, mode='insert', batch_size=5000, writers=8, skip_stored=True, report_every=5.0, max_retries=3, retry_delay=1.0, failed_dir='.'):
+        self.pipelines = import_module(pipeline_class.__module__)
+        self.normalizers = import_module(f"{pipeline_class.__module__.rsplit('.', 1)[0]}.normalize").NORMALIZERS
+        pipeline = pipeline_class()
+        self.collections = {item.__name__: collection for item, collection in pipeline.collections.items()}
+        self.natural_keys = pipeline.natural_keys
+        self.db = db
+        self.mode = mode
+        self.batch_size = batch_size
+        self.writers = writers
+        self.skip_stored = skip_stored
+        self.report_every = report_every
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.failed_dir = failed_dir
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.counts = {'read': 0, 'duplicates': 0, 'written': 0, 'already_stored': 0, 'failed': 0}
+
+    def collection_for(self, path, item=None):
+        if item:
+            return self.collections[item]
+        name = os.path.basename(path).split('.')[0]
+        if name in self.collections:
+            return self.collections[name]
+        if name in self.natural_keys:
+            return name
+        return None
+
+    def index_for(self, collection):
+        if collection not in self.indexes:
+            index = DedupIndex(self.natural_keys[collection], self.pipelines.item_hash)
+            if self.skip_stored:
+                index.load(self.db[collection])
+                loader_logger.info(f"Loaded {len(index.hashes)} stored hashes for {collection}")
+            self.indexes[collection] = index
+        return self.indexes[collection]
+
+    def iter_docs(self, path, collection):
+        index = self.index_for(collection)
+        normalizer = self.normalizers.get(collection)
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                doc = json.loads(line)
+                # Failed batch dumps carry the ObjectId as a string, let Mongo assign a fresh one
+                doc.pop('_id', None)
+                doc.pop('hash', None)
+                if normalizer:
+                    normalizer(doc)
+                self.pipelines.fill_missing(doc)
+                doc['hash'] = self.pipelines.item_hash(doc)
+                self.counts['read'] += 1
+                if index.has_hash(doc['hash']):
+                    self.counts['duplicates'] += 1
+                    continue
+                index.add(doc['hash'], doc.get(index.key_field))
+                yield doc
+
+    def write(self, collection, docs):
+        """Writes a batch, retrying errors that are not about individual documents with exponential backoff"""
+        keyless = []
+        if self.mode == 'upsert':
+            key_field = self.natural_keys[collection]
+            # Without a natural key there is nothing to upsert on, those are saved as failed instead
+            sent = [doc for doc in docs if doc.get(key_field) not in (None, 'N/A')]
+            keyless = [doc for doc in docs if doc.get(key_field) in (None, 'N/A')]
+        else:
+            sent = docs
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                if self.mode == 'upsert':
+                    if sent:
+                        self.db[collection].bulk_write([UpdateOne({key_field: doc[key_field]}, {'$set': doc}, upsert=True) for doc in sent], ordered=False)
+                else:
+                    self.db[collection].insert_many(sent, ordered=False)
+                written, stored, failed = len(sent), 0, 0
+                break
+            except BulkWriteError as e:
+                # Error indexes point into the documents sent, not the whole batch
+                errors = e.details.get('writeErrors', [])
+                rejected = [error for error in errors if error.get('code') != 11000]
+                stored = len(errors) - len(rejected)
+                failed = len(rejected)
+                written = len(sent) - len(errors)
+                if rejected:
+                    loader_logger.error(f"Bulk write errors for {collection}: {rejected[:5]}")
+                    self.save_failed(collection, [sent[error['index']] for error in rejected if error.get('index') is not None])
+                break
+            except PyMongoError as e:
+                # Out of attempts the error carries on to settle(), which saves the batch
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                loader_logger.warning(f"Write attempt {attempt} of {len(sent)} documents into {collection} failed: {e}. Retrying in {delay}s")
+                time.sleep(delay)
+        if keyless:
+            self.save_failed(collection, keyless)
+            failed += len(keyless)
+        if written:
+            bump_cache_version(self.db, collection, loader_logger)
+        with self.lock:
+            self.counts['written'] += written
+            self.counts['already_stored'] += stored
+            self.counts['failed'] += failed
+
+    def save_failed(self, collection, docs):
+        if not docs:
+            return
+        failed_file = os.path.join(self.failed_dir, f'{collection}.failed.jsonl')
+        with self.lock, open(failed_file, 'a') as f:
+            for doc in docs:
+                f.write(json.dumps({k: v for k, v in doc.items() if k != '_id'}, default=str) + '\n')
+        loader_logger.error(f"Saved {len(docs)} documents that could not be written into {collection} to {failed_file}")
+
+    def settle(self, futures, batches):
+        """Collects finished writes. A batch whose write raised is counted as failed and saved, not lost"""
+        for future in futures:
+            collection, docs = batches.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                loader_logger.error(f"Gave up writing {len(docs)} documents into {collection}: {e!r}")
+                self.save_failed(collection, docs)
+                with self.lock:
+                    self.counts['failed'] += len(docs)
+
+    def load(self, sources):
+        """Loads (path, collection) pairs, keeping at most two batches per writer in memory"""
+        started = last_report = time.time()
+        with ThreadPoolExecutor(max_workers=self.writers, thread_name_prefix='loader') as pool:
+            batches = {}
+            for path, collection in sources:
+                loader_logger.info(f"Loading {path} into {collection}")
+                batch = []
+                for doc in self.iter_docs(path, collection):
+                    batch.append(doc)
+                    if len(batch) >= self.batch_size:
+                        if len(batches) >= self.writers * 2:
+                            done, _ = wait(batches, return_when=FIRST_COMPLETED)
+                            self.settle(done, batches)
+                        batches[pool.submit(self.write, collection, batch)] = (collection, batch)
+                        batch = []
+                    if time.time() - last_report >= self.report_every:
+                        last_report = time.time()
+                        self.report(started)
+                if batch:
+                    batches[pool.submit(self.write, collection, batch)] = (collection, batch)
+            self.settle(list(batches), batches)
+        self.report(started)
+        return self.counts
+
+    def report(self, started):
+        elapsed = max(time.time() - started, 1e-9)
+        loader_logger.info(f"Read {self.counts['read']}, wrote {self.counts['written']} ({self.counts['written'] / elapsed:.0f} docs/s), "
+                           f"{self.counts['duplicates']} duplicates, {self.counts['already_stored']} already stored, {self.counts['failed']} failed")
+
+
+def find_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.jsonl'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def main(pipeline_class):
+    project = pipeline_class.__module__.split('.')[0]
+    pipelines = import_module(pipeline_class.__module__)
+    parser = argparse.ArgumentParser(description='Bulk load JSON Lines items into MongoDB')
+    parser.add_argument('paths', nargs='*', help='JSON Lines files or directories of them')
+    parser.add_argument('--item', default=None, help='Item class for every file, for feed exports not named after one')
+    parser.add_argument('--archive', default=None, help='Replay this page archive and load the items it yields')
+    parser.add_argument('--spider', default=None, help='Spider whose archived pages to replay')
+    parser.add_argument('--mode', choices=['insert', 'upsert'], default='insert')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--writers', type=int, default=8, help='Parallel writer threads')
+    parser.add_argument('--max-retries', type=int, default=3, help='Attempts per batch before it is saved as failed')
+    parser.add_argument('--failed-dir', default='.', help='Where batches that could not be written are saved')
+    parser.add_argument('--no-skip-stored', action='store_true', help='Do not load stored hashes to skip items already in the database')
+    parser.add_argument('--mongo-uri', default=pipelines.MONGO_URI)
+    parser.add_argument('--mongo-db', default=pipelines.MONGO_DATABASE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    paths = list(args.paths)
+    if args.archive or args.spider:
+        from scraping.replay import replay
+        replay_dir = tempfile.mkdtemp(prefix='replay_items_')
+        replay(project, args.spider, args.archive or data_path('page_archive'), replay_dir)
+        paths.append(replay_dir)
+
+    client = MongoClient(args.mongo_uri, maxPoolSize=args.writers + 2)
+    loader = Loader(client[args.mongo_db], pipeline_class, args.mode, args.batch_size, args.writers, not args.no_skip_stored,
+                    max_retries=args.max_retries, failed_dir=args.failed_dir)
+    sources = []
+    for path in find_files(paths):
+        collection = loader.collection_for(path, args.item)
+        if collection is None:
+            loader_logger.warning(f"Skipping {path}, it does not match an item type, pass --item to load it")
+            continue
+        sources.append((path, collection))
+    loader.load(sources)
+    client.close()
@@ -0,0 +1,152 @@
+"""Mongo plumbing shared by both projects' pipelines and the loader."""
+import json, os, queue, threading, time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from twisted.internet import defer
+from scraping.hashing import is_current, digest_bytes
+
+# Read by the query API, which drops its cached reads of a collection when its count moves
+CACHE_VERSIONS = 'cache_versions'
+
+
+def bump_cache_version(db, collection, logger):
+    """Counts a write to the collection, the query API drops its cached reads of it when the count changes"""
+    try:
+        db[CACHE_VERSIONS].update_one({'_id': collection}, {'$inc': {'version': 1}}, upsert=True)
+    except PyMongoError as e:
+        logger.warning(f"Could not bump the cache version of {collection}: {e}")
+
+
+class DedupIndex:
+    """In-memory index of the hashes and natural keys already stored in a collection"""
+
+    def __init__(self, key_field, item_hash):
+        self.key_field = key_field
+        # The project's item hash, which stored documents under an older scheme are rehashed with
+        self.item_hash = item_hash
+        self.hashes = set()
+        self.keys = set()
+        self.upgraded = 0
+
+    @staticmethod
+    def _compact(item_hash):
+        # 128 bits of the digest is plenty to tell items apart and halves the memory per entry
+        try:
+            return digest_bytes(item_hash)[:16]
+        except ValueError:
+            return item_hash.encode()
+
+    def load(self, collection, algorithm='blake2b'):
+        projection = {'_id': 1, 'hash': 1, self.key_field: 1}
+        stale = []
+        for doc in collection.find({}, projection, batch_size=10000):
+            if doc.get('hash') and not is_current(doc['hash'], algorithm):
+                stale.append(doc['_id'])
+                continue
+            self.add(doc.get('hash'), doc.get(self.key_field))
+        self.upgraded = self.upgrade(collection, stale, algorithm)
+        return self
+
+    def upgrade(self, collection, ids, algorithm, batch_size=1000):
+        """Rehashes documents stored under an older hash scheme and writes the new hash back, once"""
+        for i in range(0, len(ids), batch_size):
+            operations = []
+            for doc in collection.find({'_id': {'$in': ids[i:i + batch_size]}}):
+                doc['hash'] = self.item_hash(doc, algorithm)
+                self.add(doc['hash'], doc.get(self.key_field))
+                operations.append(UpdateOne({'_id': doc['_id']}, {'$set': {'hash': doc['hash']}}))
+            if operations:
+                collection.bulk_write(operations, ordered=False)
+        return len(ids)
+
+    def add(self, item_hash, key=None):
+        if item_hash:
+            self.hashes.add(self._compact(item_hash))
+        if key:
+            self.keys.add(key)
+
+    def has_hash(self, item_hash):
+        return self._compact(item_hash) in self.hashes
+
+    def has_key(self, key):
+        return key in self.keys
+
+
+class MongoWriter(threading.Thread):
+    """Background thread that writes batches to MongoDB in the order they were submitted.
+
+    Batches are submitted from the reactor thread, so they are queued in the order the pipeline filled them."""
+
+    def __init__(self, write_batch, logger, failed_dir, queue_size=4, max_retries=5, retry_delay=1.0):
+        super().__init__(name='mongo-writer', daemon=True)
+        self.write_batch = write_batch
+        self.logger = logger
+        self.failed_dir = failed_dir
+        self.queue = queue.Queue()
+        self.queue_size = queue_size
+        self.waiting = []
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def submit(self, collection, docs):
+        """Queues a batch without blocking the reactor. The returned Deferred fires once at most queue_size batches
+        are waiting, and holding the item until then is what holds back the engine when Mongo is slow"""
+        self.queue.put_nowait((collection, docs))
+        if self.queue.qsize() <= self.queue_size:
+            return defer.succeed(None)
+        waiter = defer.Deferred()
+        self.waiting.append(waiter)
+        return waiter
+
+    def release(self):
+        # Runs on the reactor thread each time the writer takes a batch off the queue
+        while self.waiting and self.queue.qsize() <= self.queue_size:
+            self.waiting.pop(0).callback(None)
+
+    def run(self):
+        from twisted.internet import reactor
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            reactor.callFromThread(self.release)
+            self.flush(*job)
+
+    def flush(self, collection, docs):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.write_batch(collection, docs)
+                self.logger.info(f"Batch wrote {len(docs)} items into {collection}.")
+                return True
+            except BulkWriteError as e:
+                # The batch reached the server, only individual documents were rejected.
+                # Duplicate keys mean an earlier attempt already stored them.
+                errors = e.details.get('writeErrors', [])
+                rejected = [error for error in errors if error.get('code') != 11000]
+                if not rejected:
+                    self.logger.info(f"{len(errors)} of {len(docs)} items were already stored in {collection}.")
+                    return True
+                # Retrying would be rejected the same way, so only the rejected documents are kept
+                self.logger.error(f"Bulk write errors for {collection}: {rejected[:5]}")
+                self.save_failed(collection, [docs[error['index']] for error in rejected if error.get('index') is not None] or docs)
+                return False
+            except PyMongoError as e:
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                self.logger.warning(f"Write attempt {attempt} of {len(docs)} items into {collection} failed: {e}. Retrying in {delay}s")
+                time.sleep(delay)
+
+        self.logger.error(f"Gave up writing {len(docs)} items into {collection} after {self.max_retries} attempts")
+        self.save_failed(collection, docs)
+        return False
+
+    def save_failed(self, collection, docs):
+        # Keep the documents on disk rather than dropping them so they can be loaded later
+        failed_file = os.path.join(self.failed_dir, f'{collection}.failed.jsonl')
+        with open(failed_file, 'a') as f:
+            for doc in docs:
+                f.write(json.dumps(doc, default=str) + '\n')
+        self.logger.error(f"Saved {len(docs)} items that could not be written into {collection} to {failed_file}")
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
@@ -0,0 +1,28 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from twisted.internet.defer import Deferred
+
+
+class ParsePool:
+    """Runs extractors in worker processes and hands their results back to the reactor as Deferreds"""
+
+    def __init__(self, workers):
+        # Spawned rather than forked, the crawler process already runs reactor and driver threads
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, extractor, *args):
+        from twisted.internet import reactor
+
+        deferred = Deferred()
+
+        def done(future):
+            if future.exception() is not None:
+                reactor.callFromThread(deferred.errback, future.exception())
+            else:
+                reactor.callFromThread(deferred.callback, future.result())
+
+        self.executor.submit(extractor, *args).add_done_callback(done)
+        return deferred
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,203 @@
+"""Proxy pool with health scoring, sticky sessions and quarantine.
+
+Run `python -m scraping.proxies` from src to drive the pool against simulated proxies and compare it
+with picking proxies at random."""
+import argparse, random, time
+
+
+class ProxyStats:
+    __slots__ = ('proxy', 'success_rate', 'latency', 'consecutive_failures', 'quarantined_until', 'quarantines', 'probing', 'probe_started', 'requests')
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        # Optimistic priors so new proxies get tried
+        self.success_rate = 0.9
+        self.latency = 1.0
+        self.consecutive_failures = 0
+        self.quarantined_until = 0.0
+        self.quarantines = 0
+        self.probing = False
+        self.probe_started = 0.0
+        self.requests = 0
+
+
+class ProxyPool:
+    """Picks proxies weighted by success rate over latency.
+
+    A session (e.g. one promotion's page chain, or a run of ufcstats listing pages) keeps its proxy while that
+    proxy stays healthy. A proxy that fails quarantine_after times in a row is quarantined, for longer each time
+    it happens again. Once the quarantine is over it gets a single probe request: success puts it back in
+    rotation, failure sends it back to quarantine. A probe that has not settled after probe_timeout seconds,
+    because its request was dropped or cancelled, is given up on and the next request probes again."""
+
+    def __init__(self, proxies, alpha=0.2, quarantine_after=3, base_quarantine=60.0, max_quarantine=3600.0, probe_timeout=120.0, clock=time.time, rng=None):
+        self.stats = {proxy: ProxyStats(proxy) for proxy in dict.fromkeys(proxies)}
+        self.alpha = alpha
+        self.quarantine_after = quarantine_after
+        self.base_quarantine = base_quarantine
+        self.max_quarantine = max_quarantine
+        self.probe_timeout = probe_timeout
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.sessions = {}
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path) as f:
+            return cls([line.strip() for line in f if line.strip() and not line.startswith('#')], **kwargs)
+
+    def score(self, stats):
+        return stats.success_rate ** 2 / (0.1 + stats.latency)
+
+    def is_available(self, stats):
+        return not stats.probing and stats.quarantined_until <= self.clock()
+
+    def choose(self, session=None):
+        if session is not None:
+            proxy = self.sessions.get(session)
+            if proxy and self.is_available(self.stats[proxy]) and self.stats[proxy].quarantines == 0:
+                self.stats[proxy].requests += 1
+                return proxy
+
+        now = self.clock()
+        # Proxies whose quarantine is over get one probe before rejoining the rotation
+        for stats in self.stats.values():
+            if stats.probing and stats.probe_started + self.probe_timeout <= now:
+                stats.probing = False
+            if stats.quarantines and not stats.probing and stats.quarantined_until <= now:
+                stats.probing = True
+                stats.probe_started = now
+                stats.requests += 1
+                return stats.proxy
+
+        candidates = [stats for stats in self.stats.values() if self.is_available(stats) and stats.quarantines == 0]
+        if not candidates:
+            return None
+        chosen = self.rng.choices(candidates, weights=[self.score(stats) for stats in candidates])[0]
+        chosen.requests += 1
+        if session is not None:
+            self.sessions[session] = chosen.proxy
+        return chosen.proxy
+
+    def assign(self, meta):
+        """Puts a proxy from the pool on a request's meta, sticking to the proxy of meta['proxy_session'] if set"""
+        proxy = self.choose(meta.get('proxy_session'))
+        if proxy is None:
+            meta.pop('proxy', None)
+            return None
+        meta['proxy'] = proxy
+        meta['proxy_pool'] = True
+        meta['proxy_pending'] = proxy
+        return proxy
+
+    def settle(self, meta, ok):
+        """Reports the outcome of a request assigned by the pool, once, whichever middleware sees it first"""
+        proxy = meta.pop('proxy_pending', None)
+        if proxy is not None:
+            self.report(proxy, ok, meta.get('download_latency'))
+
+    def release(self, meta):
+        """Drops the proxy a request was assigned without a verdict, for responses that never went through it"""
+        stats = self.stats.get(meta.pop('proxy_pending', None))
+        if stats is not None and stats.probing:
+            # The probe never happened, so the next request gets it
+            stats.probing = False
+
+    def report(self, proxy, ok, latency=None):
+        stats = self.stats.get(proxy)
+        if stats is None:
+            return
+        stats.success_rate = (1 - self.alpha) * stats.success_rate + self.alpha * (1.0 if ok else 0.0)
+        if latency is not None:
+            stats.latency = (1 - self.alpha) * stats.latency + self.alpha * latency
+
+        if ok:
+            stats.consecutive_failures = 0
+            if stats.probing:
+                stats.probing = False
+                stats.quarantines = 0
+            return
+
+        stats.consecutive_failures += 1
+        if stats.probing or stats.consecutive_failures >= self.quarantine_after:
+            self.quarantine(stats)
+
+    def quarantine(self, stats):
+        stats.probing = False
+        stats.quarantines += 1
+        stats.consecutive_failures = 0
+        stats.quarantined_until = self.clock() + min(self.max_quarantine, self.base_quarantine * 2 ** (stats.quarantines - 1))
+        for session, proxy in list(self.sessions.items()):
+            if proxy == stats.proxy:
+                del self.sessions[session]
+
+    def is_quarantined(self, proxy):
+        stats = self.stats.get(proxy)
+        return stats is not None and stats.quarantines > 0 and not stats.probing
+
+    def snapshot(self):
+        return {stats.proxy: {'success_rate': round(stats.success_rate, 3), 'latency': round(stats.latency, 3),
+                              'quarantines': stats.quarantines, 'requests': stats.requests} for stats in self.stats.values()}
+
+
+class FakeProxy:
+    """Simulated proxy with a failure rate, a latency and optionally a stretch of downtime"""
+
+    def __init__(self, name, failure_rate, latency, down_between=None):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.down_between = down_between
+
+    def fetch(self, now, rng):
+        if self.down_between and self.down_between[0] <= now < self.down_between[1]:
+            return False, self.latency * 5
+        return rng.random() >= self.failure_rate, rng.expovariate(1 / self.latency)
+
+
+def simulate(requests=50000, sessions=200, seed=7, use_pool=True):
+    """Sends requests through simulated proxies, one simulated second per 50 requests"""
+    rng = random.Random(seed)
+    proxies = [FakeProxy(f'http://good-{i}', 0.02, 0.4) for i in range(6)]
+    proxies += [FakeProxy(f'http://slow-{i}', 0.05, 2.5) for i in range(3)]
+    proxies += [FakeProxy(f'http://bad-{i}', 0.6, 0.8) for i in range(3)]
+    proxies += [FakeProxy('http://flaky-0', 0.02, 0.4, down_between=(200, 500))]
+    by_name = {proxy.name: proxy for proxy in proxies}
+
+    clock = {'now': 0.0}
+    pool = ProxyPool(by_name, clock=lambda: clock['now'], rng=random.Random(seed))
+    successes, total_latency, sticky_hits, last_proxy = 0, 0.0, 0, {}
+    for i in range(requests):
+        clock['now'] = i / 50
+        session = rng.randrange(sessions)
+        name = pool.choose(session) if use_pool else rng.choice(list(by_name))
+        if name is None:
+            continue
+        sticky_hits += last_proxy.get(session) == name
+        last_proxy[session] = name
+        ok, latency = by_name[name].fetch(clock['now'], rng)
+        pool.report(name, ok, latency)
+        successes += ok
+        total_latency += latency
+    return {
+        'success_rate': round(successes / requests, 4),
+        'mean_latency': round(total_latency / requests, 3),
+        'sticky_rate': round(sticky_hits / requests, 4),
+        'proxies': pool.snapshot() if use_pool else None
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exercise the proxy pool against simulated proxies')
+    parser.add_argument('--requests', type=int, default=50000)
+    parser.add_argument('--sessions', type=int, default=200)
+    args = parser.parse_args()
+    started = time.time()
+    pooled = simulate(args.requests, args.sessions)
+    elapsed = time.time() - started
+    baseline = simulate(args.requests, args.sessions, use_pool=False)
+    print(f"Pool:   success {pooled['success_rate']:.2%}, mean latency {pooled['mean_latency']}s, same proxy for a session {pooled['sticky_rate']:.2%}")
+    print(f"Random: success {baseline['success_rate']:.2%}, mean latency {baseline['mean_latency']}s")
+    print(f"Selection cost: {elapsed / args.requests * 1e6:.1f}us per request")
+    for proxy, stats in pooled['proxies'].items():
+        print(f"  {proxy:18} {stats}")
@@ -0,0 +1,87 @@
+import random, time
+
+
+class SlotState:
+    __slots__ = ('delay', 'concurrency', 'latency', 'error_rate')
+
+    def __init__(self, delay, concurrency):
+        self.delay = delay
+        self.concurrency = concurrency
+        self.latency = None
+        self.error_rate = 0.0
+
+
+class AIMDController:
+    """Additive increase, multiplicative decrease of delay and concurrency for each download slot.
+
+    Successes slowly raise concurrency and shave the delay. Throttling or errors halve concurrency and
+    double the delay, honouring Retry-After. Latency well above the slot's usual level pauses the increase."""
+
+    def __init__(self, min_delay=0.25, max_delay=60.0, start_concurrency=4, max_concurrency=16, delay_step=0.05, decrease_factor=0.5, alpha=0.2):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.start_concurrency = start_concurrency
+        self.max_concurrency = max_concurrency
+        self.delay_step = delay_step
+        self.decrease_factor = decrease_factor
+        self.alpha = alpha
+        self.slots = {}
+
+    def state(self, key):
+        if key not in self.slots:
+            self.slots[key] = SlotState(self.min_delay, self.start_concurrency)
+        return self.slots[key]
+
+    def on_success(self, key, latency):
+        state = self.state(key)
+        state.error_rate = (1 - self.alpha) * state.error_rate
+        congested = state.latency is not None and latency > 2 * state.latency
+        state.latency = latency if state.latency is None else (1 - self.alpha) * state.latency + self.alpha * latency
+        if not congested:
+            state.concurrency = min(self.max_concurrency, state.concurrency + 1 / state.concurrency)
+            state.delay = max(self.min_delay, state.delay - self.delay_step)
+        return state
+
+    def on_congestion(self, key, retry_after=None):
+        state = self.state(key)
+        state.error_rate = (1 - self.alpha) * state.error_rate + self.alpha
+        state.concurrency = max(1, state.concurrency * self.decrease_factor)
+        state.delay = min(self.max_delay, max(state.delay * 2, self.min_delay * 2, retry_after or 0))
+        return state
+
+
+class ProxyHealth:
+    """Error rate per proxy, taking proxies out of rotation for a while once they fail too often"""
+
+    def __init__(self, ban_error_rate=0.5, min_samples=10, ban_seconds=600, alpha=0.1):
+        self.ban_error_rate = ban_error_rate
+        self.min_samples = min_samples
+        self.ban_seconds = ban_seconds
+        self.alpha = alpha
+        self.error_rates = {}
+        self.samples = {}
+        self.banned_until = {}
+
+    def record(self, proxy, failed):
+        if not proxy:
+            return False
+        self.samples[proxy] = self.samples.get(proxy, 0) + 1
+        rate = (1 - self.alpha) * self.error_rates.get(proxy, 0.0) + (self.alpha if failed else 0.0)
+        self.error_rates[proxy] = rate
+        if failed and self.samples[proxy] >= self.min_samples and rate >= self.ban_error_rate:
+            self.banned_until[proxy] = time.time() + self.ban_seconds
+            self.error_rates[proxy] = 0.0
+            self.samples[proxy] = 0
+            return True
+        return False
+
+    def is_banned(self, proxy):
+        return bool(proxy) and self.banned_until.get(proxy, 0) > time.time()
+
+    def healthy(self, proxies):
+        return [proxy for proxy in proxies if not self.is_banned(proxy)]
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,107 @@
+"""Replays archived pages through the spider callbacks without touching the network.
+
+    python -m tapology_scraper.replay events --archive <dir> --output <dir> [--workers N] [--callback parse_event_details]
+    python -m ufcstats_scraper.replay fighters --archive <dir> --output <dir> [--workers N] [--callback parse_details]
+
+By default the replay starts from the archived start pages and follows every request the callbacks
+yield that has an archived page, one level at a time across a process pool. With --callback only the
+pages downloaded for that callback are replayed, with the meta archived alongside them.
+Items are written as JSON Lines, one file per item type. Each project's replay module runs this one with its
+package name, which is where the spiders and item classes are looked up."""
+import argparse, json, logging, multiprocessing, os, time
+from importlib import import_module
+import scrapy
+from scrapy.settings import Settings
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.project import data_path
+from scraping.archive import segment_paths, iter_records, read_record, build_response, deserialize_meta
+
+replay_logger = logging.getLogger('replay')
+
+_spider = None
+
+
+def project_spiders(project):
+    """The spider classes of a project package by name"""
+    loader = SpiderLoader.from_settings(Settings({'SPIDER_MODULES': [f'{project}.spiders']}))
+    return {name: loader.load(name) for name in loader.list()}
+
+
+def _init_worker(project, spider_name):
+    global _spider
+    _spider = project_spiders(project)[spider_name]()
+    # A replay re-extracts everything, nothing is skipped for already being stored
+    _spider.skip_stored = False
+
+
+def _replay_task(task):
+    path, offset, callback, meta = task
+    # Pages parsed in the parse pool replay through the plain callback
+    callback = callback.removesuffix('_pooled')
+    header, body = read_record(path, offset)
+    request = scrapy.Request(header['request_url'], meta=meta, dont_filter=True)
+    response = build_response(header, body, request)
+    found_items, children = [], []
+    for output in getattr(_spider, callback)(response) or []:
+        if isinstance(output, scrapy.Request):
+            children.append((output.url, output.callback.__name__ if output.callback else 'parse', output.meta))
+        elif isinstance(output, scrapy.Item):
+            found_items.append((type(output).__name__, dict(output)))
+    return found_items, children
+
+
+def build_index(archive_dir, spider_name):
+    """Maps each archived request URL to its newest record"""
+    index = {}
+    for path in segment_paths(archive_dir, spider_name):
+        for offset, header, _ in iter_records(path):
+            index[header['request_url']] = (path, offset, header['callback'], header['meta'])
+    return index
+
+
+def replay(project, spider_name, archive_dir, output_dir, workers=None, callback=None):
+    items = import_module(f'{project}.items')
+    index = build_index(archive_dir, spider_name)
+    if callback:
+        level = [(path, offset, cb, deserialize_meta(meta, items)) for path, offset, cb, meta in index.values() if cb == callback]
+    else:
+        level = [(path, offset, cb, deserialize_meta(meta, items)) for path, offset, cb, meta in index.values() if meta.get('depth', 0) == 0]
+    replay_logger.info(f"Replaying {len(level)} of {len(index)} archived pages for {spider_name}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {}
+    seen = {task[0:2] for task in level}
+    pages, item_count, started = 0, 0, time.time()
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(project, spider_name)) as pool:
+        while level:
+            next_level = []
+            for found_items, children in pool.imap_unordered(_replay_task, level, chunksize=8):
+                pages += 1
+                for item_type, fields in found_items:
+                    if item_type not in outputs:
+                        outputs[item_type] = open(os.path.join(output_dir, f'{item_type}.jsonl'), 'w')
+                    outputs[item_type].write(json.dumps(fields, default=str) + '\n')
+                    item_count += 1
+                if callback:
+                    continue
+                for url, child_callback, meta in children:
+                    if url in index and index[url][0:2] not in seen:
+                        seen.add(index[url][0:2])
+                        next_level.append((index[url][0], index[url][1], child_callback, meta))
+            level = next_level
+            replay_logger.info(f"Replayed {pages} pages, {item_count} items ({pages / max(time.time() - started, 1e-9):.0f} pages/s)")
+
+    for output in outputs.values():
+        output.close()
+    return pages, item_count
+
+
+def main(project):
+    parser = argparse.ArgumentParser(description='Replay archived pages through spider callbacks')
+    parser.add_argument('spider', choices=sorted(project_spiders(project)))
+    parser.add_argument('--archive', default=None, help='Archive directory, defaults to the project data dir')
+    parser.add_argument('--output', default='replay_items', help='Directory for the JSON Lines item files')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to every core')
+    parser.add_argument('--callback', default=None, help='Only replay pages downloaded for this callback')
+    args = parser.parse_args()
+    replay(project, args.spider, args.archive or data_path('page_archive'), args.output, args.workers, args.callback)
@@ -0,0 +1,42 @@
+"""What every spider of both projects shares: retrying failed requests within a budget, and the optional parse pool."""
+import logging, scrapy
+from scrapy.exceptions import IgnoreRequest
+from scraping.parsepool import ParsePool
+
+general_logger = logging.getLogger('general')
+proxy_logger = logging.getLogger('proxy_errors')
+
+
+class BaseSpider(scrapy.Spider):
+    errback_max_retries = 3
+    # Set PARSE_POOL_WORKERS to run the extractors in worker processes
+    parse_pool = None
+
+    def open_parse_pool(self, pages):
+        workers = self.settings.getint('PARSE_POOL_WORKERS', 0)
+        if workers:
+            self.parse_pool = ParsePool(workers)
+            general_logger.info(f"Parsing {pages} pages in {workers} worker processes")
+
+    def closed(self, reason):
+        if self.parse_pool:
+            self.parse_pool.close()
+
+    def errback_proxy(self, failure):
+        # Log proxy errors
+        proxy = failure.request.meta.get('proxy')
+        proxy_logger.error(f"Proxy {proxy} encountered an error for URL: {failure.request.url} for spider {self.name}")
+        proxy_logger.error(f"Error details: {repr(failure)} for spider {self.name}")
+
+        # Retry on failure, within a fixed budget so one bad proxy cannot loop forever
+        retries = failure.request.meta.get('errback_retries', 0)
+        if failure.check(IgnoreRequest):
+            return None
+        elif retries >= self.errback_max_retries:
+            proxy_logger.error(f"Giving up on {failure.request.url} after {retries} retries for spider {self.name}")
+            return None
+        else:
+            request = failure.request.copy()
+            request.meta['errback_retries'] = retries + 1
+            request.dont_filter = True  # To avoid getting filtered by duplicate filter
+            return request
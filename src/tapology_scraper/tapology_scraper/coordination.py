@@ -0,0 +1,181 @@
+"""MongoDB coordination for running one spider across several worker processes.
+
+Run `python -m tapology_scraper.coordination --workers 4` to have local processes drain a set of fake
+promotions against MONGO_URI, with one worker killed halfway through, and check every promotion was finished."""
+import argparse, multiprocessing, os, random, socket, time
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+PENDING, LEASED, DONE = 'pending', 'leased', 'done'
+
+
+class Coordinator:
+    """Hands out partitions of a crawl (promotions, for the events spider) to workers as leases.
+
+    A worker claims a few partitions at a time and keeps every request for them to itself, so a promotion's
+    page chain never leaves the worker that started it. Workers heartbeat while they run, which also extends
+    their leases. If a worker stops heartbeating, its leases expire and go back to pending, and the fingerprints
+    it registered in the shared dupefilter are dropped so another worker can fetch those pages again.
+
+    The calls block on MongoDB, so spiders make them from a thread rather than the reactor."""
+
+    def __init__(self, db, spider, crawl_id, worker_id=None, lease_seconds=120, prefix='scrapy_tapology'):
+        self.db = db
+        self.spider = spider
+        self.crawl_id = crawl_id
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.leases = db[f'{prefix}_crawl_leases']
+        self.workers = db[f'{prefix}_crawl_workers']
+        self.seen = db[f'{prefix}_crawl_seen']
+        self.crawls = db[f'{prefix}_crawls']
+        self.held = set()
+
+    @classmethod
+    def current_crawl(cls, db, spider, prefix='scrapy_tapology'):
+        """Id of the spider's running crawl. The first worker started without an id creates it, and it stays until
+        finish() is called, however long the crawl runs"""
+        started = datetime.now(timezone.utc)
+        for _ in range(2):
+            try:
+                crawl = db[f'{prefix}_crawls'].find_one_and_update(
+                    {'_id': spider},
+                    {'$setOnInsert': {'crawl_id': f"{spider}-{started:%Y%m%dT%H%M%S}-{os.getpid()}", 'started_at': started}},
+                    upsert=True, return_document=ReturnDocument.AFTER
+                )
+                return crawl['crawl_id']
+            except DuplicateKeyError:
+                # Another worker created it at the same moment, the retry reads theirs
+                continue
+        return db[f'{prefix}_crawls'].find_one({'_id': spider})['crawl_id']
+
+    def ensure_indexes(self):
+        self.leases.create_index([('crawl_id', 1), ('state', 1), ('expires_at', 1)])
+        self.leases.create_index([('crawl_id', 1), ('worker', 1)])
+        self.seen.create_index([('crawl_id', 1), ('worker', 1)])
+
+    def seed(self, partitions):
+        """Registers every partition for the crawl, workers can all call this since existing leases are left alone"""
+        operations = [
+            UpdateOne({'_id': f'{self.spider}:{self.crawl_id}:{partition}'},
+                      {'$setOnInsert': {'crawl_id': self.crawl_id, 'spider': self.spider, 'partition': partition, 'state': PENDING}},
+                      upsert=True)
+            for partition in partitions
+        ]
+        for i in range(0, len(operations), 1000):
+            self.leases.bulk_write(operations[i:i + 1000], ordered=False)
+
+    def claim(self, count):
+        """Takes up to count partitions that are pending or whose lease ran out"""
+        claimed = []
+        now = datetime.now(timezone.utc)
+        for _ in range(count):
+            lease = self.leases.find_one_and_update(
+                {'crawl_id': self.crawl_id, 'spider': self.spider,
+                 '$or': [{'state': PENDING}, {'state': LEASED, 'expires_at': {'$lt': now}}]},
+                {'$set': {'state': LEASED, 'worker': self.worker_id, 'expires_at': now + timedelta(seconds=self.lease_seconds)}},
+                return_document=ReturnDocument.AFTER
+            )
+            if lease is None:
+                break
+            claimed.append(lease['partition'])
+        self.held.update(claimed)
+        return claimed
+
+    def complete(self, partitions=None):
+        """Marks partitions done, all the ones this worker holds by default"""
+        partitions = list(self.held if partitions is None else partitions)
+        if partitions:
+            self.leases.update_many(
+                {'crawl_id': self.crawl_id, 'spider': self.spider, 'partition': {'$in': partitions}, 'worker': self.worker_id},
+                {'$set': {'state': DONE, 'finished_at': datetime.now(timezone.utc)}}
+            )
+        self.held.difference_update(partitions)
+        return partitions
+
+    def heartbeat(self):
+        now = datetime.now(timezone.utc)
+        self.workers.update_one({'_id': self.worker_id},
+                                {'$set': {'crawl_id': self.crawl_id, 'spider': self.spider, 'heartbeat': now}}, upsert=True)
+        self.leases.update_many({'crawl_id': self.crawl_id, 'worker': self.worker_id, 'state': LEASED},
+                                {'$set': {'expires_at': now + timedelta(seconds=self.lease_seconds)}})
+
+    def reap(self):
+        """Returns the work of workers that stopped heartbeating to the pool, returns their ids"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.lease_seconds)
+        dead = [worker['_id'] for worker in self.workers.find({'crawl_id': self.crawl_id, 'heartbeat': {'$lt': cutoff}}, {'_id': 1})]
+        for worker in dead:
+            self.leases.update_many({'crawl_id': self.crawl_id, 'worker': worker, 'state': LEASED},
+                                    {'$set': {'state': PENDING}, '$unset': {'worker': '', 'expires_at': ''}})
+            self.seen.delete_many({'crawl_id': self.crawl_id, 'worker': worker})
+            self.workers.delete_one({'_id': worker})
+        return dead
+
+    def outstanding(self):
+        """Partitions that are not done yet, whoever holds them"""
+        return self.leases.count_documents({'crawl_id': self.crawl_id, 'spider': self.spider, 'state': {'$ne': DONE}})
+
+    def finish(self):
+        """Ends the crawl once every partition is done, so the next worker started without an id begins a new one"""
+        self.crawls.delete_one({'_id': self.spider, 'crawl_id': self.crawl_id})
+
+    def request_seen(self, fingerprint):
+        try:
+            self.seen.insert_one({'_id': f'{self.crawl_id}:{fingerprint.hex()}', 'crawl_id': self.crawl_id, 'worker': self.worker_id})
+        except DuplicateKeyError:
+            return True
+        return False
+
+    def leave(self):
+        """Gives back unfinished leases right away instead of waiting for them to expire"""
+        self.leases.update_many({'crawl_id': self.crawl_id, 'worker': self.worker_id, 'state': LEASED},
+                                {'$set': {'state': PENDING}, '$unset': {'worker': '', 'expires_at': ''}})
+        self.workers.delete_one({'_id': self.worker_id})
+        self.held.clear()
+
+
+def run_worker(mongo_uri, mongo_db, crawl_id, worker_id, lease_seconds, die_after):
+    """Claims and finishes fake promotions until none are left, stopping dead after die_after claims if set"""
+    coordinator = Coordinator(MongoClient(mongo_uri)[mongo_db], 'simulation', crawl_id, worker_id, lease_seconds)
+    finished, claims = [], 0
+    while True:
+        coordinator.heartbeat()
+        coordinator.reap()
+        claimed = coordinator.claim(3)
+        if not claimed:
+            if not coordinator.outstanding():
+                return finished
+            time.sleep(lease_seconds / 4)
+            continue
+        claims += 1
+        if die_after and claims > die_after:
+            # Simulates a crash, the leases are left held and heartbeats stop
+            return finished
+        time.sleep(random.uniform(0.01, 0.05) * len(claimed))
+        finished.extend(coordinator.complete())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drain fake promotions with several local worker processes')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--partitions', type=int, default=200)
+    parser.add_argument('--lease-seconds', type=float, default=2.0)
+    parser.add_argument('--mongo-uri', default=os.getenv('MONGO_URI', 'mongodb://localhost:27017'))
+    parser.add_argument('--mongo-db', default=os.getenv('MONGO_DATABASE', 'fightgraphs_simulation'))
+    args = parser.parse_args()
+
+    crawl_id = f'simulation-{int(time.time())}'
+    coordinator = Coordinator(MongoClient(args.mongo_uri)[args.mongo_db], 'simulation', crawl_id)
+    coordinator.ensure_indexes()
+    coordinator.seed([f'/promotion/{i}' for i in range(args.partitions)])
+
+    jobs = [(args.mongo_uri, args.mongo_db, crawl_id, f'worker-{i}', args.lease_seconds, 5 if i == 0 else 0) for i in range(args.workers)]
+    started = time.time()
+    with multiprocessing.Pool(args.workers) as pool:
+        results = pool.starmap(run_worker, jobs)
+    finished = [partition for result in results for partition in result]
+    print(f"{len(finished)} promotions finished in {time.time() - started:.1f}s by {args.workers} workers, worker-0 killed after 5 claims")
+    for (_, _, _, worker_id, _, _), result in zip(jobs, results):
+        print(f"  {worker_id}: {len(result)}")
+    print(f"Missing: {args.partitions - len(set(finished))}, finished twice: {len(finished) - len(set(finished))}")
@@ -0,0 +1,20 @@
+from scrapy.dupefilters import RFPDupeFilter
+
+
+class SharedDupeFilter(RFPDupeFilter):
+    """Dupefilter shared by every worker of a distributed crawl through the spider's Coordinator.
+
+    Spiders without a coordinator get the regular RFPDupeFilter behaviour. Enabled with
+    DUPEFILTER_CLASS = 'tapology_scraper.dupefilter.SharedDupeFilter'."""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        dupefilter = super().from_crawler(crawler)
+        dupefilter.crawler = crawler
+        return dupefilter
+
+    def request_seen(self, request):
+        coordinator = getattr(self.crawler.spider, 'coordinator', None)
+        if coordinator is None:
+            return super().request_seen(request)
+        return coordinator.request_seen(self.fingerprinter.fingerprint(request))
@@ -0,0 +1,21 @@
+from parsel import Selector
+
+
+def extract_event_details(text):
+    """Pulls the date, location and detail list off an event page. Plain data only, so it can run in a worker process."""
+    selector = Selector(text=text)
+    data = {}
+    date_container = selector.xpath('//div[@class="div flex items-center justify-between text-xs uppercase font-bold text-tap_7f leading-none"]')
+    data['event_date'] = date_container.xpath('.//span[@class="hidden md:inline"]/text()').get()
+    location_container = selector.xpath('//div[@class="div flex items-center justify-end gap-1.5"]')
+    data['event_location'] = location_container.xpath('.//a/text()').get()
+    details = {}
+    details_container = selector.xpath('//div[contains(@class, "hidden") and contains(@class, "md:flex")]/ul/li')
+    for detail in details_container:
+        detail_key = detail.xpath('.//span[contains(@class, "font-bold")]/text()').get()
+        detail_value = detail.xpath('.//span[contains(@class, "text-neutral-700")]/text()').get()
+
+        if detail_key and detail_value:
+            details[detail_key.strip()] = detail_value.strip()
+    data['event_details'] = details
+    return data
@@ -0,0 +1,84 @@
+import json, os, sqlite3, time
+
+PENDING, IN_FLIGHT, DONE, FAILED = 'pending', 'in_flight', 'done', 'failed'
+
+
+class Frontier:
+    """SQLite record of every request a crawl job has scheduled, what state it reached and a hash of its content.
+
+    Rows are keyed on the request fingerprint and scoped to a job, FRONTIER_JOB or else JOBDIR. A job that finishes
+    cleanly clears its rows, so only an interrupted job is resumed and the next ordinary crawl starts fresh."""
+
+    def __init__(self, path, job='default', commit_every=500):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS frontier (
+            job TEXT NOT NULL,
+            spider TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            url TEXT NOT NULL,
+            method TEXT NOT NULL DEFAULT 'GET',
+            body BLOB,
+            state TEXT NOT NULL,
+            callback TEXT,
+            meta TEXT,
+            content_hash TEXT,
+            updated_at REAL,
+            PRIMARY KEY (job, spider, fingerprint)
+        )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS frontier_job_state ON frontier (job, spider, state)')
+        self.conn.commit()
+        self.job = job
+        self.commit_every = commit_every
+        self.writes = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # The spider and downloader middlewares share one frontier per crawler
+        if getattr(crawler, 'frontier', None) is None:
+            job = crawler.settings.get('FRONTIER_JOB') or crawler.settings.get('JOBDIR') or 'default'
+            crawler.frontier = cls(crawler.settings.get('FRONTIER_PATH'), job)
+        return crawler.frontier
+
+    def _write(self, sql, params):
+        self.conn.execute(sql, params)
+        self.writes += 1
+        if self.writes % self.commit_every == 0:
+            self.conn.commit()
+
+    def add(self, spider, fingerprint, request, callback, meta):
+        # Finished pages only go back to pending when they are explicitly requested again
+        self._write('''INSERT INTO frontier (job, spider, fingerprint, url, method, body, state, callback, meta, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (job, spider, fingerprint) DO UPDATE SET state = excluded.state, callback = excluded.callback,
+            meta = excluded.meta, updated_at = excluded.updated_at''',
+            (self.job, spider, fingerprint, request.url, request.method, request.body or None, PENDING, callback, json.dumps(meta), time.time()))
+
+    def mark(self, spider, fingerprint, state, content_hash=None):
+        self._write('UPDATE frontier SET state = ?, content_hash = COALESCE(?, content_hash), updated_at = ? WHERE job = ? AND spider = ? AND fingerprint = ?',
+                    (state, content_hash, time.time(), self.job, spider, fingerprint))
+
+    def state(self, spider, fingerprint):
+        row = self.conn.execute('SELECT state FROM frontier WHERE job = ? AND spider = ? AND fingerprint = ?', (self.job, spider, fingerprint)).fetchone()
+        return row[0] if row else None
+
+    def unfinished(self, spider):
+        """Everything the job scheduled but did not finish, in flight pages included since those never came back"""
+        cursor = self.conn.execute('SELECT fingerprint, url, method, body, callback, meta FROM frontier WHERE job = ? AND spider = ? AND state != ?',
+                                   (self.job, spider, DONE))
+        for fingerprint, url, method, body, callback, meta in cursor:
+            yield fingerprint, url, method, body, callback, json.loads(meta) if meta else {}
+
+    def counts(self, spider):
+        return dict(self.conn.execute('SELECT state, COUNT(*) FROM frontier WHERE job = ? AND spider = ? GROUP BY state', (self.job, spider)).fetchall())
+
+    def clear(self, spider):
+        self.conn.execute('DELETE FROM frontier WHERE job = ? AND spider = ?', (self.job, spider))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
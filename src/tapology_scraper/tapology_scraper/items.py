@@ -13,6 +13,10 @@ class TapologyInitialFighterItem(scrapy.Item):
     weightclass = scrapy.Field()
     record = scrapy.Field()
     nationality = scrapy.Field()
+    # Typed fields added by TapologyNormalizationPipeline
+    height_cm = scrapy.Field()
+    record_wld = scrapy.Field()
+    no_contests = scrapy.Field()
 
 
 
@@ -30,7 +34,11 @@ class TapologyEventItem(scrapy.Item):
     event_name = scrapy.Field()
     fights = scrapy.Field()
     fighters = scrapy.Field()
+    # A dict per bout on the card: bout_link and the two fighter links
+    bouts = scrapy.Field()
     event_date = scrapy.Field()
     event_location = scrapy.Field()
     event_details = scrapy.Field()
+    # Typed field added by TapologyNormalizationPipeline
+    event_datetime = scrapy.Field()
     
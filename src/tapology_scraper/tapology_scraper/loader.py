@@ -0,0 +1,11 @@
+"""Bulk loads scraped Tapology items from JSON Lines into MongoDB without running a crawl.
+
+    python -m tapology_scraper.loader <file or dir> [...] [--item TapologyEventItem] [--mode upsert] [--writers 8]
+    python -m tapology_scraper.loader --archive <dir> --spider events
+
+The loader itself is scraping.loader, shared with the ufcstats project."""
+from scraping.loader import main
+from tapology_scraper.pipelines import TapologyScraperPipeline
+
+if __name__ == '__main__':
+    main(TapologyScraperPipeline)
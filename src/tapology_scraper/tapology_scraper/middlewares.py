@@ -3,12 +3,30 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import hashlib, time
+import scrapy
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.project import data_path
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet.task import deferLater
+from scraping.httpcache import LocalCacheStorage, TTLPolicy
+from tapology_scraper import items
+from scraping.ratecontrol import AIMDController, ProxyHealth, backoff_delay
+from scraping.archive import ArchiveWriter, serialize_meta, deserialize_meta
+from tapology_scraper.frontier import Frontier, IN_FLIGHT, DONE, FAILED
+from scraping.proxies import ProxyPool
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
 
+def from_network(response):
+    """Whether a response was downloaded, rather than served by the local cache, offline mode or the page archive"""
+    return 'revalidated' in response.flags or not ('cached' in response.flags or 'archived' in response.flags)
+
+
 class TapologyScraperSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the spider middleware does not modify the
@@ -57,47 +75,412 @@ class TapologyScraperSpiderMiddleware:
 
 
 class TapologyScraperDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    """Local HTTP cache. Serves fresh pages from disk and revalidates stale ones with ETag/Last-Modified.
+
+    Enabled with LOCAL_HTTPCACHE_ENABLED. Freshness comes from LOCAL_HTTPCACHE_TTL (seconds),
+    LOCAL_HTTPCACHE_SPIDER_TTL ({spider name: ttl}) and LOCAL_HTTPCACHE_URL_TTL ([(regex, ttl)], first match wins).
+    LOCAL_HTTPCACHE_OFFLINE serves whatever is cached and ignores requests that are not."""
+
+    def __init__(self, enabled=False, storage=None, policy=None, fingerprinter=None, stats=None, offline=False):
+        self.enabled = enabled
+        self.storage = storage
+        self.policy = policy
+        self.fingerprinter = fingerprinter
+        self.stats = stats
+        self.offline = offline
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        settings = crawler.settings
+        s = cls(
+            enabled=settings.getbool('LOCAL_HTTPCACHE_ENABLED', False),
+            storage=LocalCacheStorage(settings.get('LOCAL_HTTPCACHE_DIR') or data_path('local_httpcache')),
+            policy=TTLPolicy(
+                settings.getint('LOCAL_HTTPCACHE_TTL', 24 * 60 * 60),
+                settings.getdict('LOCAL_HTTPCACHE_SPIDER_TTL'),
+                settings.getlist('LOCAL_HTTPCACHE_URL_TTL')
+            ),
+            fingerprinter=crawler.request_fingerprinter,
+            stats=crawler.stats,
+            offline=settings.getbool('LOCAL_HTTPCACHE_OFFLINE', False)
+        )
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
     def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
+        if not self.enabled or request.meta.get('dont_cache'):
+            return None
+
+        fingerprint = self.fingerprinter.fingerprint(request).hex()
+        meta = self.storage.load(spider, fingerprint)
+        if meta is None:
+            self.stats.inc_value('local_httpcache/miss')
+            if self.offline:
+                raise IgnoreRequest(f"Offline and not cached: {request.url}")
+            return None
+
+        if self.offline or self.policy.is_fresh(spider, request.url, meta):
+            self.stats.inc_value('local_httpcache/hit')
+            return self.storage.response(spider, fingerprint, meta, request)
+
+        # Stale: ask the server whether the cached copy is still good
+        headers = {k.lower(): v for k, v in meta['headers'].items()}
+        if 'etag' in headers:
+            request.headers['If-None-Match'] = headers['etag'][0]
+        if 'last-modified' in headers:
+            request.headers['If-Modified-Since'] = headers['last-modified'][0]
+        request.meta['local_cache_fingerprint'] = fingerprint
+        self.stats.inc_value('local_httpcache/stale')
         return None
 
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
+        if not self.enabled or request.meta.get('dont_cache') or 'cached' in response.flags:
+            return response
 
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+        fingerprint = request.meta.get('local_cache_fingerprint')
+        if response.status == 304 and fingerprint:
+            meta = self.storage.load(spider, fingerprint)
+            if meta is not None:
+                self.storage.touch(spider, fingerprint, meta)
+                self.stats.inc_value('local_httpcache/revalidated')
+                # The 304 did go out, so rate control and the proxy pool still count it
+                cached = self.storage.response(spider, fingerprint, meta, request)
+                cached.flags.append('revalidated')
+                return cached
+
+        if response.status == 200:
+            self.storage.store(spider, fingerprint or self.fingerprinter.fingerprint(request).hex(), response)
+            self.stats.inc_value('local_httpcache/store')
         return response
 
     def process_exception(self, request, exception, spider):
         # Called when a download handler or a process_request()
         # (from other downloader middleware) raises an exception.
-
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
         pass
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class TapologyArchiveMiddleware:
+    """Writes every downloaded page to compressed archive segments so callbacks can be replayed offline.
+
+    Enabled with PAGE_ARCHIVE_ENABLED. Segments go to PAGE_ARCHIVE_DIR and roll over at PAGE_ARCHIVE_SEGMENT_SIZE bytes.
+    Replay them with `python -m tapology_scraper.replay <spider>`."""
+
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.writer = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PAGE_ARCHIVE_ENABLED', False):
+            raise NotConfigured
+        s = cls(
+            crawler.settings.get('PAGE_ARCHIVE_DIR') or data_path('page_archive', createdir=True),
+            crawler.settings.getint('PAGE_ARCHIVE_SEGMENT_SIZE', 256 * 1024 * 1024)
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_response(self, request, response, spider):
+        # Cached pages were archived when they were first downloaded
+        if response.status == 200 and 'cached' not in response.flags:
+            callback = request.callback.__name__ if request.callback else 'parse'
+            self.writer.write(request, response, callback)
+        return response
+
+    def spider_opened(self, spider):
+        self.writer = ArchiveWriter(self.directory, spider.name, self.segment_size)
+        spider.logger.info(f"Archiving pages for {spider.name} to {self.directory}")
+
+    def spider_closed(self, spider):
+        self.writer.close()
+
+
+class TapologyFrontierSpiderMiddleware:
+    """Resumes an interrupted crawl job from the durable frontier and keeps its finished pages from being requested again.
+
+    Enabled with FRONTIER_PATH, alongside TapologyFrontierDownloaderMiddleware. Set FRONTIER_JOB (or JOBDIR) to name
+    the job, a crawl that closes with reason finished clears the job's rows."""
+
+    def __init__(self, frontier, fingerprinter):
+        self.frontier = frontier
+        self.fingerprinter = fingerprinter
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('FRONTIER_PATH'):
+            raise NotConfigured
+        s = cls(Frontier.from_crawler(crawler), crawler.request_fingerprinter)
+        crawler.signals.connect(s.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def fingerprint(self, request):
+        return self.fingerprinter.fingerprint(request).hex()
+
+    def done(self, spider, request):
+        return not request.dont_filter and self.frontier.state(spider.name, self.fingerprint(request)) == DONE
+
+    def process_start_requests(self, start_requests, spider):
+        # Pick up where the interrupted job stopped, then only the start pages that never finished
+        resumed = set()
+        for fingerprint, url, method, body, callback, meta in self.frontier.unfinished(spider.name):
+            resumed.add(fingerprint)
+            yield scrapy.Request(url, method=method, body=body, callback=getattr(spider, callback), errback=getattr(spider, 'errback_proxy', None),
+                                 meta=deserialize_meta(meta, items), dont_filter=True)
+        if resumed:
+            spider.logger.info(f"Resumed {len(resumed)} unfinished requests of job {self.frontier.job} from the frontier")
+
+        for request in start_requests:
+            if self.fingerprint(request) in resumed or self.done(spider, request):
+                continue
+            yield request
+
+    def process_spider_output(self, response, result, spider):
+        for output in result:
+            if isinstance(output, scrapy.Request) and self.done(spider, output):
+                continue
+            yield output
+
+        # A redirected response also finishes the requests that led to it
+        content_hash = hashlib.sha1(response.body).hexdigest()
+        for fingerprint in set(response.meta.get('frontier_fingerprints', [])) | {self.fingerprint(response.request)}:
+            self.frontier.mark(spider.name, fingerprint, DONE, content_hash)
+
+    def process_spider_exception(self, response, exception, spider):
+        self.frontier.mark(spider.name, self.fingerprint(response.request), FAILED)
+
+    def request_scheduled(self, request, spider):
+        fingerprint = self.fingerprint(request)
+        # A new list rather than an append, redirects and spiders passing meta along share it with the parent
+        fingerprints = request.meta.get('frontier_fingerprints', [])
+        if fingerprint not in fingerprints:
+            request.meta['frontier_fingerprints'] = fingerprints + [fingerprint]
+        # Pooled callbacks resume through the plain one
+        callback = request.callback.__name__.removesuffix('_pooled') if request.callback else 'parse'
+        self.frontier.add(spider.name, fingerprint, request, callback, serialize_meta(request.meta))
+
+    def spider_closed(self, spider, reason):
+        spider.logger.info(f"Frontier state of job {self.frontier.job} for {spider.name}: {self.frontier.counts(spider.name)}")
+        if reason == 'finished':
+            # Nothing left to resume, and keeping the done rows would filter the next crawl of the same pages
+            self.frontier.clear(spider.name)
+        self.frontier.close()
+
+
+class TapologyFrontierDownloaderMiddleware:
+    """Tracks requests through the downloader for the durable frontier"""
+
+    def __init__(self, frontier, fingerprinter):
+        self.frontier = frontier
+        self.fingerprinter = fingerprinter
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('FRONTIER_PATH'):
+            raise NotConfigured
+        return cls(Frontier.from_crawler(crawler), crawler.request_fingerprinter)
+
+    def process_request(self, request, spider):
+        self.frontier.mark(spider.name, self.fingerprinter.fingerprint(request).hex(), IN_FLIGHT)
+        return None
+
+    def process_exception(self, request, exception, spider):
+        self.frontier.mark(spider.name, self.fingerprinter.fingerprint(request).hex(), FAILED)
+        return None
+
+
+class TapologyProxyPoolMiddleware:
+    """Assigns proxies from a ProxyPool and feeds the outcome of each request back into it.
+
+    Enabled with PROXY_POOL_ENABLED. Proxies come from the file at PROXY_POOL_FILE, one per line, or from
+    PROXY_LIST. Give it a lower order than TapologyRateControlMiddleware, and both below Scrapy's
+    HttpProxyMiddleware (750), so the proxy is set before the download slot is picked. Requests that share
+    meta['proxy_session'] keep the same proxy while it stays healthy."""
+
+    FAILURE_STATUSES = {403, 407, 429, 502, 503, 504, 522, 524}
+
+    def __init__(self, crawler, pool):
+        self.crawler = crawler
+        self.pool = pool
+        crawler.proxy_pool = pool
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('PROXY_POOL_ENABLED', False):
+            raise NotConfigured
+        options = dict(
+            alpha=settings.getfloat('PROXY_POOL_EWMA_ALPHA', 0.2),
+            quarantine_after=settings.getint('PROXY_POOL_QUARANTINE_AFTER', 3),
+            base_quarantine=settings.getfloat('PROXY_POOL_QUARANTINE_SECONDS', 60.0),
+            max_quarantine=settings.getfloat('PROXY_POOL_MAX_QUARANTINE_SECONDS', 3600.0),
+            probe_timeout=settings.getfloat('PROXY_POOL_PROBE_TIMEOUT', 120.0)
+        )
+        if settings.get('PROXY_POOL_FILE'):
+            pool = ProxyPool.from_file(settings.get('PROXY_POOL_FILE'), **options)
+        else:
+            pool = ProxyPool(settings.getlist('PROXY_LIST'), **options)
+        if not pool.stats:
+            raise NotConfigured('PROXY_POOL_ENABLED is set but no proxies were loaded')
+        middleware = cls(crawler, pool)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def process_request(self, request, spider):
+        # Requests the pool assigned before (retries, errback copies) are assigned again, which also moves them off quarantined proxies
+        if 'proxy' in request.meta and not request.meta.get('proxy_pool'):
+            return None
+        if self.pool.assign(request.meta) is None:
+            self.crawler.stats.inc_value('proxy_pool/exhausted')
+            raise IgnoreRequest(f"No healthy proxy available for {request.url}")
+        self.crawler.stats.inc_value('proxy_pool/assigned')
+        return None
+
+    def process_response(self, request, response, spider):
+        if not from_network(response):
+            self.pool.release(request.meta)
+            return response
+        ok = response.status not in self.FAILURE_STATUSES
+        self.pool.settle(request.meta, ok)
+        if not ok and self.pool.is_quarantined(request.meta.get('proxy')):
+            self.crawler.stats.inc_value('proxy_pool/quarantined')
+        return response
+
+    def process_exception(self, request, exception, spider):
+        # A request dropped before it went out says nothing about its proxy
+        if isinstance(exception, IgnoreRequest):
+            self.pool.release(request.meta)
+        else:
+            self.pool.settle(request.meta, False)
+        return None
+
+    def spider_closed(self, spider):
+        for proxy, stats in self.pool.snapshot().items():
+            spider.logger.info(f"Proxy {proxy}: {stats}")
+
+
+class TapologyRateControlMiddleware:
+    """Adaptive rate control for each host and proxy, with a capped retry budget per request.
+
+    Enabled with RATE_CONTROL_ENABLED. It does its own retrying, so set RETRY_ENABLED = False alongside it.
+    Every host/proxy pair gets its own download slot, and AIMDController sets that slot's delay and concurrency
+    from latency and errors. Throttled or failed requests are retried with jittered exponential backoff, at most
+    RATE_CONTROL_MAX_RETRIES times. Proxies that keep failing are rested, and requests through them move to a
+    healthy proxy from PROXY_LIST. When TapologyProxyPoolMiddleware is enabled the pool does that job instead."""
+
+    RETRY_STATUSES = {403, 408, 429, 500, 502, 503, 504, 522, 524}
+
+    def __init__(self, crawler, controller, proxy_health, proxies=None, max_retries=5, backoff_base=1.0, backoff_max=60.0):
+        self.crawler = crawler
+        self.controller = controller
+        self.proxy_health = proxy_health
+        self.proxies = proxies or []
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.next_proxy = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('RATE_CONTROL_ENABLED', False):
+            raise NotConfigured
+        controller = AIMDController(
+            min_delay=settings.getfloat('RATE_CONTROL_MIN_DELAY', 0.25),
+            max_delay=settings.getfloat('RATE_CONTROL_MAX_DELAY', 60.0),
+            start_concurrency=settings.getint('RATE_CONTROL_START_CONCURRENCY', 4),
+            max_concurrency=settings.getint('RATE_CONTROL_MAX_CONCURRENCY', 16)
+        )
+        proxy_health = ProxyHealth(
+            ban_error_rate=settings.getfloat('RATE_CONTROL_PROXY_BAN_ERROR_RATE', 0.5),
+            ban_seconds=settings.getint('RATE_CONTROL_PROXY_BAN_SECONDS', 600)
+        )
+        return cls(
+            crawler, controller, proxy_health,
+            proxies=settings.getlist('PROXY_LIST'),
+            max_retries=settings.getint('RATE_CONTROL_MAX_RETRIES', 5),
+            backoff_base=settings.getfloat('RATE_CONTROL_BACKOFF_BASE', 1.0),
+            backoff_max=settings.getfloat('RATE_CONTROL_BACKOFF_MAX', 60.0)
+        )
+
+    def pick_proxy(self):
+        healthy = self.proxy_health.healthy(self.proxies)
+        if not healthy:
+            return None
+        self.next_proxy += 1
+        return healthy[self.next_proxy % len(healthy)]
+
+    async def process_request(self, request, spider):
+        proxy = request.meta.get('proxy')
+        if getattr(self.crawler, 'proxy_pool', None) is None and self.proxy_health.is_banned(proxy):
+            replacement = self.pick_proxy()
+            if replacement:
+                request.meta['proxy'] = proxy = replacement
+
+        request.meta['download_slot'] = f"{urlparse_cached(request).hostname}|{proxy or 'direct'}"
+        wait = request.meta.get('retry_not_before', 0) - time.time()
+        if wait > 0:
+            from twisted.internet import reactor
+            await maybe_deferred_to_future(deferLater(reactor, wait, lambda: None))
+        return None
+
+    def process_response(self, request, response, spider):
+        # Pages served locally say nothing about the host or the proxy, and carry no download latency
+        if not from_network(response):
+            return response
+        key = request.meta.get('download_slot')
+        if response.status in self.RETRY_STATUSES:
+            retry_after = response.headers.get('Retry-After', b'').decode('latin1')
+            self.apply(key, self.controller.on_congestion(key, float(retry_after) if retry_after.isdigit() else None))
+            self.record_proxy(request, True, spider)
+            return self.retry(request, f"status {response.status}", spider) or response
+
+        self.apply(key, self.controller.on_success(key, request.meta.get('download_latency', 0.0)))
+        self.record_proxy(request, False, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, IgnoreRequest):
+            return None
+        key = request.meta.get('download_slot')
+        self.apply(key, self.controller.on_congestion(key))
+        self.record_proxy(request, True, spider)
+        # Out of budget returns None, so the exception carries on to the spider's errback
+        return self.retry(request, repr(exception), spider)
+
+    def retry(self, request, reason, spider):
+        retries = request.meta.get('rate_retries', 0)
+        if retries >= self.max_retries:
+            self.crawler.stats.inc_value('rate_control/retry_budget_spent')
+            spider.logger.warning(f"Retry budget spent for {request.url} after {retries} retries: {reason}")
+            return None
+        retry = request.copy()
+        retry.meta['rate_retries'] = retries + 1
+        retry.meta['retry_not_before'] = time.time() + backoff_delay(retries, self.backoff_base, self.backoff_max)
+        retry.dont_filter = True
+        self.crawler.stats.inc_value('rate_control/retries')
+        spider.logger.info(f"Retrying {request.url} ({retries + 1}/{self.max_retries}): {reason}")
+        return retry
+
+    def record_proxy(self, request, failed, spider):
+        pool = getattr(self.crawler, 'proxy_pool', None)
+        if pool is not None:
+            # Retried responses never reach the pool middleware, so report them here
+            pool.settle(request.meta, not failed)
+            return
+        proxy = request.meta.get('proxy')
+        if self.proxy_health.record(proxy, failed):
+            self.crawler.stats.inc_value('rate_control/proxies_banned')
+            spider.logger.warning(f"Proxy {proxy} taken out of rotation for {self.proxy_health.ban_seconds}s")
+
+    def apply(self, key, state):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.delay = state.delay
+            slot.concurrency = max(1, int(state.concurrency))
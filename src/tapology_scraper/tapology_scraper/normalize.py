@@ -0,0 +1,61 @@
+"""Parsers that turn the strings scraped off Tapology into numbers in metric units, record tuples and real dates.
+
+Typed values are written next to the raw strings, which stay as scraped so hashes and older readers keep working."""
+import re
+from scraping.dates import parse_event_date
+
+FEET_INCHES = re.compile(r"(\d+)'\s*(\d+(?:\.\d+)?)?")
+CENTIMETRES = re.compile(r'(\d+(?:\.\d+)?)\s*cm')
+RECORD = re.compile(r'(\d+)\s*-\s*(\d+)\s*-\s*(\d+)')
+NO_CONTESTS = re.compile(r'(\d+)\s*NC')
+
+CM_PER_INCH = 2.54
+
+# Fields derived here, left out of the content hash since they only restate the raw ones
+TYPED_FIELDS = ('height_cm', 'record_wld', 'no_contests', 'event_datetime')
+# Indexes for the range queries the typed fields are meant for
+TYPED_INDEXES = {
+    'scrapy_tapology_fighters_initial': ['height_cm'],
+    'scrapy_tapology_events': ['event_datetime']
+}
+
+
+def parse_height_cm(value):
+    """5'11" (180cm) -> 180.0, 5'11" -> 180.3"""
+    if not isinstance(value, str):
+        return None
+    match = CENTIMETRES.search(value)
+    if match:
+        return float(match.group(1))
+    match = FEET_INCHES.search(value)
+    if not match:
+        return None
+    inches = int(match.group(1)) * 12 + float(match.group(2) or 0)
+    return round(inches * CM_PER_INCH, 1)
+
+
+def parse_record(value):
+    """22-3-0 (1 NC) -> ([22, 3, 0], 1)"""
+    match = RECORD.search(value) if isinstance(value, str) else None
+    if not match:
+        return None, None
+    no_contests = NO_CONTESTS.search(value)
+    return [int(part) for part in match.groups()], int(no_contests.group(1)) if no_contests else 0
+
+
+def normalize_fighter(fields):
+    """Adds the typed fields to a fighter item or stored document, in place"""
+    fields['height_cm'] = parse_height_cm(fields.get('height'))
+    fields['record_wld'], fields['no_contests'] = parse_record(fields.get('record'))
+    return fields
+
+
+def normalize_event(fields):
+    fields['event_datetime'] = parse_event_date(fields.get('event_date'))
+    return fields
+
+
+NORMALIZERS = {
+    'scrapy_tapology_fighters_initial': normalize_fighter,
+    'scrapy_tapology_events': normalize_event
+}
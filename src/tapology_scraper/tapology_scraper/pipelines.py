@@ -1,8 +1,13 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from itemadapter import ItemAdapter
 from scrapy.exceptions import DropItem
+from twisted.internet.threads import deferToThread
+from scraping.hashing import content_hash
+from scraping.mongo import DedupIndex, MongoWriter, bump_cache_version
+from tapology_scraper.normalize import NORMALIZERS, TYPED_FIELDS, TYPED_INDEXES
 from tapology_scraper.items import TapologyPromotionItem, TapologyEventItem, TapologyInitialFighterItem
-import hashlib, logging, os
+import logging, os
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -29,15 +34,40 @@ def setup_logger(name, log_file, level=logging.INFO):
 # General log for all pipeline operations
 pipeline_logger = setup_logger('pipeline_logger', f'{log_dir}/pipeline.log')
 
+def fill_missing(fields):
+    """Writes 'N/A' into empty fields, the placeholder stored documents and their readers rely on"""
+    for key, value in fields.items():
+        # Typed fields stay None so the columns hold a single type
+        if value is None and key not in TYPED_FIELDS:
+            fields[key] = 'N/A'
+
+def item_hash(fields, algorithm='blake2b'):
+    """The content hash the pipeline dedups on. Empty fields are read as 'N/A' from a copy, so an item
+    hashes the same before and after fill_missing and the fields are left as they are"""
+    canonical = {key: 'N/A' if value is None and key not in TYPED_FIELDS else value for key, value in fields.items()}
+    return content_hash(canonical, algorithm, exclude=TYPED_FIELDS)
+
 class TapologyScraperPipeline:
-    def __init__(self, mongo_uri=MONGO_URI, mongo_db=MONGO_DATABASE):
+    def __init__(self, mongo_uri=MONGO_URI, mongo_db=MONGO_DATABASE, async_writes=False, writer_queue_size=4, writer_max_retries=5, write_mode='insert', hash_algorithm='blake2b'):
         self.mongo_uri = mongo_uri
         self.mongo_db_name = mongo_db
+        self.async_writes = async_writes
+        self.writer_queue_size = writer_queue_size
+        self.writer_max_retries = writer_max_retries
+        self.writer = None
+        self.write_mode = write_mode
+        self.hash_algorithm = hash_algorithm
         self.collections = {
             TapologyPromotionItem: 'scrapy_tapology_promotions',
             TapologyEventItem: 'scrapy_tapology_events',
             TapologyInitialFighterItem: 'scrapy_tapology_fighters_initial'
         }
+        self.natural_keys = {
+            'scrapy_tapology_promotions': 'promotion_link',
+            'scrapy_tapology_events': 'event_link',
+            'scrapy_tapology_fighters_initial': 'tapology_link'
+        }
+        self.indexes = {}
         self.buffers = {collection: [] for collection in self.collections.values()}
         self.batch_size = 250
         self.collection_loggers = {}
@@ -49,7 +79,12 @@ class TapologyScraperPipeline:
     def from_crawler(cls, crawler):
         return cls(
             mongo_uri=crawler.settings.get('MONGO_URI', MONGO_URI),
-            mongo_db=crawler.settings.get('MONGO_DATABASE', MONGO_DATABASE)
+            mongo_db=crawler.settings.get('MONGO_DATABASE', MONGO_DATABASE),
+            async_writes=crawler.settings.getbool('MONGO_ASYNC_WRITES', False),
+            writer_queue_size=crawler.settings.getint('MONGO_WRITER_QUEUE_SIZE', 4),
+            writer_max_retries=crawler.settings.getint('MONGO_WRITER_MAX_RETRIES', 5),
+            write_mode=crawler.settings.get('MONGO_WRITE_MODE', 'insert'),
+            hash_algorithm=crawler.settings.get('CONTENT_HASH_ALGORITHM', 'blake2b')
         )
 
     def open_spider(self, spider):
@@ -63,17 +98,84 @@ class TapologyScraperPipeline:
             self.collection_loggers[collection_name] = setup_logger(collection_name, log_file)
             pipeline_logger.info(f"Logger initialized for {collection_name}: {log_file}")
 
+        # Preload stored hashes and links once so duplicate checks never hit the database
+        for collection_name, key_field in self.natural_keys.items():
+            self.indexes[collection_name] = DedupIndex(key_field, item_hash).load(self.db[collection_name], self.hash_algorithm)
+            pipeline_logger.info(f"Loaded {len(self.indexes[collection_name].hashes)} hashes and {len(self.indexes[collection_name].keys)} links for {collection_name}")
+            if self.indexes[collection_name].upgraded:
+                pipeline_logger.info(f"Rehashed {self.indexes[collection_name].upgraded} documents in {collection_name} stored under an older hash scheme")
+        spider.dedup_indexes = self.indexes
+
+        if self.write_mode == 'upsert':
+            for collection, key_field in self.natural_keys.items():
+                try:
+                    self.db[collection].create_index(key_field, unique=True)
+                    pipeline_logger.info(f"Ensured unique index on {key_field} for {collection}")
+                except PyMongoError as e:
+                    pipeline_logger.error(f"Could not create unique index on {key_field} for {collection}: {e}")
+
+        # Typed fields get plain indexes so range queries on them run in the database
+        for collection, fields in TYPED_INDEXES.items():
+            for field in fields:
+                try:
+                    self.db[collection].create_index(field)
+                except PyMongoError as e:
+                    pipeline_logger.error(f"Could not create index on {field} for {collection}: {e}")
+
+        if self.async_writes:
+            self.writer = MongoWriter(self.write_batch, pipeline_logger, log_dir, self.writer_queue_size, self.writer_max_retries)
+            self.writer.start()
+            pipeline_logger.info(f"Started background writer with a queue of {self.writer_queue_size} batches")
+
+    def write_batch(self, collection, docs):
+        # The cache version is only bumped when documents changed, so batches that failed or matched what was
+        # stored leave the query API's cached reads alone
+        try:
+            if self.write_mode == 'upsert':
+                # Keyed on the natural link, so replaying a batch that was partly written is harmless
+                key_field = self.natural_keys[collection]
+                operations = [
+                    UpdateOne({key_field: doc[key_field]}, {'$set': {k: v for k, v in doc.items() if k != '_id'}}, upsert=True)
+                    for doc in docs
+                ]
+                result = self.db[collection].bulk_write(operations, ordered=False)
+                changed = result.upserted_count + result.modified_count
+            else:
+                self.db[collection].insert_many(docs, ordered=not self.async_writes)
+                changed = len(docs)
+        except BulkWriteError as e:
+            # The documents of a failed batch that did get written
+            if e.details.get('nInserted') or e.details.get('nUpserted') or e.details.get('nModified'):
+                bump_cache_version(self.db, collection, pipeline_logger)
+            raise
+        if changed:
+            bump_cache_version(self.db, collection, pipeline_logger)
+
     def close_spider(self, spider):
+        if self.writer:
+            # Queue the leftovers behind every batch already submitted, then wait for the writer to drain
+            for collection, buffer in self.buffers.items():
+                if buffer:
+                    pipeline_logger.info(f"Queueing final {len(buffer)} items for {collection}.")
+                    self.writer.submit(collection, buffer)
+                    self.buffers[collection] = []
+            return deferToThread(self.close_writer)
+
         for collection, buffer in self.buffers.items():
             if buffer:
                 try:
                     pipeline_logger.info(f"Attempting to insert {len(buffer)} items into {collection}.")
-                    self.db[collection].insert_many(buffer)
+                    self.write_batch(collection, buffer)
                     pipeline_logger.info(f"Successfully inserted {len(buffer)} items into {collection}.")
                 except Exception as e:
                     pipeline_logger.error(f"Error inserting items into {collection}: {e}")
         self.client.close()
 
+    def close_writer(self):
+        self.writer.close()
+        pipeline_logger.info("Background writer drained")
+        self.client.close()
+
     def process_item(self, item, spider):
         collection = self.collection_name(item)
         if not collection:
@@ -81,29 +183,49 @@ class TapologyScraperPipeline:
             raise DropItem(f"Invalid item type: {type(item)}")
 
         adapter = ItemAdapter(item)
-        hash_string = ''
-        for key, value in sorted(adapter.items()):
-            if value is None:
-                adapter[key] = 'N/A'
-            hash_string += str(value)
-
-        adapter['hash'] = hashlib.sha256(hash_string.encode()).hexdigest()
+        fill_missing(adapter)
+        adapter['hash'] = item_hash(adapter, self.hash_algorithm)
         collection_logger = self.collection_loggers[collection]
+        index = self.indexes[collection]
+
+        if self.write_mode == 'upsert' and adapter.get(index.key_field) in (None, 'N/A'):
+            collection_logger.warning(f"Item has no {index.key_field} to upsert on: {adapter['hash']}")
+            raise DropItem(f"Missing {index.key_field}: {adapter['hash']}")
 
-        # Check for duplicates
-        if self.db[collection].find_one({'hash': adapter['hash']}):
+        # Check for duplicates, including items still waiting in the buffer
+        if index.has_hash(adapter['hash']):
             collection_logger.info(f"Duplicate item found: {adapter['hash']}")
             raise DropItem(f"Duplicate item found: {adapter['hash']}")
         else:
             self.buffers[collection].append(dict(adapter))
+            index.add(adapter['hash'], adapter.get(index.key_field))
             collection_logger.info(f"Item added to buffer: {adapter['hash']} (Buffer size: {len(self.buffers[collection])})")
 
             if len(self.buffers[collection]) >= self.batch_size:
+                if self.writer:
+                    batch, self.buffers[collection] = self.buffers[collection], []
+                    collection_logger.info(f"Queued batch of {len(batch)} items for {collection}.")
+                    return self.writer.submit(collection, batch).addCallback(lambda _: item)
                 try:
-                    self.db[collection].insert_many(self.buffers[collection])
+                    self.write_batch(collection, self.buffers[collection])
                     collection_logger.info(f"Batch inserted {len(self.buffers[collection])} items into {collection}.")
                     self.buffers[collection] = []
                 except Exception as e:
                     collection_logger.error(f"Error inserting items into {collection}: {e}")
 
         return item
+
+
+class TapologyNormalizationPipeline:
+    """Adds typed fields parsed from the raw strings, metric units, record tuples and dates, before items are stored.
+
+    Enable it ahead of TapologyScraperPipeline, e.g. ITEM_PIPELINES = {'tapology_scraper.pipelines.TapologyNormalizationPipeline': 200, 'tapology_scraper.pipelines.TapologyScraperPipeline': 300}."""
+
+    def __init__(self):
+        self.collections = TapologyScraperPipeline().collections
+
+    def process_item(self, item, spider):
+        normalizer = NORMALIZERS.get(self.collections.get(type(item)))
+        if normalizer:
+            normalizer(ItemAdapter(item))
+        return item
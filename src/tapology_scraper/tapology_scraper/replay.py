@@ -0,0 +1,9 @@
+"""Replays archived Tapology pages through the spider callbacks without touching the network.
+
+    python -m tapology_scraper.replay events --archive <dir> --output <dir> [--workers N] [--callback parse_event_details]
+
+The replay itself is scraping.replay, shared with the ufcstats project."""
+from scraping.replay import main
+
+if __name__ == '__main__':
+    main('tapology_scraper')
@@ -1,6 +1,16 @@
 import scrapy, os, logging
+from datetime import datetime, timedelta
 from tapology_scraper.items import TapologyEventItem
-from scrapy.exceptions import IgnoreRequest
+from scraping.dates import parse_event_date
+from tapology_scraper.utils import last_page_number, page_url, card_bouts
+from tapology_scraper.extractors import extract_event_details
+from tapology_scraper.coordination import Coordinator
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from scrapy.utils.defer import maybe_deferred_to_future
+from scraping.spiders import BaseSpider
 
 log_path = '/Users/sohanhossain/Documents/fightgraphs/src/tapology_scraper/logs/events_log/'
 if not os.path.exists(log_path):
@@ -30,98 +40,268 @@ general_logger.addHandler(general_handler)
 item_logger.addHandler(item_handler)
 proxy_logger.addHandler(proxy_handler)
 
-class EventsSpider(scrapy.Spider):
+class EventsSpider(BaseSpider):
     name = "events"
     collection = 'scrapy_tapology_events'
     allowed_domains = ["tapology.com"]
+    watermark_collection = 'scrapy_tapology_event_watermarks'
     start_urls = []
-    
+    # Run with -a mode=incremental to only refresh events that can still change
+    mode = 'full'
+    recent_days = 14
+    skip_stored = True
+    # Highest page requested per promotion, and the most events seen on one listing page
+    scheduled_pages = {}
+    listing_page_size = 0
+    # Run with -a distributed=1 to share promotions with other workers through MongoDB
+    distributed = False
+    crawl_id = None
+    worker_id = None
+    lease_batch = 5
+    lease_seconds = 120
+    coordinator = None
+    lease_refill = None
+    leases_drained = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
     def start_requests(self):
         promotions = self.db['scrapy_tapology_promotions'].distinct('promotion_link')
         self.start_urls = promotions
+        if self.distributed:
+            self.start_urls = self.start_distributed(promotions)
+        self.open_parse_pool('event')
+        if self.mode == 'incremental':
+            self.load_incremental_state()
         for link in self.start_urls:
             url = 'https://www.tapology.com' + link
             general_logger.info(f"Starting request for events for promotion {url}")
             try:
                 
-                yield scrapy.Request(url, callback=self.parse, meta={'promotion_link': url, 'page': 1}, errback=self.errback_proxy)
+                yield self.promotion_request(link)
             except Exception as e:
                 proxy_logger.error(f"Error in starting request for promotion {url}: {e} for spider {self.name}")
             
+    def promotion_request(self, link):
+        url = 'https://www.tapology.com' + link
+        return scrapy.Request(url, callback=self.parse, meta={'promotion_link': url, 'page': 1, 'proxy_session': url}, errback=self.errback_proxy)
+
+    def start_distributed(self, promotions):
+        """Registers this worker with the coordinator and returns the first promotions it leased"""
+        if 'SharedDupeFilter' not in self.settings.get('DUPEFILTER_CLASS', ''):
+            general_logger.warning("Distributed mode without DUPEFILTER_CLASS = 'tapology_scraper.dupefilter.SharedDupeFilter' dedups requests per worker only")
+        # Runs once before anything is downloaded, so these calls can block
+        self.crawl_id = self.crawl_id or Coordinator.current_crawl(self.db, self.name)
+        self.coordinator = Coordinator(self.db, self.name, self.crawl_id, self.worker_id, int(self.lease_seconds))
+        self.coordinator.ensure_indexes()
+        self.coordinator.seed(promotions)
+        self.heartbeat = LoopingCall(self.send_heartbeat)
+        self.heartbeat.start(int(self.lease_seconds) / 3, now=True)
+        self.coordinator.reap()
+        claimed = self.coordinator.claim(int(self.lease_batch))
+        general_logger.info(f"Worker {self.coordinator.worker_id} joined crawl {self.crawl_id} and leased {len(claimed)} promotions")
+        return claimed
+
+    def send_heartbeat(self):
+        # In a thread so a slow MongoDB never stalls downloads, a failed beat is retried by the next one
+        return deferToThread(self.coordinator.heartbeat).addErrback(lambda failure: general_logger.warning(f"Heartbeat failed: {failure.value}"))
+
+    def spider_idle(self, spider):
+        """Nothing is left in flight, so every leased promotion is finished and the next ones can be claimed"""
+        if self.coordinator is None or self.leases_drained:
+            return
+        # The spider stays open while the coordinator answers from its thread, idle fires again meanwhile
+        if self.lease_refill is None:
+            self.lease_refill = deferToThread(self.refill_leases)
+            self.lease_refill.addCallbacks(self.leases_refilled, self.lease_refill_failed)
+        raise DontCloseSpider
+
+    def refill_leases(self):
+        finished = self.coordinator.complete()
+        dead = self.coordinator.reap()
+        claimed = self.coordinator.claim(int(self.lease_batch))
+        # Stay open while other workers hold leases, in case they die and their promotions come back
+        outstanding = bool(claimed) or self.coordinator.outstanding() > 0
+        if not outstanding:
+            self.coordinator.finish()
+        return finished, dead, claimed, outstanding
+
+    def leases_refilled(self, result):
+        finished, dead, claimed, outstanding = result
+        self.lease_refill = None
+        if dead:
+            general_logger.info(f"Returned the promotions of stopped workers {dead} to the pool")
+        general_logger.info(f"Finished {len(finished)} promotions, leased {len(claimed)} more")
+        for link in claimed:
+            self.crawler.engine.crawl(self.promotion_request(link))
+        if not outstanding:
+            general_logger.info(f"Every promotion of crawl {self.crawl_id} is done")
+            self.leases_drained = True
+
+    def lease_refill_failed(self, failure):
+        self.lease_refill = None
+        general_logger.warning(f"Could not refill leases, retrying when idle again: {failure.value}")
+
+    def load_incremental_state(self):
+        self.cutoff = datetime.now() - timedelta(days=int(self.recent_days))
+        self.event_dates = {}
+        computed = {}
+        for event in self.db[self.collection].find({}, {'_id': 0, 'event_link': 1, 'event_date': 1, 'promotion_link': 1}):
+            event_date = parse_event_date(event.get('event_date'))
+            self.event_dates[event['event_link']] = event_date
+            # Events that finished before the cutoff are final, the newest of them is where paging can stop
+            if event_date and event_date < self.cutoff:
+                promotion = event.get('promotion_link')
+                computed[promotion] = max(computed.get(promotion, event_date), event_date)
+
+        self.stored_watermarks = {state['promotion_link']: state['watermark'] for state in self.db[self.watermark_collection].find({}, {'_id': 0})}
+        self.watermarks = dict(computed)
+        for promotion, watermark in self.stored_watermarks.items():
+            self.watermarks[promotion] = max(watermark, computed.get(promotion, watermark))
+        self.new_watermarks = {}
+        general_logger.info(f"Incremental mode: {len(self.event_dates)} stored events, {len(self.watermarks)} promotion watermarks, cutoff {self.cutoff:%Y-%m-%d}")
+        if self.settings.get('MONGO_WRITE_MODE', 'insert') != 'upsert':
+            general_logger.warning("Incremental mode refreshes stored events, set MONGO_WRITE_MODE = 'upsert' to update them in place")
+
+    def save_watermark(self, promotion_link):
+        watermark = self.new_watermarks.pop(promotion_link, None)
+        if watermark and watermark > self.stored_watermarks.get(promotion_link, datetime.min):
+            self.db[self.watermark_collection].update_one(
+                {'promotion_link': promotion_link},
+                {'$set': {'watermark': watermark, 'updated_at': datetime.now()}},
+                upsert=True
+            )
+            general_logger.info(f"Watermark for {promotion_link} moved to {watermark:%Y-%m-%d}")
 
     def parse(self, response):
+        if self.mode == 'incremental':
+            yield from self.parse_incremental(response)
+            return
+
         promotion_link = response.meta['promotion_link']
         general_logger.info(f"Scraping events for {response.meta['promotion_link']} - Page {response.meta['page']}")
         page = response.meta['page']
-        next_page = page + 1
-        next_page_url = f'{promotion_link}?page={next_page}'
-        yield scrapy.Request(next_page_url, callback=self.parse, meta={'promotion_link': promotion_link, 'page': next_page})
 
         events = response.xpath("//div[@data-controller='bout-toggler']")
         if not events:
             general_logger.info(f"No more events found for {promotion_link} with page {page}")
             return
 
+        yield from self.follow_pages(response, promotion_link, page, len(events))
+
         for event in events:
-            event_link = event.xpath('.//a[contains(@href, "/fightcenter/events/")]/@href').get()
-            if not event_link:
-                general_logger.info(f"Event link not found for {response.url}")
+            event_item = self.build_event_item(event, promotion_link, response)
+            if not event_item:
                 continue
 
-            event_link = 'https://www.tapology.com' + event_link
-            if self.db[self.collection].find_one({'event_link': event_link}):
-                general_logger.info(f"Event {event_link} already exists in the database. Skipping...")
+            if self.skip_stored and self.dedup_indexes[self.collection].has_key(event_item['event_link']):
+                general_logger.info(f"Event {event_item['event_link']} already exists in the database. Skipping...")
                 continue
-                
-            event_item = TapologyEventItem()
-            event_item['promotion_link'] = promotion_link
-            event_item['event_link']=  event_link
-            event_item['event_name'] = event.xpath('.//a[contains(@href, "/fightcenter/events/")]/text()').get()
-
-            event_item['fights'], event_item['fighters'] = [], []
-            fights_container = event.xpath('.//div[@data-bout-toggler-target="content"]//a/@href').getall()
-            for link in fights_container:
-                if link:
-                    if '/fightcenter/fighters/' in link and 'fightcenter/fighters/' not in event_item['fighters']:
-                        event_item['fighters'].append(link)
-                    elif '/fightcenter/bouts/' in link and 'fightcenter/bouts/' not in event_item['fights']:
-                        event_item['fights'].append(link)
+
             try:
-                yield scrapy.Request(event_item['event_link'], callback=self.parse_event_details, meta={'event_item': event_item})
+                yield scrapy.Request(event_item['event_link'], callback=self.details_callback, meta={'event_item': event_item})
             except Exception as e:
                 proxy_logger.error(f"Error in starting request for promotion {event_item['event_link']}: {e} for spider {self.name}")
             general_logger.info(f"Scraping event details for {['event_name']} - {event_item['event_link']}")
         
 
+    def follow_pages(self, response, promotion_link, page, event_count):
+        """Schedules the listing pages that exist past this one, all at once when the pager shows them"""
+        self.listing_page_size = max(self.listing_page_size, event_count)
+        scheduled = self.scheduled_pages.get(promotion_link, 1)
+        last_page = last_page_number(response)
+        if last_page is None:
+            # No pager to read, only walk on while pages come back full
+            if page < scheduled or event_count < self.listing_page_size:
+                general_logger.info(f"Page {page} is the last page for {promotion_link}")
+                return
+            last_page = page + 1
+
+        if last_page > scheduled:
+            general_logger.info(f"Scheduling pages {scheduled + 1}-{last_page} for {promotion_link}")
+        for next_page in range(scheduled + 1, last_page + 1):
+            yield scrapy.Request(page_url(promotion_link, next_page), callback=self.parse, meta={'promotion_link': promotion_link, 'page': next_page, 'proxy_session': promotion_link}, errback=self.errback_proxy)
+        self.scheduled_pages[promotion_link] = max(scheduled, last_page)
+
+    def parse_incremental(self, response):
+        promotion_link = response.meta['promotion_link']
+        page = response.meta['page']
+        watermark = self.watermarks.get(promotion_link)
+        reached_watermark = False
+
+        events = response.xpath("//div[@data-controller='bout-toggler']")
+        for event in events:
+            event_item = self.build_event_item(event, promotion_link, response)
+            if not event_item:
+                continue
+
+            event_link = event_item['event_link']
+            if event_link in self.event_dates:
+                event_date = self.event_dates[event_link]
+                if event_date and event_date < self.cutoff:
+                    # Listings are newest first, so everything past the watermark was seen on an earlier run
+                    self.new_watermarks[promotion_link] = max(self.new_watermarks.get(promotion_link, event_date), event_date)
+                    if watermark and event_date <= watermark:
+                        reached_watermark = True
+                        break
+                    continue
+                general_logger.info(f"Refreshing upcoming or recent event {event_link}")
+            yield scrapy.Request(event_link, callback=self.details_callback, meta={'event_item': event_item}, errback=self.errback_proxy, dont_filter=True)
+
+        last_page = last_page_number(response)
+        if not events or reached_watermark or (last_page is not None and page >= last_page):
+            general_logger.info(f"Stopped paging {promotion_link} at page {page} ({'watermark reached' if reached_watermark else 'no more events'})")
+            self.save_watermark(promotion_link)
+            return
+
+        next_page = page + 1
+        yield scrapy.Request(page_url(promotion_link, next_page), callback=self.parse, meta={'promotion_link': promotion_link, 'page': next_page, 'proxy_session': promotion_link}, errback=self.errback_proxy)
+
+    def build_event_item(self, event, promotion_link, response):
+        event_link = event.xpath('.//a[contains(@href, "/fightcenter/events/")]/@href').get()
+        if not event_link:
+            general_logger.info(f"Event link not found for {response.url}")
+            return None
+
+        event_item = TapologyEventItem()
+        event_item['promotion_link'] = promotion_link
+        event_item['event_link'] = 'https://www.tapology.com' + event_link
+        event_item['event_name'] = event.xpath('.//a[contains(@href, "/fightcenter/events/")]/text()').get()
+
+        event_item['fights'], event_item['fighters'] = [], []
+        fights_container = event.xpath('.//div[@data-bout-toggler-target="content"]//a/@href').getall()
+        for link in fights_container:
+            if link:
+                if '/fightcenter/fighters/' in link and 'fightcenter/fighters/' not in event_item['fighters']:
+                    event_item['fighters'].append(link)
+                elif '/fightcenter/bouts/' in link and 'fightcenter/bouts/' not in event_item['fights']:
+                    event_item['fights'].append(link)
+        event_item['bouts'] = card_bouts(event)
+        return event_item
+
+    @property
+    def details_callback(self):
+        return self.parse_event_details_pooled if self.parse_pool else self.parse_event_details
+
     def parse_event_details(self, response):
         event_item = response.meta['event_item']
-
-        date_container = response.xpath('//div[@class="div flex items-center justify-between text-xs uppercase font-bold text-tap_7f leading-none"]')
-        event_item['event_date'] = date_container.xpath('.//span[@class="hidden md:inline"]/text()').get()
-        location_container = response.xpath('//div[@class="div flex items-center justify-end gap-1.5"]')
-        event_item['event_location'] = location_container.xpath('.//a/text()').get()
-        details = {}
-        details_container = response.xpath('//div[contains(@class, "hidden") and contains(@class, "md:flex")]/ul/li')
-        for detail in details_container:
-            detail_key = detail.xpath('.//span[contains(@class, "font-bold")]/text()').get()
-            detail_value = detail.xpath('.//span[contains(@class, "text-neutral-700")]/text()').get()
-            
-            if detail_key and detail_value:
-                details[detail_key.strip()] = detail_value.strip()
-        event_item['event_details'] = details
+        event_item.update(extract_event_details(response.text))
         yield event_item
         item_logger.info(f"Item yielded:{event_item['event_link']} to pipeline for spider {self.name}")
 
-    def errback_proxy(self, failure):
-        # Log proxy errors
-        proxy = failure.request.meta.get('proxy')
-        proxy_logger.error(f"Proxy {proxy} encountered an error for URL: {failure.request.url} for spider {self.name}")
-        proxy_logger.error(f"Error details: {repr(failure)} for spider {self.name}")
-        
-        # Retry on failure
-        if failure.check(IgnoreRequest):
-            return None
-        else:
-            request = failure.request.copy()
-            request.dont_filter = True  # To avoid getting filtered by duplicate filter
-            return request
+    async def parse_event_details_pooled(self, response):
+        event_item = response.meta['event_item']
+        event_item.update(await maybe_deferred_to_future(self.parse_pool.submit(extract_event_details, response.text)))
+        item_logger.info(f"Item yielded:{event_item['event_link']} to pipeline for spider {self.name}")
+        return [event_item]
+
+    def closed(self, reason):
+        super().closed(reason)
+        if self.coordinator:
+            if self.heartbeat.running:
+                self.heartbeat.stop()
+            return deferToThread(self.coordinator.leave)
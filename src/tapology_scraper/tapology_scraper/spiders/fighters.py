@@ -1,6 +1,7 @@
 import scrapy,os, logging
 from tapology_scraper.items import TapologyInitialFighterItem
-from scrapy.exceptions import IgnoreRequest
+from tapology_scraper.utils import last_page_number, page_url
+from scraping.spiders import BaseSpider
 
 log_path = '/Users/sohanhossain/Documents/fightgraphs/src/tapology_scraper/logs/InitFighter_logs/'
 if not os.path.exists(log_path):
@@ -32,7 +33,7 @@ proxy_logger.addHandler(proxy_handler)
 
 
 
-class FightersSpider(scrapy.Spider):
+class FightersSpider(BaseSpider):
     name = "fighters"
     allowed_domains = ["tapology.com"]
     start_urls = ["https://www.tapology.com/search/mma-fighters-by-weight-class/Atomweight-105-pounds",
@@ -49,6 +50,10 @@ class FightersSpider(scrapy.Spider):
     
     collection = 'scrapy_tapology_fighters_initial'
     fighter_count = {}
+    # Without a pager, keep this many pages in flight ahead of the last full page
+    probe_ahead = 10
+    scheduled_pages = {}
+    first_empty_page = {}
 
 
     def start_requests(self):
@@ -56,7 +61,7 @@ class FightersSpider(scrapy.Spider):
             try:
                 weightclass = url.split('/')[-1]
                 self.fighter_count[weightclass] = 0
-                yield scrapy.Request(url, callback=self.parse, errback=self.errback_proxy, meta= {'weightclass': weightclass, 'page': 1, 'link': url})
+                yield scrapy.Request(url, callback=self.parse, errback=self.errback_proxy, meta= {'weightclass': weightclass, 'page': 1, 'link': url, 'proxy_session': url})
                 general_logger.info(f"Starting request for fighters for weightclass {url}")
             except Exception as e:
                 proxy_logger.error(f"Error in starting request for event {url}: {e} for spider {self.name}")
@@ -66,16 +71,18 @@ class FightersSpider(scrapy.Spider):
         url = response.meta['link']
         general_logger.info(f"Scraping fighters for {response.meta['weightclass']} - Page {page}")
         weightclass = response.meta['weightclass']
-        next_page = page + 1
-        next_page_url = f'{url}?page={next_page}'
 
+        if page > self.first_empty_page.get(weightclass, page):
+            general_logger.info(f"Ignoring page {page} for {weightclass}, past the last page")
+            return
 
-        
         fighters_table = response.xpath('//table[@class="siteSearchResults"]//tr')
         if not fighters_table:
+            self.first_empty_page[weightclass] = min(page, self.first_empty_page.get(weightclass, page))
             general_logger.info(f"No more fighters found for {weightclass} with page {page}")
             return
-        
+
+        yield from self.follow_pages(response, weightclass, url, page)
 
         for i,fighter in enumerate(fighters_table):
             fighter_item = TapologyInitialFighterItem()
@@ -89,27 +96,25 @@ class FightersSpider(scrapy.Spider):
             fighter_item['weightclass'] = fighter.xpath('.//td[5]/text()').get()
             fighter_item['record'] = fighter.xpath('.//td[7]/text()').get()
             fighter_item['nationality'] = fighter.xpath('.//td[9]/img/@src').get()
-            self.fighter_count[weightclass] += 1
+            self.fighter_count[weightclass] = self.fighter_count.get(weightclass, 0) + 1
             yield fighter_item
             item_logger.info(f"Processed fighter #{self.fighter_count[weightclass]}: {fighter_item['tapology_link']} for weightclass {weightclass} at page {page}")
 
-        try:
-            yield scrapy.Request(next_page_url, callback=self.parse, meta={'weightclass': weightclass, 'page': next_page, 'link': url})
-        except Exception as e:
-            proxy_logger.error(f"Error in starting request for event {url}: {e} for spider {self.name}")
-
-
-
-    def errback_proxy(self, failure):
-        # Log proxy errors
-        proxy = failure.request.meta.get('proxy')
-        proxy_logger.error(f"Proxy {proxy} encountered an error for URL: {failure.request.url} for spider {self.name}")
-        proxy_logger.error(f"Error details: {repr(failure)} for spider {self.name}")
-        
-        # Retry on failure
-        if failure.check(IgnoreRequest):
-            return None
-        else:
-            request = failure.request.copy()
-            request.dont_filter = True  # To avoid getting filtered by duplicate filter
-            return request
+    def follow_pages(self, response, weightclass, url, page):
+        """Requests many pages of a weight class at once, using the pager or probing ahead of the last full page"""
+        scheduled = self.scheduled_pages.get(weightclass, 1)
+        last_page = last_page_number(response)
+        if last_page is None:
+            last_page = page + int(self.probe_ahead)
+        if weightclass in self.first_empty_page:
+            last_page = min(last_page, self.first_empty_page[weightclass] - 1)
+        if last_page <= scheduled:
+            return
+
+        general_logger.info(f"Scheduling pages {scheduled + 1}-{last_page} for {weightclass}")
+        for next_page in range(scheduled + 1, last_page + 1):
+            try:
+                yield scrapy.Request(page_url(url, next_page), callback=self.parse, errback=self.errback_proxy, meta={'weightclass': weightclass, 'page': next_page, 'link': url, 'proxy_session': url})
+            except Exception as e:
+                proxy_logger.error(f"Error in starting request for event {url}: {e} for spider {self.name}")
+        self.scheduled_pages[weightclass] = last_page
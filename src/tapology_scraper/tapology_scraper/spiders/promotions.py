@@ -1,8 +1,8 @@
 import scrapy
 from tapology_scraper.items import TapologyPromotionItem
 import logging
-from scrapy.exceptions import IgnoreRequest
 import os
+from scraping.spiders import BaseSpider
 
 log_path = '/Users/sohanhossain/Documents/fightgraphs/src/tapology_scraper/logs/promotions_log/'
 if not os.path.exists(log_path):
@@ -35,7 +35,7 @@ proxy_logger.addHandler(proxy_handler)
 
 
 
-class PromotionsSpider(scrapy.Spider):
+class PromotionsSpider(BaseSpider):
     name = "promotions"
     collection = 'scrapy_tapology_promotions'
     allowed_domains = ["tapology.com"]
@@ -50,7 +50,7 @@ class PromotionsSpider(scrapy.Spider):
                 url = f'https://www.tapology.com/fightcenter/promotions?page={page}'
                 general_logger.info(f"Starting request for page {page}: {url}")
             try:
-                if self.db[self.collection].find_one({'promotion_link': url}):
+                if self.dedup_indexes[self.collection].has_key(url):
                     general_logger.info(f"Promotions page {page} already exists in the database. Skipping...")
                     continue
                 else:
@@ -81,19 +81,3 @@ class PromotionsSpider(scrapy.Spider):
             
             yield promotion
             item_logger.info(f"Item yielded:{promotion_link} to pipeline for spider {self.name}")
-
-
-
-    def errback_proxy(self, failure):
-        # Log proxy errors
-        proxy = failure.request.meta.get('proxy')
-        proxy_logger.error(f"Proxy {proxy} encountered an error for URL: {failure.request.url} for spider {self.name}")
-        proxy_logger.error(f"Error details: {repr(failure)} for spider {self.name}")
-        
-        # Retry on failure
-        if failure.check(IgnoreRequest):
-            return None
-        else:
-            request = failure.request.copy()
-            request.dont_filter = True  # To avoid getting filtered by duplicate filter
-            return request
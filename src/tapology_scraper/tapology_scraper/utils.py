@@ -0,0 +1,35 @@
+from urllib.parse import urlparse, parse_qs
+
+
+def last_page_number(response):
+    """Returns the highest page number linked from the page's pager, or None when the page has no pager"""
+    path = urlparse(response.url).path
+    pages = []
+    for href in response.xpath('//a[contains(@href, "page=")]/@href').getall():
+        url = urlparse(response.urljoin(href))
+        page = parse_qs(url.query).get('page', [''])[0]
+        if url.path == path and page.isdigit():
+            pages.append(int(page))
+    return max(pages) if pages else None
+
+
+def page_url(url, page):
+    return url if page == 1 else f'{url}?page={page}'
+
+
+def card_bouts(event):
+    """Each bout on an event's card with its two fighter links, read from the row that holds the bout link"""
+    bouts = {}
+    for anchor in event.xpath('.//div[@data-bout-toggler-target="content"]//a[contains(@href, "/fightcenter/bouts/")]'):
+        link = anchor.attrib.get('href')
+        # The closest element around the bout link that has fighter links in it is the bout's row
+        row = anchor.xpath('ancestor::*[.//a[contains(@href, "/fightcenter/fighters/")]][1]')
+        if not link or link in bouts or not row:
+            continue
+        # A row holding several bout links does not tell who fought whom
+        if len(set(row.xpath('.//a[contains(@href, "/fightcenter/bouts/")]/@href').getall())) != 1:
+            continue
+        fighters = list(dict.fromkeys(row.xpath('.//a[contains(@href, "/fightcenter/fighters/")]/@href').getall()))
+        if len(fighters) == 2:
+            bouts[link] = {'bout_link': link, 'fighters': fighters}
+    return list(bouts.values())
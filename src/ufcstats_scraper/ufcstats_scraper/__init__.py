@@ -0,0 +1,6 @@
+import os, sys
+
+# Scrapy only puts the project directory on the path, src also holds the scraping package both projects share
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
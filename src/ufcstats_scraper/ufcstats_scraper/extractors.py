@@ -0,0 +1,178 @@
+import re
+from lxml import etree
+from parsel import Selector
+
+LISTING_COLUMNS = ['first_name', 'last_name', 'nickname', 'height', 'weight', 'reach', 'stance', 'wins', 'losses', 'draws']
+# Per round table headers, with punctuation and spaces dropped, and the columns each one is split into.
+# Percentages are left out, they follow from landed and attempted
+ROUND_COLUMNS = {
+    'kd': ('kd',),
+    'sigstr': ('sig_str_landed', 'sig_str_attempted'),
+    'totalstr': ('total_str_landed', 'total_str_attempted'),
+    'td': ('td_landed', 'td_attempted'),
+    'subatt': ('sub_att',),
+    'rev': ('rev',),
+    'ctrl': ('ctrl_seconds',),
+    'head': ('head_landed', 'head_attempted'),
+    'body': ('body_landed', 'body_attempted'),
+    'leg': ('leg_landed', 'leg_attempted'),
+    'distance': ('distance_landed', 'distance_attempted'),
+    'clinch': ('clinch_landed', 'clinch_attempted'),
+    'ground': ('ground_landed', 'ground_attempted')
+}
+FIGHT_INFO_LABELS = {'method': 'method', 'round': 'round', 'time': 'time', 'timeformat': 'time_format', 'referee': 'referee'}
+LANDED_OF_ATTEMPTED = re.compile(r'(\d+)\s+of\s+(\d+)')
+MINUTES_SECONDS = re.compile(r'(\d+):(\d{2})')
+
+
+def _cell_text(cell):
+    link = cell.find('a')
+    if link is not None:
+        return link.text
+    return cell.text
+
+
+def iter_listing_rows(body, encoding='utf-8', chunk_size=64 * 1024):
+    """Streams the rows of the fighters listing table as dicts, freeing each row once it has been read"""
+    parser = etree.HTMLPullParser(events=('end',), tag='tr', encoding=encoding)
+    view = memoryview(body)
+    for start in range(0, len(body), chunk_size):
+        parser.feed(bytes(view[start:start + chunk_size]))
+        yield from _drain_rows(parser)
+    parser.close()
+    yield from _drain_rows(parser)
+
+
+def _drain_rows(parser):
+    for _, row in parser.read_events():
+        body = row.getparent()
+        table = body.getparent() if body is not None else None
+        if body is None or body.tag != 'tbody' or table is None or table.get('class') != 'b-statistics__table':
+            continue
+
+        cells = row.findall('td')
+        if len(cells) >= len(LISTING_COLUMNS):
+            link = cells[0].find('a')
+            data = {'fighter_link': link.get('href') if link is not None else None}
+            for column, cell in zip(LISTING_COLUMNS, cells):
+                data[column] = _cell_text(cell)
+            champ = cells[10].find('img') if len(cells) > 10 else None
+            data['champ'] = champ is not None and bool(champ.get('src'))
+            yield data
+
+        # Drop the rows already read so memory stays flat however long the table is
+        row.clear(keep_tail=True)
+        while row.getprevious() is not None:
+            del body[0]
+
+
+def extract_fights(text):
+    """Pulls the fight history table off a fighter page. Plain data only, so it can run in a worker process."""
+    selector = Selector(text=text)
+    fights = []
+    fights_table = selector.xpath('//table[@class="b-fight-details__table b-fight-details__table_style_margin-top b-fight-details__table_type_event-details js-fight-table"]/tbody/tr[position()>1]')
+    for fight in fights_table:
+        fight_link = fight.xpath('.//td[1]/p/a/@href').get()
+        fight_outcome = fight.xpath('.//td[1]/p/a/i/i/text()').get()
+        fighters_involved = fight.xpath('.//td[2]//a/@href').getall()
+        event_link = fight.xpath('.//td[7]/p[1]/a/@href').get()
+        event_date = fight.xpath('.//td[7]/p[2]/text()').get()
+        title_fight = fight.xpath('.//td[7]/p[2]/img/@src').get()
+        if title_fight:
+            title_fight = True
+        else:
+            title_fight = False
+        finish_method = fight.xpath('.//td[8]/p[1]/text()').get()
+        finish_details = fight.xpath('.//td[8]/p[2]/text()').get()
+        bonuses = fight.xpath('.//td[8]/p[1]/img/@src').getall()
+        round_ended = fight.xpath('.//td[9]/p/text()').get()
+        time_ended = fight.xpath('.//td[10]/p/text()').get()
+        data = {
+            'fight_link': fight_link,
+            'fight_outcome': fight_outcome,
+            'fighters_involved': fighters_involved,
+            'event_link': event_link,
+            'event_date': event_date,
+            'title_fight': title_fight,
+            'finish_method': finish_method,
+            'finish_details': finish_details,
+            'bonuses': bonuses,
+            'round_ended': round_ended,
+            'time_ended': time_ended
+        }
+        for key, value in data.items():
+            if value and isinstance(value, list):
+                data[key] = [item.strip() for item in value]
+            elif isinstance(value, str):
+                data[key] = value.strip()
+        fights.append(data)
+    return fights
+
+
+def _stat_values(text, width):
+    """'12 of 30' -> [12, 30], '2:15' -> [135], '1' -> [1], '--' -> [None]"""
+    text = (text or '').strip()
+    match = LANDED_OF_ATTEMPTED.search(text)
+    if match:
+        return [int(match.group(1)), int(match.group(2))]
+    match = MINUTES_SECONDS.search(text)
+    if match:
+        return [int(match.group(1)) * 60 + int(match.group(2))]
+    return [int(text)] if text.isdigit() else [None] * width
+
+
+def extract_round_stats(selector):
+    """Per round stats of both fighters as columns: row i is fighter[i] in round[i], fighter being 0 or 1"""
+    columns = {'round': [], 'fighter': []}
+    for table in selector.xpath('//section[contains(@class, "b-fight-details__section")]//table[contains(@class, "js-fight-table")]'):
+        headers = [re.sub(r'[^a-z%]', '', ''.join(th.xpath('.//text()').getall()).lower()) for th in table.xpath('./thead[1]//th')]
+        rows = table.xpath('./tbody/tr')
+        # Both tables cover the same rounds, the first one lays out the round and fighter columns
+        fill_keys = not columns['round']
+        for number, row in enumerate(rows, 1):
+            cells = row.xpath('./td')
+            for fighter in (0, 1):
+                if fill_keys:
+                    columns['round'].append(number)
+                    columns['fighter'].append(fighter)
+                for header, cell in zip(headers, cells):
+                    names = ROUND_COLUMNS.get(header)
+                    # Sig. str. shows up in both tables, it is only read once
+                    if not names or (names[0] in columns and len(columns[names[0]]) >= len(columns['round'])):
+                        continue
+                    texts = cell.xpath('./p/text()').getall()
+                    values = _stat_values(texts[fighter] if fighter < len(texts) else None, len(names))
+                    for name, value in zip(names, values):
+                        columns.setdefault(name, []).append(value)
+    return columns
+
+
+def extract_fight_details(text):
+    """Pulls the result, bout details and per round stats off a fight page. Plain data only, so it can run in a worker process."""
+    selector = Selector(text=text)
+    people = selector.xpath('//div[contains(concat(" ", normalize-space(@class), " "), " b-fight-details__person ")]')
+    data = {
+        'event_link': selector.xpath('//h2[contains(@class, "b-content__title")]/a/@href').get(),
+        'event_name': selector.xpath('//h2[contains(@class, "b-content__title")]/a/text()').get(),
+        'fighters': people.xpath('.//h3/a/@href').getall(),
+        'fighter_names': people.xpath('.//h3/a/text()').getall(),
+        'outcomes': people.xpath('.//i[contains(@class, "b-fight-details__person-status")]/text()').getall(),
+        'bout': ' '.join(''.join(selector.xpath('//i[contains(@class, "b-fight-details__fight-title")]//text()').getall()).split()),
+        'bonuses': selector.xpath('//i[contains(@class, "b-fight-details__fight-title")]/img/@src').getall()
+    }
+    data['title_fight'] = 'title' in data['bout'].lower()
+    for item in selector.xpath('(//p[contains(@class, "b-fight-details__text")])[1]/i[contains(@class, "b-fight-details__text-item")]'):
+        label = ''.join(item.xpath('./i[contains(@class, "b-fight-details__label")]/text()').getall())
+        key = FIGHT_INFO_LABELS.get(re.sub(r'[^a-z]', '', label.lower()))
+        if key:
+            value = ' '.join(''.join(item.xpath('.//text()').getall()).split())
+            data[key] = value[len(' '.join(label.split())):].strip()
+    details = ' '.join(''.join(selector.xpath('(//p[contains(@class, "b-fight-details__text")])[2]//text()').getall()).split())
+    data['details'] = details.removeprefix('Details:').strip() or None
+    for key, value in data.items():
+        if value and isinstance(value, list):
+            data[key] = [item.strip() for item in value]
+        elif isinstance(value, str):
+            data[key] = value.strip()
+    data['round_stats'] = extract_round_stats(selector)
+    return data
@@ -26,4 +26,33 @@ class UfcStatsFighterItem(scrapy.Item):
     draws = scrapy.Field()
     champ = scrapy.Field()
     fighter_link = scrapy.Field()
-    fights = scrapy.Field()
\ No newline at end of file
+    fights = scrapy.Field()
+    # Typed fields added by UfcstatsNormalizationPipeline
+    height_cm = scrapy.Field()
+    weight_kg = scrapy.Field()
+    reach_cm = scrapy.Field()
+    record_wld = scrapy.Field()
+
+
+class UfcStatsFightItem(scrapy.Item):
+    hash = scrapy.Field()
+    fight_link = scrapy.Field()
+    event_link = scrapy.Field()
+    event_name = scrapy.Field()
+    fighters = scrapy.Field()
+    fighter_names = scrapy.Field()
+    outcomes = scrapy.Field()
+    bout = scrapy.Field()
+    title_fight = scrapy.Field()
+    bonuses = scrapy.Field()
+    method = scrapy.Field()
+    round = scrapy.Field()
+    time = scrapy.Field()
+    time_format = scrapy.Field()
+    referee = scrapy.Field()
+    details = scrapy.Field()
+    # Columns of per round stats, one entry per fighter per round
+    round_stats = scrapy.Field()
+    # Typed fields added by UfcstatsNormalizationPipeline
+    finish_round = scrapy.Field()
+    finish_seconds = scrapy.Field()
@@ -0,0 +1,11 @@
+"""Bulk loads scraped ufcstats items from JSON Lines into MongoDB without running a crawl.
+
+    python -m ufcstats_scraper.loader <file or dir> [...] [--item UfcStatsFighterItem] [--mode upsert] [--writers 8]
+    python -m ufcstats_scraper.loader --archive <dir> --spider fighters
+
+The loader itself is scraping.loader, shared with the Tapology project."""
+from scraping.loader import main
+from ufcstats_scraper.pipelines import UFCScraperPipeline
+
+if __name__ == '__main__':
+    main(UFCScraperPipeline)
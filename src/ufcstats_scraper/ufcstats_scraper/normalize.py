@@ -0,0 +1,100 @@
+"""Parsers that turn the strings scraped off ufcstats into numbers in metric units and real dates.
+
+Typed values are written next to the raw strings, which stay as scraped so hashes and older readers keep working."""
+import re
+from datetime import datetime
+
+FEET_INCHES = re.compile(r"(\d+)'\s*(\d+(?:\.\d+)?)?")
+INCHES = re.compile(r'(\d+(?:\.\d+)?)\s*"')
+POUNDS = re.compile(r'(\d+(?:\.\d+)?)\s*lbs?\b')
+WORDED_DATE = re.compile(r'([A-Za-z]{3})[a-z]*\.? (\d{1,2}),? (\d{4})')
+ROUND_MINUTES = re.compile(r'\(([\d-]+)\)')
+MINUTES_SECONDS = re.compile(r'(\d+):(\d{2})')
+MONTHS = {month: number for number, month in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+CM_PER_INCH = 2.54
+KG_PER_POUND = 0.45359237
+
+# Fields derived here, left out of the content hash since they only restate the raw ones
+TYPED_FIELDS = ('height_cm', 'weight_kg', 'reach_cm', 'record_wld', 'finish_round', 'finish_seconds')
+# Indexes for the range queries the typed fields are meant for
+TYPED_INDEXES = {
+    'scrapy_ufcstats_fighter': ['height_cm', 'weight_kg', 'reach_cm', 'fights.event_datetime']
+}
+
+
+def parse_height_cm(value):
+    """5' 11" -> 180.3"""
+    match = FEET_INCHES.search(value) if isinstance(value, str) else None
+    if not match:
+        return None
+    inches = int(match.group(1)) * 12 + float(match.group(2) or 0)
+    return round(inches * CM_PER_INCH, 1)
+
+
+def parse_reach_cm(value):
+    """72.0" -> 182.9"""
+    match = INCHES.search(value) if isinstance(value, str) else None
+    return round(float(match.group(1)) * CM_PER_INCH, 1) if match else None
+
+
+def parse_weight_kg(value):
+    """155 lbs. -> 70.3"""
+    match = POUNDS.search(value) if isinstance(value, str) else None
+    return round(float(match.group(1)) * KG_PER_POUND, 1) if match else None
+
+
+def parse_int(value):
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+def parse_date(value):
+    """Mar. 02, 2024 -> datetime(2024, 3, 2)"""
+    match = WORDED_DATE.search(value) if isinstance(value, str) else None
+    if not match or match.group(1).title() not in MONTHS:
+        return None
+    try:
+        return datetime(int(match.group(3)), MONTHS[match.group(1).title()], int(match.group(2)))
+    except ValueError:
+        return None
+
+
+def normalize_fighter(fields):
+    """Adds the typed fields to a fighter item or stored document, in place"""
+    fields['height_cm'] = parse_height_cm(fields.get('height'))
+    fields['weight_kg'] = parse_weight_kg(fields.get('weight'))
+    fields['reach_cm'] = parse_reach_cm(fields.get('reach'))
+    record = [parse_int(fields.get(key)) for key in ('wins', 'losses', 'draws')]
+    fields['record_wld'] = record if None not in record else None
+    for fight in fields.get('fights') or []:
+        if isinstance(fight, dict):
+            fight['event_datetime'] = parse_date(fight.get('event_date'))
+    return fields
+
+
+def parse_fight_seconds(finish_round, time, time_format):
+    """Round 3 at 2:15 of 3 Rnd (5-5-5) -> 735, seconds from the opening bell to the finish"""
+    match = MINUTES_SECONDS.search(time) if isinstance(time, str) else None
+    if finish_round is None or not match:
+        return None
+    lengths = ROUND_MINUTES.search(time_format) if isinstance(time_format, str) else None
+    minutes = [int(length) for length in lengths.group(1).split('-') if length] if lengths else []
+    if len(minutes) < finish_round - 1:
+        return None
+    return sum(minutes[:finish_round - 1]) * 60 + int(match.group(1)) * 60 + int(match.group(2))
+
+
+def normalize_fight(fields):
+    fields['finish_round'] = parse_int(fields.get('round'))
+    fields['finish_seconds'] = parse_fight_seconds(fields['finish_round'], fields.get('time'), fields.get('time_format'))
+    return fields
+
+
+NORMALIZERS = {
+    'scrapy_ufcstats_fighter': normalize_fighter,
+    'scrapy_ufcstats_fights': normalize_fight
+}
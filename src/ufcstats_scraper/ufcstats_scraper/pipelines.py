@@ -1,8 +1,13 @@
 from itemadapter import ItemAdapter
 from scrapy.exceptions import DropItem
-from ufcstats_scraper.items import UfcStatsFighterItem
-import logging, os, hashlib
-from pymongo import MongoClient
+from twisted.internet.threads import deferToThread
+from scraping.hashing import content_hash
+from scraping.mongo import DedupIndex, MongoWriter, bump_cache_version
+from ufcstats_scraper.normalize import NORMALIZERS, TYPED_FIELDS, TYPED_INDEXES
+from ufcstats_scraper.items import UfcStatsFighterItem, UfcStatsFightItem
+import logging, os
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from dotenv import load_dotenv
 
 MONGO_URI = os.getenv("MONGO_URI")
@@ -23,16 +28,36 @@ dupe_handler.setFormatter(formatter)
 dupe_logger.setLevel(logging.INFO)
 dupe_logger.addHandler(dupe_handler)
 
+def fill_missing(fields):
+    """Writes 'N/A' into empty fields, the placeholder stored documents and their readers rely on"""
+    for key, value in fields.items():
+        # Typed fields stay None so the columns hold a single type
+        if value is None and key not in TYPED_FIELDS:
+            fields[key] = 'N/A'
+
+def item_hash(fields, algorithm='blake2b'):
+    """The content hash the pipeline dedups on, list fields are left out. Empty fields are read as 'N/A' from a copy,
+    so an item hashes the same before and after fill_missing and the fields are left as they are"""
+    canonical = {key: 'N/A' if value is None and key not in TYPED_FIELDS else value for key, value in fields.items()}
+    return content_hash(canonical, algorithm, skip_lists=True, exclude=TYPED_FIELDS)
 
 class UfcstatsScraperPipeline:
     def process_item(self, item, spider):
         return item
 
 class UFCScraperPipeline:
-    def __init__(self, mongo_uri=MONGO_URI, mongo_db=MONGO_DATABASE):
+    def __init__(self, mongo_uri=MONGO_URI, mongo_db=MONGO_DATABASE, async_writes=False, writer_queue_size=4, writer_max_retries=5, write_mode='insert', hash_algorithm='blake2b'):
         self.mongo_uri = mongo_uri
         self.mongo_db_name = mongo_db
-        self.collections = { UfcStatsFighterItem: 'scrapy_ufcstats_fighter'}
+        self.async_writes = async_writes
+        self.writer_queue_size = writer_queue_size
+        self.writer_max_retries = writer_max_retries
+        self.writer = None
+        self.write_mode = write_mode
+        self.hash_algorithm = hash_algorithm
+        self.collections = { UfcStatsFighterItem: 'scrapy_ufcstats_fighter', UfcStatsFightItem: 'scrapy_ufcstats_fights'}
+        self.natural_keys = { 'scrapy_ufcstats_fighter': 'fighter_link', 'scrapy_ufcstats_fights': 'fight_link'}
+        self.indexes = {}
         self.buffers = {collection: [] for collection in self.collections.values()}
         self.batch_size = 250
 
@@ -43,7 +68,12 @@ class UFCScraperPipeline:
     def from_crawler(cls, crawler):
         return cls(
             mongo_uri=crawler.settings.get('MONGO_URI', MONGO_URI),
-            mongo_db=crawler.settings.get('MONGO_DATABASE', MONGO_DATABASE)
+            mongo_db=crawler.settings.get('MONGO_DATABASE', MONGO_DATABASE),
+            async_writes=crawler.settings.getbool('MONGO_ASYNC_WRITES', False),
+            writer_queue_size=crawler.settings.getint('MONGO_WRITER_QUEUE_SIZE', 4),
+            writer_max_retries=crawler.settings.getint('MONGO_WRITER_MAX_RETRIES', 5),
+            write_mode=crawler.settings.get('MONGO_WRITE_MODE', 'insert'),
+            hash_algorithm=crawler.settings.get('CONTENT_HASH_ALGORITHM', 'blake2b')
         )
     
 
@@ -52,17 +82,84 @@ class UFCScraperPipeline:
         self.db = self.client[self.mongo_db_name]
         spider.db = self.db
 
+        # Preload stored hashes and links once so duplicate checks never hit the database
+        for collection, key_field in self.natural_keys.items():
+            self.indexes[collection] = DedupIndex(key_field, item_hash).load(self.db[collection], self.hash_algorithm)
+            dupe_logger.info(f"Loaded {len(self.indexes[collection].hashes)} hashes and {len(self.indexes[collection].keys)} links for {collection}")
+            if self.indexes[collection].upgraded:
+                dupe_logger.info(f"Rehashed {self.indexes[collection].upgraded} documents in {collection} stored under an older hash scheme")
+        spider.dedup_indexes = self.indexes
+
+        if self.write_mode == 'upsert':
+            for collection, key_field in self.natural_keys.items():
+                try:
+                    self.db[collection].create_index(key_field, unique=True)
+                    dupe_logger.info(f"Ensured unique index on {key_field} for {collection}")
+                except PyMongoError as e:
+                    dupe_logger.error(f"Could not create unique index on {key_field} for {collection}: {e}")
+
+        # Typed fields get plain indexes so range queries on them run in the database
+        for collection, fields in TYPED_INDEXES.items():
+            for field in fields:
+                try:
+                    self.db[collection].create_index(field)
+                except PyMongoError as e:
+                    dupe_logger.error(f"Could not create index on {field} for {collection}: {e}")
+
+        if self.async_writes:
+            self.writer = MongoWriter(self.write_batch, dupe_logger, log_path, self.writer_queue_size, self.writer_max_retries)
+            self.writer.start()
+            dupe_logger.info(f"Started background writer with a queue of {self.writer_queue_size} batches")
+
+    def write_batch(self, collection, docs):
+        # The cache version is only bumped when documents changed, so batches that failed or matched what was
+        # stored leave the query API's cached reads alone
+        try:
+            if self.write_mode == 'upsert':
+                # Keyed on the natural link, so replaying a batch that was partly written is harmless
+                key_field = self.natural_keys[collection]
+                operations = [
+                    UpdateOne({key_field: doc[key_field]}, {'$set': {k: v for k, v in doc.items() if k != '_id'}}, upsert=True)
+                    for doc in docs
+                ]
+                result = self.db[collection].bulk_write(operations, ordered=False)
+                changed = result.upserted_count + result.modified_count
+            else:
+                self.db[collection].insert_many(docs, ordered=not self.async_writes)
+                changed = len(docs)
+        except BulkWriteError as e:
+            # The documents of a failed batch that did get written
+            if e.details.get('nInserted') or e.details.get('nUpserted') or e.details.get('nModified'):
+                bump_cache_version(self.db, collection, dupe_logger)
+            raise
+        if changed:
+            bump_cache_version(self.db, collection, dupe_logger)
+
     def close_spider(self, spider):
+        if self.writer:
+            # Queue the leftovers behind every batch already submitted, then wait for the writer to drain
+            for collection, buffer in self.buffers.items():
+                if buffer:
+                    dupe_logger.info(f"Queueing final {len(buffer)} items for {collection}.")
+                    self.writer.submit(collection, buffer)
+                    self.buffers[collection] = []
+            return deferToThread(self.close_writer)
+
         for collection, buffer in self.buffers.items():
             if buffer:
                 try:
                     dupe_logger.info(f"Attempting to insert {len(buffer)} items into {collection}.")
-                    self.db[collection].insert_many(buffer)
+                    self.write_batch(collection, buffer)
                     dupe_logger.info(f"Successfully inserted {len(buffer)} items into {collection}.")
                 except Exception as e:
                     dupe_logger.error(f"Error inserting items into {collection}: {e}")
         self.client.close()
 
+    def close_writer(self):
+        self.writer.close()
+        dupe_logger.info("Background writer drained")
+        self.client.close()
+
     
     def process_item(self, item, spider):
         collection = self.collection_name(item)
@@ -70,23 +167,25 @@ class UFCScraperPipeline:
             raise DropItem(f"Invalid item type: {type(item)}")
         
         adapter = ItemAdapter(item)
-        hash_string = ''
-        for key, value in sorted(adapter.items()):
-            if value is None:
-                adapter[key] = 'N/A'
-            elif isinstance(value, list):
-                continue
-            hash_string += str(value)
-        adapter['hash'] = hashlib.sha256(hash_string.encode()).hexdigest()
-
-        if self.db[collection].find_one({'hash': adapter['hash']}):
+        fill_missing(adapter)
+        adapter['hash'] = item_hash(adapter, self.hash_algorithm)
+
+        index = self.indexes[collection]
+        if self.write_mode == 'upsert' and adapter.get(index.key_field) in (None, 'N/A'):
+            dupe_logger.warning(f"Item of type {type(item)} has no {index.key_field} to upsert on: {adapter['hash']}")
+            raise DropItem(f"Missing {index.key_field}: {adapter['hash']}")
+        if index.has_hash(adapter['hash']):
             dupe_logger.info(f"Duplicate item found of type {type(item)}: {adapter['hash']} in collection {collection}")
             raise DropItem(f"Duplicate item found: {adapter['hash']}")
         else:
             self.buffers[collection].append(dict(adapter))
+            index.add(adapter['hash'], adapter.get(index.key_field))
             if len(self.buffers[collection]) >= self.batch_size:
+                if self.writer:
+                    batch, self.buffers[collection] = self.buffers[collection], []
+                    return self.writer.submit(collection, batch).addCallback(lambda _: item)
                 try:
-                    self.db[collection].insert_many(self.buffers[collection])
+                    self.write_batch(collection, self.buffers[collection])
                     self.buffers[collection] = [] 
                 except Exception as e:
                     dupe_logger.error(f"Error inserting items into {collection}: {e}")
@@ -96,4 +195,19 @@ class UFCScraperPipeline:
             
    
         return item
-    
\ No newline at end of file
+    
+
+
+class UfcstatsNormalizationPipeline:
+    """Adds typed fields parsed from the raw strings, metric units, record tuples and dates, before items are stored.
+
+    Enable it ahead of UFCScraperPipeline, e.g. ITEM_PIPELINES = {'ufcstats_scraper.pipelines.UfcstatsNormalizationPipeline': 200, 'ufcstats_scraper.pipelines.UFCScraperPipeline': 300}."""
+
+    def __init__(self):
+        self.collections = UFCScraperPipeline().collections
+
+    def process_item(self, item, spider):
+        normalizer = NORMALIZERS.get(self.collections.get(type(item)))
+        if normalizer:
+            normalizer(ItemAdapter(item))
+        return item
@@ -0,0 +1,9 @@
+"""Replays archived ufcstats pages through the spider callbacks without touching the network.
+
+    python -m ufcstats_scraper.replay fighters --archive <dir> --output <dir> [--workers N] [--callback parse_details]
+
+The replay itself is scraping.replay, shared with the Tapology project."""
+from scraping.replay import main
+
+if __name__ == '__main__':
+    main('ufcstats_scraper')
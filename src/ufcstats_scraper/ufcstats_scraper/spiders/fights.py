@@ -0,0 +1,87 @@
+import scrapy, logging, os
+from ufcstats_scraper.items import UfcStatsFightItem
+from ufcstats_scraper.extractors import extract_fight_details
+from scrapy.utils.defer import maybe_deferred_to_future
+from scraping.spiders import BaseSpider
+
+log_path = '/Users/sohanhossain/Documents/fightgraphs/src/ufcstats_scraper/logs/fights_log/'
+if not os.path.exists(log_path):
+    os.makedirs(log_path)
+
+general_logger = logging.getLogger('general')
+item_logger = logging.getLogger('item_processing')
+proxy_logger = logging.getLogger('proxy_errors')
+
+# Configure loggers
+logging.basicConfig(level=logging.DEBUG)
+general_handler = logging.FileHandler(f'{log_path}general.log')
+item_handler = logging.FileHandler(f'{log_path}item_processing.log')
+proxy_handler = logging.FileHandler(f'{log_path}proxy_errors.log')
+proxy_handler.setLevel(logging.ERROR)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+general_handler.setFormatter(formatter)
+item_handler.setFormatter(formatter)
+proxy_handler.setFormatter(formatter)
+
+general_logger.setLevel(logging.DEBUG)
+item_logger.setLevel(logging.INFO)
+proxy_logger.setLevel(logging.ERROR)
+
+general_logger.addHandler(general_handler)
+item_logger.addHandler(item_handler)
+proxy_logger.addHandler(proxy_handler)
+
+
+class FightsSpider(BaseSpider):
+    """Fetches every bout linked from the stored fighter pages once, with its per round stats.
+
+    A bout shows up on both fighters' pages, the links are deduped before anything is requested. Fights already
+    stored are skipped, so an interrupted crawl resumes by running it again."""
+
+    name = "fights"
+    allowed_domains = ["ufcstats.com"]
+    collection = 'scrapy_ufcstats_fights'
+    fighters_collection = 'scrapy_ufcstats_fighter'
+
+    # Fight pages are small and all on one host, so many can be in flight at once. Upserts on fight_link make
+    # a batch written again after a crash land on the same documents
+    custom_settings = {
+        'CONCURRENT_REQUESTS': 32,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 32,
+        'RATE_CONTROL_START_CONCURRENCY': 8,
+        'RATE_CONTROL_MAX_CONCURRENCY': 32,
+        'MONGO_WRITE_MODE': 'upsert'
+    }
+    skip_stored = True
+
+    def start_requests(self):
+        self.open_parse_pool('fight')
+        # distinct runs in the database and returns each bout once, however many fighter pages list it
+        links = [link for link in self.db[self.fighters_collection].distinct('fights.fight_link') if link and link != 'N/A']
+        stored = self.dedup_indexes[self.collection] if self.skip_stored else None
+        pending = [link for link in links if not (stored and stored.has_key(link))]
+        general_logger.info(f"Found {len(links)} bouts, {len(links) - len(pending)} already stored, requesting {len(pending)}")
+        for link in pending:
+            try:
+                yield scrapy.Request(link, callback=self.details_callback, errback=self.errback_proxy, meta={'fight_link': link})
+            except Exception as e:
+                proxy_logger.error(f"Error in starting request for fight {link}: {e} for spider {self.name}")
+
+    @property
+    def details_callback(self):
+        return self.parse_pooled if self.parse_pool else self.parse
+
+    def fight_item(self, response, details):
+        fight_item = UfcStatsFightItem(fight_link=response.meta.get('fight_link', response.url), **details)
+        item_logger.info(f"Yielded item {fight_item['fight_link']} for processing")
+        return fight_item
+
+    def parse(self, response):
+        general_logger.info(f"Scraping fight {response.url}")
+        yield self.fight_item(response, extract_fight_details(response.text))
+
+    async def parse_pooled(self, response):
+        general_logger.info(f"Scraping fight {response.url} in the parse pool")
+        details = await maybe_deferred_to_future(self.parse_pool.submit(extract_fight_details, response.text))
+        return [self.fight_item(response, details)]